@@ -0,0 +1,219 @@
+'''summaries of the readings taken during a window
+
+collectors can sample every second while the transports only get a summary
+every few seconds, for each number of the readings the summary has the min,
+max, mean and last value and the 95th and 99th percentiles estimated with
+the P-square algorithm (Jain and Chlamtac, 1985) that keeps 5 markers
+instead of the samples
+
+for the counters (COUNTERS) the values are per second rates calculated from
+the deltas, the mean is the sum of the deltas over the time they span so
+it's exact, for the rest the values are the readings'''
+import stream
+
+# collectors whose deltas are summarized as rates
+COUNTERS = ("cpu", "net", "disk")
+
+PERCENTILES = (95, 99)
+
+def _is_number(value):
+    '''return True if *value* is summarized'''
+    return isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool)
+
+class P2Quantile(object):
+    '''streaming estimate of the *quantile* (0 to 1) of the values added'''
+
+    __slots__ = ("quantile", "heights", "positions", "desired", "increments")
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile,
+                3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2.0, quantile, (1 + quantile) / 2.0,
+                1]
+
+    def add(self, value):
+        '''add a value'''
+        heights = self.heights
+
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self.positions
+
+        for i in xrange(cell + 1, 5):
+            positions[i] += 1
+
+        for i in xrange(5):
+            self.desired[i] += self.increments[i]
+
+        for i in xrange(1, 4):
+            diff = self.desired[i] - positions[i]
+
+            if (diff >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (diff <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if diff > 0 else -1
+                height = self._parabolic(i, step)
+
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, step)
+
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        '''piecewise parabolic prediction of marker *i* moved by *step*'''
+        heights = self.heights
+        positions = self.positions
+
+        return heights[i] + step / float(positions[i + 1] -
+                positions[i - 1]) * (
+                (positions[i] - positions[i - 1] + step) *
+                (heights[i + 1] - heights[i]) /
+                float(positions[i + 1] - positions[i]) +
+                (positions[i + 1] - positions[i] - step) *
+                (heights[i] - heights[i - 1]) /
+                float(positions[i] - positions[i - 1]))
+
+    def _linear(self, i, step):
+        '''linear prediction of marker *i* moved by *step*'''
+        heights = self.heights
+        positions = self.positions
+
+        return heights[i] + step * (heights[i + step] - heights[i]) / \
+                float(positions[i + step] - positions[i])
+
+    def value(self):
+        '''return the estimate, None if no values were added'''
+        heights = self.heights
+
+        if not heights:
+            return None
+        elif len(heights) < 5:
+            # exact with few values, nearest rank
+            rank = int(round(self.quantile * (len(heights) - 1)))
+            return heights[rank]
+
+        return heights[2]
+
+class MetricSummary(object):
+    '''the summary of one number in a window, the mean is total / weight'''
+
+    __slots__ = ("min", "max", "last", "total", "weight", "count",
+            "quantiles")
+
+    def __init__(self, percentiles=PERCENTILES):
+        self.min = None
+        self.max = None
+        self.last = None
+        self.total = 0.0
+        self.weight = 0.0
+        self.count = 0
+        self.quantiles = [(percentile, P2Quantile(percentile / 100.0))
+                for percentile in percentiles]
+
+    def add(self, value, amount, weight):
+        '''add *value*, *amount* and *weight* are added to the totals'''
+        if self.count == 0 or value < self.min:
+            self.min = value
+
+        if self.count == 0 or value > self.max:
+            self.max = value
+
+        self.last = value
+        self.total += amount
+        self.weight += weight
+        self.count += 1
+
+        for _percentile, quantile in self.quantiles:
+            quantile.add(value)
+
+    def to_dict(self):
+        '''return a dict representation'''
+        result = {
+            "min": self.min,
+            "max": self.max,
+            "last": self.last,
+            "mean": self.total / self.weight if self.weight else None
+        }
+
+        for percentile, quantile in self.quantiles:
+            result["p%d" % percentile] = quantile.value()
+
+        return result
+
+class WindowSummary(object):
+    '''summarizes the readings of a collector, *rates* is True if the
+    deltas are summarized as rates'''
+
+    def __init__(self, rates, percentiles=PERCENTILES):
+        self.rates = rates
+        self.percentiles = percentiles
+        self.reset(None)
+
+    def reset(self, start):
+        '''start a new window at monotonic time *start*'''
+        self.start = start
+        self.samples = 0
+        self.metrics = {}
+        self.order = []
+
+    def _metric(self, path):
+        '''return the summary of the number at *path*'''
+        metric = self.metrics.get(path)
+
+        if metric is None:
+            metric = self.metrics[path] = MetricSummary(self.percentiles)
+            self.order.append(path)
+
+        return metric
+
+    def add(self, clock, data, delta, elapsed):
+        '''add a reading taken at monotonic time *clock* with its *delta*
+        over *elapsed* seconds (None for the first reading)'''
+        if self.start is None:
+            self.start = clock
+
+        self.samples += 1
+
+        if self.rates:
+            if delta is None or not elapsed:
+                return
+
+            for path, value in stream.flatten(delta):
+                if _is_number(value):
+                    self._metric(path).add(value / elapsed, value, elapsed)
+        else:
+            for path, value in stream.flatten(data):
+                if _is_number(value):
+                    self._metric(path).add(value, value, 1)
+
+    def elapsed(self, clock):
+        '''return the seconds since the start of the window'''
+        return 0.0 if self.start is None else clock - self.start
+
+    def summary(self, clock):
+        '''return the summary of the window that ends at *clock*'''
+        return {
+            "window": self.elapsed(clock),
+            "samples": self.samples,
+            "rates": self.rates,
+            "stats": stream.unflatten([(path, self.metrics[path].to_dict())
+                for path in sorted(self.order)])
+        }
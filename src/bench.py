@@ -0,0 +1,933 @@
+'''benchmarks for the collectors, delta calculators, encoders and transports
+
+the procfs, snapshot, procs, cgroups and fs collectors read a synthetic /proc,
+cgroup tree and mount table written to a temporary directory with the size of
+a large host (see SIZES), the psutil collectors read the real host, the
+encoders and delta calculators use the readings of the synthetic host and
+the transports are checked against stand-in mqtt and http servers on
+localhost
+
+the synthetic /proc is made of regular files that are read in one go, the
+seq_file files of the real /proc come about a page per read, so the procfs
+collectors and the reads of REAL_PROC_FILES are measured on the real /proc
+too, after checking that the reads get the whole files
+
+each benchmark is called in a loop until it takes MIN_TIME seconds and that
+is repeated REPEAT times, the results are written as json with the seconds
+per call of each repeat so runs can be compared with --compare'''
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import platform
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from timeit import default_timer
+from optparse import OptionParser
+
+import procfs
+import procs
+import cgroups
+import mounts
+import sistats
+import snapshot
+import stream
+import wire
+
+# version of the results format
+FORMAT = 1
+
+# size of the synthetic host
+SIZES = {
+    "cpus": 256,
+    "interfaces": 2000,
+    "disks": 500,
+    "mounts": 2000,
+    "processes": 5000,
+    "cgroups": 1000
+}
+
+# size of the synthetic host with --quick
+QUICK_SIZES = {
+    "cpus": 8,
+    "interfaces": 4,
+    "disks": 4,
+    "mounts": 10,
+    "processes": 100,
+    "cgroups": 10
+}
+
+# seconds each repeat takes at least and repeats of each benchmark
+MIN_TIME = 0.2
+REPEAT = 5
+
+# a benchmark is reported as a regression when its median is this many
+# times the one of the baseline
+THRESHOLD = 1.25
+
+# seconds to wait for the stand-in servers to get the messages of a check
+DELIVERY_TIMEOUT = 10.0
+
+# files of the real /proc read and checked for short reads, smaps takes
+# several pages on any host
+REAL_PROC_FILES = ("stat", "meminfo", "net/dev", "diskstats",
+        "self/mountinfo", "self/smaps")
+
+MEMINFO = '''MemTotal:       %(total)d kB
+MemFree:        %(free)d kB
+MemAvailable:   %(free)d kB
+Buffers:          204800 kB
+Cached:          8388608 kB
+SwapCached:            0 kB
+SwapTotal:       8388608 kB
+SwapFree:        8388608 kB
+'''
+
+# /proc/net/dev starts with two header lines
+NET_HEADER = '''Inter-|   Receive    |  Transmit
+ face |bytes    packets|bytes    packets
+'''
+
+# functions that turn the readings into snapshots for the snapshot deltas
+SNAPSHOTS = {
+    "cpu": snapshot.cpu_snapshot,
+    "mem": snapshot.mem_snapshot,
+    "net": lambda stats: snapshot.device_snapshot("net",
+        snapshot.NET_FIELDS, stats),
+    "disk": lambda stats: snapshot.device_snapshot("disk",
+        snapshot.DISK_FIELDS, stats)
+}
+
+class Fixture(object):
+    '''a synthetic /proc, cgroup v2 tree and mount table of a host with
+    *sizes* (see SIZES) under *root*, write(tick) makes the counters grow
+    with *tick*'''
+
+    def __init__(self, root, sizes):
+        self.root = root
+        self.sizes = sizes
+        self.proc = os.path.join(root, "proc")
+        self.cgroup = os.path.join(root, "cgroup")
+        self.mnt = os.path.join(root, "mnt")
+        self.mountinfo = os.path.join(self.proc, "self", "mountinfo")
+
+    def _write(self, path, content):
+        '''write *content* to *path* creating the directories'''
+        directory = os.path.dirname(path)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(path, "w") as handle:
+            handle.write(content)
+
+    def write(self, tick=0):
+        '''write the files with the counters of *tick*'''
+        step = tick + 1
+        sizes = self.sizes
+
+        lines = ["cpu  %d 10 %d %d 0 0 0 0 0 0" % (1000 * step *
+            sizes["cpus"], 500 * step * sizes["cpus"], 8000 * step *
+            sizes["cpus"])]
+        lines.extend(["cpu%d %d 10 %d %d 0 0 0 0 0 0" % (i, 1000 * step + i,
+            500 * step, 8000 * step) for i in xrange(sizes["cpus"])])
+        lines.append("intr 0\nctxt %d\nbtime 1500000000" % (1000 * step))
+        self._write(os.path.join(self.proc, "stat"), "\n".join(lines) + "\n")
+
+        self._write(os.path.join(self.proc, "meminfo"), MEMINFO % {
+            "total": 512 * 1024 * 1024, "free": 256 * 1024 * 1024 - step})
+
+        self._write(os.path.join(self.proc, "net", "dev"), NET_HEADER +
+            "".join(["%6s: %d %d 0 0 0 0 0 0 %d %d 0 0 0 0 0 0\n" % (
+                "eth%d" % i, 1500 * step * (i + 1), step * (i + 1),
+                900 * step * (i + 1), step * (i + 1))
+                for i in xrange(sizes["interfaces"])]))
+
+        self._write(os.path.join(self.proc, "diskstats"),
+            "".join(["%4d %7d sd%d %d 0 %d %d %d 0 %d %d 0 %d %d\n" % (8, i,
+                i, 100 * step, 800 * step, 40 * step, 50 * step, 400 * step,
+                30 * step, 60 * step, 70 * step)
+                for i in xrange(sizes["disks"])]))
+
+        if tick == 0:
+            self._write_static()
+
+        for pid in xrange(1, sizes["processes"] + 1):
+            self._write(os.path.join(self.proc, str(pid), "stat"),
+                "%d (worker %d) S 1 %d %d 0 -1 4194560 100 0 0 0 %d %d 0 0 "
+                "20 0 1 0 %d 1000000 %d 18446744073709551615 0 0 0 0 0 0 0 "
+                "0 0 0 0 0 17 0 0 0 0 0 0\n" % (pid, pid, pid, pid,
+                    step * (pid % 997), step * (pid % 89), pid,
+                    100 + pid % 5000))
+            self._write(os.path.join(self.proc, str(pid), "io"),
+                "rchar: 0\nwchar: 0\nsyscr: 0\nsyscw: 0\nread_bytes: %d\n"
+                "write_bytes: %d\ncancelled_write_bytes: 0\n" % (
+                    step * pid * 4096, step * (pid % 13) * 4096))
+
+        for path in self.cgroup_paths():
+            self._write(os.path.join(path, "cpu.stat"),
+                "usage_usec %d\nuser_usec %d\nsystem_usec %d\n"
+                "nr_periods 0\nnr_throttled 0\nthrottled_usec 0\n" % (
+                    3000 * step, 2000 * step, 1000 * step))
+            self._write(os.path.join(path, "memory.stat"),
+                "".join(["%s %d\n" % (field, 4096 * step) for field in
+                    cgroups.MEMORY_STAT + ("active_anon", "inactive_anon",
+                        "active_file", "inactive_file", "unevictable")]))
+            self._write(os.path.join(path, "memory.current"),
+                "%d\n" % (1048576 * step))
+            self._write(os.path.join(path, "io.stat"),
+                "8:0 rbytes=%d wbytes=%d rios=%d wios=%d dbytes=0 dios=0\n" %
+                (4096 * step, 8192 * step, step, 2 * step))
+
+    def cgroup_paths(self):
+        '''return the paths of the cgroups, the root, a slice and the
+        cgroups in it'''
+        slice_path = os.path.join(self.cgroup, "bench.slice")
+
+        return [self.cgroup, slice_path] + [os.path.join(slice_path,
+            "unit-%d.scope" % i) for i in xrange(self.sizes["cgroups"])]
+
+    def _write_static(self):
+        '''write the files that don't change with the ticks'''
+        sizes = self.sizes
+        lines = []
+
+        for i in xrange(sizes["mounts"]):
+            mountpoint = os.path.join(self.mnt, "m%d" % i)
+
+            if not os.path.isdir(mountpoint):
+                os.makedirs(mountpoint)
+
+            lines.append("%d 1 8:%d / %s rw,relatime shared:1 - ext4 "
+                "/dev/sd%d rw" % (100 + i, i, mountpoint, i))
+
+        self._write(self.mountinfo, "\n".join(lines) + "\n")
+
+        for pid in xrange(1, sizes["processes"] + 1):
+            self._write(os.path.join(self.proc, str(pid), "cmdline"),
+                "/usr/bin/worker\0--id\0%d\0" % pid)
+
+        paths = self.cgroup_paths()
+
+        for path in paths:
+            self._write(os.path.join(path, "cgroup.controllers"),
+                "cpu io memory\n")
+            descendants = len(paths) - 1 if path == self.cgroup else \
+                    len(paths) - 2 if path == paths[1] else 0
+            self._write(os.path.join(path, "cgroup.stat"),
+                "nr_descendants %d\nnr_dying_descendants 0\n" % descendants)
+
+    def remove(self):
+        '''remove the files'''
+        shutil.rmtree(self.root, ignore_errors=True)
+
+class StubBrokerHandler(SocketServer.BaseRequestHandler):
+    '''the mqtt 3.1 packets a client needs: connect, publish with qos 0 to
+    2, subscribe and ping, messages are counted and dropped'''
+
+    def _read(self, size):
+        '''return *size* bytes, None if the client went away'''
+        chunks = []
+
+        while size:
+            chunk = self.request.recv(size)
+
+            if not chunk:
+                return None
+
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        return "".join(chunks)
+
+    def _packet(self):
+        '''return the (type, flags, body) of the next packet'''
+        header = self._read(1)
+
+        if header is None:
+            return None
+
+        length = 0
+        shift = 0
+
+        while True:
+            byte = self._read(1)
+
+            if byte is None:
+                return None
+
+            length |= (ord(byte) & 0x7f) << shift
+            shift += 7
+
+            if not ord(byte) & 0x80:
+                break
+
+        body = self._read(length) if length else ""
+
+        if body is None:
+            return None
+
+        return ord(header) >> 4, ord(header) & 0x0f, body
+
+    def handle(self):
+        while True:
+            packet = self._packet()
+
+            if packet is None:
+                return
+
+            packet_type, flags, body = packet
+
+            if packet_type == 1:
+                # connect -> connack accepted
+                self.request.sendall("\x20\x02\x00\x00")
+            elif packet_type == 3:
+                qos = (flags >> 1) & 3
+                topic_size, = struct.unpack_from("!H", body)
+                offset = 2 + topic_size
+
+                if qos:
+                    mid = body[offset:offset + 2]
+                    offset += 2
+                    # puback or pubrec
+                    self.request.sendall(("\x40\x02" if qos == 1 else
+                        "\x50\x02") + mid)
+
+                self.server.received(len(body) - offset)
+            elif packet_type == 6:
+                # pubrel -> pubcomp
+                self.request.sendall("\x70\x02" + body[:2])
+            elif packet_type == 8:
+                # subscribe -> suback granting the qos asked for
+                offset = 2
+                granted = []
+
+                while offset < len(body):
+                    topic_size, = struct.unpack_from("!H", body, offset)
+                    offset += 2 + topic_size
+                    granted.append(body[offset])
+                    offset += 1
+
+                self.request.sendall("\x90" + chr(2 + len(granted)) +
+                        body[:2] + "".join(granted))
+            elif packet_type == 12:
+                self.request.sendall("\xd0\x00")
+            elif packet_type == 14:
+                return
+
+class Counter(object):
+    '''counts the messages and bytes a stand-in server got, wait blocks
+    until there are some'''
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.messages = 0
+        self.bytes = 0
+
+    def received(self, size):
+        '''count a message of *size* bytes'''
+        with self.lock:
+            self.messages += 1
+            self.bytes += size
+            self.lock.notify_all()
+
+    def wait(self, messages, timeout=DELIVERY_TIMEOUT):
+        '''wait until *messages* were received, return False if that took
+        longer than *timeout* seconds'''
+        deadline = time.time() + timeout
+
+        with self.lock:
+            while self.messages < messages:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    return False
+
+                self.lock.wait(remaining)
+
+        return True
+
+class StubBroker(SocketServer.ThreadingMixIn, SocketServer.TCPServer,
+        Counter):
+    '''a stand-in mqtt broker on a free port of localhost'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0),
+                StubBrokerHandler)
+        Counter.__init__(self)
+        self.port = self.server_address[1]
+
+class StubHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''accepts any POST'''
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        size = int(self.headers.getheader("content-length", 0))
+        self.rfile.read(size)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("{}")
+
+        if self.path != "/api/session":
+            self.server.received(size)
+
+    def log_message(self, *args):
+        pass
+
+class StubHttpServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer, Counter):
+    '''a stand-in for the rest api on a free port of localhost'''
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                StubHttpHandler)
+        Counter.__init__(self)
+        self.port = self.server_address[1]
+
+def serve(server):
+    '''serve *server* on a daemon thread'''
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def measure(function, min_time=MIN_TIME, repeat=REPEAT):
+    '''return (calls per repeat, seconds per call of each repeat)'''
+    number = 1
+
+    while True:
+        start = default_timer()
+
+        for _ in xrange(number):
+            function()
+
+        elapsed = default_timer() - start
+
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+
+        number *= 2 if elapsed < min_time / 4 else 1 + int(min_time / elapsed)
+
+    # the calls to find number warm up caches and are not counted
+    times = []
+
+    for _ in xrange(repeat):
+        start = default_timer()
+
+        for _ in xrange(number):
+            function()
+
+        times.append((default_timer() - start) / number)
+
+    return number, times
+
+def summarize(number, times):
+    '''return the result entry for the seconds per call *times*'''
+    ordered = sorted(times)
+    size = len(ordered)
+    median = (ordered[size // 2] + ordered[(size - 1) // 2]) / 2.0
+
+    return {
+        "number": number,
+        "times": times,
+        "best": ordered[0],
+        "median": median,
+        "mean": sum(times) / size
+    }
+
+class Suite(object):
+    '''the benchmarks, *pattern* selects them by name'''
+
+    def __init__(self, fixture, pattern=None, min_time=MIN_TIME,
+            repeat=REPEAT, verbose=True):
+        self.fixture = fixture
+        self.pattern = re.compile(pattern) if pattern else None
+        self.min_time = min_time
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+        self.skipped = {}
+
+    def selected(self, name):
+        '''return True if benchmark *name* runs'''
+        return self.pattern is None or self.pattern.search(name) is not None
+
+    def run(self, name, function):
+        '''run benchmark *name*'''
+        if not self.selected(name):
+            return
+
+        try:
+            number, times = measure(function, self.min_time, self.repeat)
+        except Exception as error:
+            self.skip(name, "%s: %s" % (type(error).__name__, error))
+            return
+
+        result = self.results[name] = summarize(number, times)
+
+        if self.verbose:
+            print "%-32s %12.3f us %12.3f us %10d" % (name,
+                    result["median"] * 1e6, result["best"] * 1e6, number)
+
+    def skip(self, name, reason):
+        '''record that benchmark *name* couldn't run'''
+        self.skipped[name] = reason
+
+        if self.verbose:
+            print "%-32s skipped (%s)" % (name, reason)
+
+    def readings(self):
+        '''return a dict from collector name to two readings of the
+        synthetic host, one for each tick'''
+        fixture = self.fixture
+        readings = {}
+
+        for tick in (0, 1):
+            fixture.write(tick)
+            reader = procfs.ProcReader(fixture.proc)
+            fs_collector = mounts.FsCollector(
+                    mounts.MountTable(fixture.mountinfo))
+            cgroup_collector = cgroups.CgroupCollector(fixture.cgroup)
+
+            values = {
+                "cpu": procfs.get_cpu_stats(reader),
+                "mem": procfs.get_mem_stats(reader),
+                "net": procfs.get_net_stats(reader),
+                "disk": procfs.get_disk_stats(reader),
+                "fs": fs_collector.get_stats(),
+                "procs": procs.ProcessTable(fixture.proc).get_stats(),
+                "cgroups": cgroup_collector.get_stats()
+            }
+            reader.close()
+            cgroup_collector.close()
+
+            for name, value in values.items():
+                readings.setdefault(name, []).append(value)
+
+        return readings
+
+    def collectors(self):
+        '''the collectors on the synthetic host and the psutil ones on this
+        host'''
+        fixture = self.fixture
+        reader = procfs.ProcReader(fixture.proc)
+
+        for name, (source, parse) in sorted(procfs.SOURCES.items()):
+            self.run("collect.procfs." + name,
+                    lambda source=source, parse=parse:
+                        parse(reader.read(source)))
+
+        for name in ("cpu", "mem", "net", "disk"):
+            parse = getattr(snapshot, "parse_%s_snapshot" % name)
+            source = procfs.SOURCES[name][0]
+            self.run("collect.snapshot." + name,
+                    lambda source=source, parse=parse:
+                        parse(reader.read(source)))
+
+        self.run("collect.procs", procs.ProcessTable(fixture.proc).get_stats)
+        # the files stay open, closed so the servers can select on theirs
+        cgroup_collector = cgroups.CgroupCollector(fixture.cgroup)
+        self.run("collect.cgroups", cgroup_collector.get_stats)
+        cgroup_collector.close()
+        self.run("collect.fs", mounts.FsCollector(
+            mounts.MountTable(fixture.mountinfo)).get_stats)
+
+        for name in ("cpu", "mem", "net", "disk", "fs"):
+            self.run("collect.psutil." + name,
+                    getattr(sistats, "get_%s_stats" % name))
+
+        reader.close()
+
+    def proc(self):
+        '''the reads of REAL_PROC_FILES and the procfs collectors on the
+        real /proc, a read is skipped if it doesn't get the whole file'''
+        names = ["read.proc." + path for path in REAL_PROC_FILES] + \
+                ["collect.proc." + name for name in sorted(procfs.SOURCES)]
+
+        if not os.path.isdir(os.path.join(procfs.PROC, "self")):
+            for name in names:
+                if self.selected(name):
+                    self.skip(name, "no %s" % procfs.PROC)
+
+            return
+
+        reader = procfs.ProcReader()
+
+        for path in REAL_PROC_FILES:
+            name = "read.proc." + path
+
+            if not self.selected(name):
+                continue
+
+            try:
+                check_read(reader, path)
+            except (IOError, OSError, RuntimeError) as error:
+                self.skip(name, str(error))
+                continue
+
+            self.run(name, lambda path=path: reader.read(path))
+
+        for name, (source, parse) in sorted(procfs.SOURCES.items()):
+            self.run("collect.proc." + name,
+                    lambda source=source, parse=parse:
+                        parse(reader.read(source)))
+
+        reader.close()
+
+    def deltas(self, readings):
+        '''the delta calculators on the readings of the synthetic host'''
+        for name, (_function, delta) in sorted(sistats.COLLECTORS.items()):
+            old, new = readings[name]
+            self.run("delta." + name, lambda old=old, new=new, delta=delta:
+                    delta(old, new))
+
+        for name in ("cpu", "mem", "net", "disk"):
+            old, new = [SNAPSHOTS[name](reading)
+                    for reading in readings[name]]
+            delta = snapshot.COLLECTORS[name][2]
+            self.run("delta.snapshot." + name,
+                    lambda old=old, new=new, delta=delta: delta(old, new))
+
+    def encoders(self, readings):
+        '''bson, json, stream and wire on the readings of the synthetic
+        host'''
+        try:
+            import bson
+        except ImportError as error:
+            bson = None
+            reason = str(error)
+
+        try:
+            import rest_transport
+        except ImportError as error:
+            rest_transport = None
+            json_reason = str(error)
+
+        for name, (first, second) in sorted(readings.items()):
+            if bson is None:
+                self.skip("encode.bson." + name, reason)
+            else:
+                payload = bson.BSON.encode(first)
+                self.run("encode.bson." + name, lambda first=first:
+                        bson.BSON.encode(first))
+                self.run("decode.bson." + name, lambda payload=payload:
+                        bson.BSON(payload).decode())
+
+            if rest_transport is None:
+                self.skip("encode.json." + name, json_reason)
+            else:
+                event = rest_transport.Event(first, "bench." + name,
+                        time.time())
+                payload = json.dumps(event.to_json())
+                self.run("encode.json." + name, lambda event=event:
+                        json.dumps(event.to_json()))
+                self.run("decode.json." + name, lambda payload=payload:
+                        json.loads(payload))
+
+            frames = _alternate(stream.StreamEncoder(1 << 30).encode,
+                    first, second)
+            keyframe = stream.StreamEncoder().encode(first)
+            self.run("encode.stream." + name, frames)
+            self.run("decode.stream." + name, lambda keyframe=keyframe:
+                    stream.StreamDecoder().decode(keyframe))
+
+            encoder = wire.WireEncoder(1 << 30)
+            decoder = wire.WireDecoder()
+            decoder.decode(encoder.encode(first))
+            frame = encoder.encode(first)
+            self.run("encode.wire." + name, _alternate(encoder.encode,
+                first, second))
+            self.run("decode.wire." + name, lambda frame=frame,
+                    decoder=decoder: decoder.decode(frame))
+
+    def transports(self):
+        '''Checker.check of the mqtt and rest transports and of the relay
+        against the stand-in servers'''
+        fixture = self.fixture
+        reader = procfs.ProcReader(fixture.proc)
+        collectors = [(name, lambda parse=parse, source=source:
+            parse(reader.read(source)), sistats.COLLECTORS[name][1])
+            for name, (source, parse) in sorted(procfs.SOURCES.items())]
+
+        if self.selected("check.mqtt"):
+            try:
+                import mqtt_transport
+            except ImportError as error:
+                self.skip("check.mqtt", str(error))
+            else:
+                broker = serve(StubBroker())
+                checker = mqtt_transport.Checker("bench", port=broker.port)
+                self._check("check.mqtt", checker, collectors, broker)
+                broker.shutdown()
+
+        if self.selected("check.rest"):
+            try:
+                import rest_transport
+            except ImportError as error:
+                self.skip("check.rest", str(error))
+            else:
+                server = serve(StubHttpServer())
+                endpoint = lambda path: rest_transport.EndPoint("127.0.0.1",
+                        server.port, path)
+                checker = rest_transport.Checker("bench", "bench", "bench",
+                        endpoint("/api/session"), endpoint("/api/event"))
+                checker.login()
+                self._check("check.rest", checker, collectors, server)
+                server.shutdown()
+
+        if self.selected("check.relay"):
+            try:
+                import relay
+            except ImportError as error:
+                self.skip("check.relay", str(error))
+            else:
+                self._relay(collectors)
+
+        reader.close()
+
+    def _relay(self, collectors):
+        '''Checker.check of a bulk rest agent sending to a relay that
+        forwards the events to the stand-in http server'''
+        import relay
+        import rest_transport
+
+        server = serve(StubHttpServer())
+        endpoint = lambda port, path: rest_transport.EndPoint("127.0.0.1",
+                port, path)
+        # one upstream batch per check once there are deltas, the first
+        # check leaves a partial batch behind
+        forwarder = relay.Relay("bench", "bench", "bench",
+                endpoint(server.port, "/api/session"),
+                endpoint(server.port, "/api/event"), listen=("127.0.0.1", 0),
+                batch_size=2 * len(collectors), linger=3600, compress=True)
+        checker = rest_transport.Checker("bench", "bench", "bench",
+                endpoint(forwarder.port, "/api/session"),
+                endpoint(forwarder.port, "/api/event"), bulk=True,
+                compress=True)
+        checker.collectors = collectors
+        checker.check()
+
+        try:
+            self._check("check.relay", checker, collectors, server, 1, 1)
+        finally:
+            forwarder.on_exit()
+            server.shutdown()
+
+    def _check(self, name, checker, collectors, server, first=None,
+            messages=None):
+        '''run check of *checker* with *collectors* until *server* got the
+        messages of each check, *first* is the number of messages the first
+        check sends and *messages* the number the next ones send, by default
+        one per collector and two (stats and delta) per collector'''
+        checker.collectors = collectors
+
+        if first is None:
+            first = len(collectors)
+
+        if messages is None:
+            messages = 2 * len(collectors)
+
+        try:
+            # the first check has no deltas, the second gives the messages
+            # sent on each check
+            checker.check()
+            if not server.wait(first):
+                self.skip(name, "nothing delivered to the stand-in server")
+                return
+
+            before = server.messages
+            checker.check()
+            server.wait(before + messages)
+            per_check = server.messages - before
+            state = {"expected": server.messages}
+
+            def check():
+                '''check and wait for the messages'''
+                state["expected"] += per_check
+                checker.check()
+
+                if not server.wait(state["expected"]):
+                    raise RuntimeError("messages not delivered")
+
+            self.run(name, check)
+        finally:
+            checker.on_exit()
+
+    def run_all(self):
+        '''run the benchmarks'''
+        self.collectors()
+        self.proc()
+        readings = self.readings()
+        self.deltas(readings)
+        self.encoders(readings)
+        self.transports()
+
+        return {
+            "format": FORMAT,
+            "meta": {
+                "time": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "host": socket.gethostname(),
+                "sizes": self.fixture.sizes,
+                "min_time": self.min_time,
+                "repeat": self.repeat
+            },
+            "results": self.results,
+            "skipped": self.skipped
+        }
+
+def check_read(reader, path):
+    '''raise RuntimeError if reading *path* with procfs *reader* doesn't get
+    as many lines as reading it to the end with a python file'''
+    content = reader.read(path)
+
+    with open(reader.path(path)) as handle:
+        expected = handle.read()
+
+    if content.count("\n") != expected.count("\n"):
+        raise RuntimeError("short read: %d of %d bytes" % (len(content),
+            len(expected)))
+
+def _alternate(function, first, second):
+    '''return a function that calls *function* with *first* and *second*
+    alternately'''
+    state = [first, second]
+
+    def call():
+        '''call function with the next argument'''
+        state.reverse()
+        return function(state[0])
+
+    return call
+
+def compare(baseline, results, threshold=THRESHOLD):
+    '''return a list of (name, baseline median, median, ratio, status) for
+    the benchmarks in both results, status is "slower", "faster" or ""'''
+    rows = []
+
+    for name in sorted(results["results"]):
+        if name not in baseline["results"]:
+            continue
+
+        old = baseline["results"][name]["median"]
+        new = results["results"][name]["median"]
+        ratio = new / old if old else float("inf")
+
+        if ratio >= threshold:
+            status = "slower"
+        elif ratio <= 1 / threshold:
+            status = "faster"
+        else:
+            status = ""
+
+        rows.append((name, old, new, ratio, status))
+
+    return rows
+
+def print_comparison(rows):
+    '''print the output of compare, return the number of regressions'''
+    print "%-32s %12s %12s %7s" % ("benchmark", "baseline us", "current us",
+            "ratio")
+
+    for name, old, new, ratio, status in rows:
+        print "%-32s %12.3f %12.3f %7.2f %s" % (name, old * 1e6, new * 1e6,
+                ratio, status)
+
+    return len([row for row in rows if row[4] == "slower"])
+
+def load(path):
+    '''return the results stored at *path*'''
+    with open(path) as handle:
+        results = json.load(handle)
+
+    if results.get("format") != FORMAT:
+        raise ValueError("%s: unsupported results format" % path)
+
+    return results
+
+def main():
+    '''run the benchmarks and/or compare results'''
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--output", dest="output", default=None,
+        help="write the results as json to FILE", metavar="FILE")
+    parser.add_option("-c", "--compare", dest="compare", default=None,
+        help="compare the results with the ones in FILE, exits with status "
+        "1 if any benchmark is slower", metavar="FILE")
+    parser.add_option("-i", "--input", dest="input", default=None,
+        help="compare the results in FILE instead of running the "
+        "benchmarks", metavar="FILE")
+    parser.add_option("-k", "--filter", dest="pattern", default=None,
+        help="only run the benchmarks whose name matches REGEX",
+        metavar="REGEX")
+    parser.add_option("-q", "--quick", action="store_true", dest="quick",
+        default=False, help="use a small synthetic host")
+    parser.add_option("-s", "--size", dest="sizes", default="",
+        help="size of the synthetic host, like cpus=64,interfaces=100 (%s)"
+        % ", ".join(sorted(SIZES)), metavar="SIZES")
+    parser.add_option("-r", "--repeat", dest="repeat", default=REPEAT,
+        type="int", help="repeat each benchmark COUNT times",
+        metavar="COUNT")
+    parser.add_option("-m", "--mintime", dest="min_time", default=MIN_TIME,
+        type="float", help="run each repeat for at least SEC seconds",
+        metavar="SEC")
+    parser.add_option("-t", "--threshold", dest="threshold",
+        default=THRESHOLD, type="float", help="with --compare, a benchmark "
+        "is slower when its median is RATIO times the baseline",
+        metavar="RATIO")
+    opts, _args = parser.parse_args()
+
+    if opts.input is not None:
+        if opts.compare is None:
+            parser.error("--input needs --compare")
+
+        results = load(opts.input)
+    else:
+        sizes = dict(QUICK_SIZES if opts.quick else SIZES)
+
+        for item in filter(None, opts.sizes.split(",")):
+            name, _sep, value = item.partition("=")
+
+            if name not in sizes:
+                parser.error("unknown size %s" % name)
+
+            sizes[name] = int(value)
+
+        fixture = Fixture(tempfile.mkdtemp(prefix="sistats-bench-"), sizes)
+
+        try:
+            fixture.write()
+            print "%-32s %15s %15s %10s" % ("benchmark", "median", "best",
+                    "calls")
+            results = Suite(fixture, opts.pattern, opts.min_time,
+                    opts.repeat).run_all()
+        finally:
+            fixture.remove()
+
+        if opts.output is not None:
+            with open(opts.output, "w") as handle:
+                json.dump(results, handle, indent=1, sort_keys=True)
+
+    if opts.compare is not None:
+        print
+        if print_comparison(compare(load(opts.compare), results,
+                opts.threshold)):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+'''per cgroup stats from the cgroup v2 hierarchy on linux
+
+each cgroup reports cpu.stat, memory.current, some of memory.stat and the
+io.stat totals of all its devices as a flat dict, the files are kept open
+between checks (see procfs.ProcFile) up to *max_files*, the rest are opened
+on each read
+
+the tree is not listed on every check, cgroup.stat of each cgroup has the
+number of cgroups below it (nr_descendants), a cgroup is only listed again
+when that number changed or when one of the cgroups below it went away
+(reading its open files fails), so a check on a tree where nothing was
+created or removed reads the root cgroup.stat only besides the stats'''
+import os
+import errno
+
+import procfs
+
+ROOT = "/sys/fs/cgroup"
+
+# fields of memory.stat that are reported
+MEMORY_STAT = ("anon", "file", "kernel_stack", "slab", "sock", "shmem",
+        "file_mapped", "file_dirty", "file_writeback", "pgfault",
+        "pgmajfault")
+
+# fields of io.stat that are summed for all the devices
+IO_STAT = ("rbytes", "wbytes", "rios", "wios")
+
+# files kept open at most, a cgroup uses up to 5
+try:
+    import resource
+    MAX_FILES = min(4096,
+            resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2)
+except ImportError:
+    MAX_FILES = 256
+
+# errors reading the files of a cgroup that was removed
+GONE = (errno.ENOENT, errno.ENODEV)
+
+class PathFile(object):
+    '''a file that is opened on each read, used once MAX_FILES are open'''
+
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.exists(path):
+            raise OSError(errno.ENOENT, "no such file", path)
+
+    def read(self):
+        '''return the current content of the file'''
+        fd = os.open(self.path, os.O_RDONLY)
+
+        try:
+            return procfs.read_fd(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        '''nothing to close'''
+        pass
+
+def parse_keyed(content):
+    '''return a dict from the "key value" lines of *content*'''
+    values = {}
+
+    for line in content.splitlines():
+        key, _sep, value = line.partition(" ")
+
+        if value:
+            values[key] = int(value)
+
+    return values
+
+def parse_cpu_stat(content, stats):
+    '''add the fields of cpu.stat to *stats*, times in seconds'''
+    values = parse_keyed(content)
+
+    for key, value in values.items():
+        if key.endswith("_usec"):
+            stats["cpu_" + key[:-5]] = value / 1000000.0
+        else:
+            stats["cpu_" + key] = value
+
+def parse_memory_stat(content, stats, fields=MEMORY_STAT):
+    '''add *fields* of memory.stat to *stats*'''
+    values = parse_keyed(content)
+
+    for field in fields:
+        if field in values:
+            stats["mem_" + field] = values[field]
+
+def parse_io_stat(content, stats, fields=IO_STAT):
+    '''add the totals of *fields* of all the devices in io.stat to
+    *stats*'''
+    totals = dict.fromkeys(fields, 0)
+
+    for line in content.splitlines():
+        for item in line.split()[1:]:
+            key, _sep, value = item.partition("=")
+
+            if key in totals:
+                totals[key] += int(value)
+
+    for field in fields:
+        stats["io_" + field] = totals[field]
+
+class Cgroup(object):
+    '''the open files of a cgroup'''
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.descendants = None
+        # child directory name -> Cgroup
+        self.children = {}
+        # file name -> ProcFile or PathFile
+        self.files = {}
+
+    def close(self):
+        '''close the files of the cgroup and its children'''
+        for child in self.children.values():
+            child.close()
+
+        for cgroup_file in self.files.values():
+            cgroup_file.close()
+
+        self.files = {}
+        self.children = {}
+
+class CgroupCollector(object):
+    '''collects the stats of the cgroups under *root*'''
+
+    FILES = ("cgroup.stat", "cpu.stat", "memory.current", "memory.stat",
+            "io.stat")
+
+    def __init__(self, root=ROOT, max_files=MAX_FILES,
+            memory_fields=MEMORY_STAT):
+        self.root = root
+        self.max_files = max_files
+        self.memory_fields = memory_fields
+        self.open_files = 0
+        self.tree = None
+        # paths of the cgroups whose parent has to be listed again
+        self.dirty = set()
+        self.scans = 0
+
+    def available(self):
+        '''return True if *root* is a cgroup v2 hierarchy'''
+        return os.path.exists(os.path.join(self.root,
+            "cgroup.controllers"))
+
+    def _open(self, cgroup):
+        '''open the files of *cgroup*, the missing ones are skipped'''
+        for name in self.FILES:
+            path = os.path.join(cgroup.path, name)
+
+            try:
+                if self.open_files < self.max_files:
+                    cgroup.files[name] = procfs.ProcFile(path)
+                    self.open_files += 1
+                else:
+                    cgroup.files[name] = PathFile(path)
+            except OSError:
+                pass
+
+    def _add(self, name, path):
+        '''return a new Cgroup with its files open'''
+        cgroup = Cgroup(name, path)
+        self._open(cgroup)
+        return cgroup
+
+    def _remove(self, cgroup):
+        '''close *cgroup* and the ones below it'''
+        for child in cgroup.children.values():
+            self._remove(child)
+
+        self.open_files -= len([cgroup_file for cgroup_file in
+            cgroup.files.values() if isinstance(cgroup_file,
+                procfs.ProcFile)])
+        cgroup.close()
+
+    def _descendants(self, cgroup):
+        '''return nr_descendants of *cgroup*, None if it's gone'''
+        cgroup_file = cgroup.files.get("cgroup.stat")
+
+        if cgroup_file is None:
+            return None
+
+        try:
+            return parse_keyed(cgroup_file.read()).get("nr_descendants")
+        except (OSError, IOError):
+            return None
+
+    def _is_dirty(self, cgroup):
+        '''return True if a cgroup that went away is below *cgroup*'''
+        prefix = cgroup.path + os.sep
+
+        for path in self.dirty:
+            if path.startswith(prefix):
+                return True
+
+        return False
+
+    def _refresh(self, cgroup):
+        '''list *cgroup* again if cgroups were created or removed below it,
+        return False if it's gone'''
+        descendants = self._descendants(cgroup)
+
+        if descendants is None:
+            return False
+
+        if descendants == cgroup.descendants and not self._is_dirty(cgroup):
+            return True
+
+        cgroup.descendants = descendants
+
+        try:
+            names = set([name for name in os.listdir(cgroup.path)
+                if os.path.isdir(os.path.join(cgroup.path, name))])
+        except OSError:
+            return False
+
+        for name in set(cgroup.children) - names:
+            self._remove(cgroup.children.pop(name))
+
+        for name in names:
+            child = cgroup.children.get(name)
+
+            if child is None:
+                child = cgroup.children[name] = self._add(
+                        os.path.join(cgroup.name, name),
+                        os.path.join(cgroup.path, name))
+
+            if not self._refresh(child):
+                self._remove(cgroup.children.pop(name))
+
+        return True
+
+    def scan(self):
+        '''bring the tree up to date'''
+        self.scans += 1
+
+        if self.tree is None:
+            self.tree = self._add("/", self.root)
+
+        if not self._refresh(self.tree):
+            self._remove(self.tree)
+            self.tree = None
+
+        self.dirty = set()
+
+    def _read(self, cgroup, stats):
+        '''add the stats of *cgroup* and the ones below it to *stats*'''
+        values = {}
+        files = cgroup.files
+
+        try:
+            if "cpu.stat" in files:
+                parse_cpu_stat(files["cpu.stat"].read(), values)
+
+            if "memory.current" in files:
+                values["mem_current"] = int(files["memory.current"].read())
+
+            if "memory.stat" in files:
+                parse_memory_stat(files["memory.stat"].read(), values,
+                        self.memory_fields)
+
+            if "io.stat" in files:
+                parse_io_stat(files["io.stat"].read(), values)
+        except (OSError, IOError) as error:
+            if error.errno not in GONE:
+                raise
+
+            # removed since the last scan, listed again on the next one
+            self.dirty.add(cgroup.path)
+            return
+
+        stats[cgroup.name] = values
+
+        for child in cgroup.children.values():
+            self._read(child, stats)
+
+    def get_stats(self):
+        '''return a dict from cgroup path ("/" for the root) to its stats'''
+        self.scan()
+        stats = {}
+
+        if self.tree is not None:
+            self._read(self.tree, stats)
+
+        return stats
+
+    def close(self):
+        '''close all the open files'''
+        if self.tree is not None:
+            self._remove(self.tree)
+            self.tree = None
+
+def get_stats_delta(old, new):
+    '''return the delta between two readings from
+    CgroupCollector.get_stats for the cgroups in both'''
+    delta = {}
+
+    for name, values in new.items():
+        previous = old.get(name)
+
+        if previous is None:
+            continue
+
+        delta[name] = dict((key, value - previous[key])
+                for key, value in values.items() if key in previous)
+
+    return delta
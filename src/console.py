@@ -0,0 +1,341 @@
+'''live top style console view of the stats
+
+each check is rendered into one frame that fits the terminal and written
+with a single call, redrawing in place: a bar per cpu (one character per cpu
+when the bars don't fit), memory and swap, the interfaces and disks with the
+highest rates, the fullest file systems and, with --procs, the processes
+using more cpu'''
+import os
+import sys
+import time
+import struct
+
+import transport
+
+from optparse import OptionParser
+
+# used when the terminal size can't be read
+DEFAULT_SIZE = (80, 24)
+
+# one character per cpu from idle to busy when the bars don't fit
+HEAT = " .:-=+*#%@"
+
+# escape sequences to move to the top left, clear the rest of the line and
+# of the screen, hide and show the cursor and use the alternate screen
+HOME = "\x1b[H"
+CLEAR_LINE = "\x1b[K"
+CLEAR_SCREEN = "\x1b[J"
+HIDE_CURSOR = "\x1b[?25l"
+SHOW_CURSOR = "\x1b[?25h"
+ALT_SCREEN = "\x1b[?1049h"
+MAIN_SCREEN = "\x1b[?1049l"
+
+# width of the bar of each cpu
+CPU_BAR = 10
+
+UNITS = ("", "K", "M", "G", "T", "P")
+
+def terminal_size(stream=sys.stdout):
+    '''return the (columns, rows) of the terminal of *stream*'''
+    try:
+        import fcntl
+        import termios
+
+        rows, columns = struct.unpack("hh", fcntl.ioctl(stream.fileno(),
+            termios.TIOCGWINSZ, "\0" * 4))
+
+        if rows > 0 and columns > 0:
+            return columns, rows
+    except (ImportError, IOError, AttributeError, ValueError):
+        pass
+
+    try:
+        return int(os.environ["COLUMNS"]), int(os.environ["LINES"])
+    except (KeyError, ValueError):
+        return DEFAULT_SIZE
+
+def human(value):
+    '''return *value* (bytes) with a unit, like 1.5M'''
+    value = float(value)
+
+    for unit in UNITS:
+        if abs(value) < 1024 or unit == UNITS[-1]:
+            break
+
+        value /= 1024
+
+    if unit == "":
+        return "%d" % value
+
+    return "%.1f%s" % (value, unit)
+
+def bar(percent, width):
+    '''return a bar of *width* characters filled up to *percent*'''
+    filled = int(round(max(0.0, min(100.0, percent)) * width / 100.0))
+    return "[" + "|" * filled + " " * (width - filled) + "]"
+
+def cpu_percent(delta):
+    '''return the busy percent of a cpu delta'''
+    total = sum(delta.get(field, 0) for field in
+            ("kernel", "user", "idle", "nice"))
+
+    if total <= 0:
+        return 0.0
+
+    return 100.0 * (total - delta.get("idle", 0)) / total
+
+def cpu_lines(delta, columns, max_rows):
+    '''return the lines for the cpu *delta*, a bar per cpu if they fit in
+    *max_rows*, one character per cpu if they don't'''
+    total = cpu_percent(delta["global"])
+    lines = ["cpu  %s %5.1f%%" % (bar(total, max(10, columns - 14)),
+        total)]
+    percents = [cpu_percent(cpu) for cpu in delta["cpu"]]
+
+    if not percents or max_rows < 2:
+        return lines
+
+    label = len(str(len(percents) - 1))
+    cell = label + CPU_BAR + 10
+    per_row = max(1, columns // cell)
+    rows = (len(percents) + per_row - 1) // per_row
+
+    if rows <= max_rows - 1:
+        for start in xrange(0, len(percents), per_row):
+            lines.append("".join(["%*d %s %5.1f%% " % (label, index,
+                bar(percent, CPU_BAR), percent)
+                for index, percent in enumerate(percents[start:start +
+                    per_row], start)]))
+    else:
+        width = max(1, columns - 5)
+        lines.extend(["%3d  %s" % (start, "".join([HEAT[min(len(HEAT) - 1,
+            int(percent * len(HEAT) / 100.0))]
+            for percent in percents[start:start + width]]))
+            for start in xrange(0, len(percents), width)][:max_rows - 1])
+
+    return lines
+
+def mem_lines(data, columns):
+    '''return the lines for the mem reading *data*'''
+    lines = []
+
+    for name in ("mem", "swap"):
+        usage = data.get(name)
+
+        if usage:
+            lines.append("%-4s %s %5.1f%% %s/%s" % (name,
+                bar(usage["percent"], max(10, columns - 30)),
+                usage["percent"], human(usage["used"]),
+                human(usage["total"])))
+
+    return lines
+
+def rate_lines(title, header, delta, elapsed, fields, rows):
+    '''return at most *rows* lines with the devices of *delta* with the
+    highest rates of *fields*, sorted by the first two'''
+    if rows < 2:
+        return []
+
+    lines = [title + header]
+
+    if delta is None or not elapsed:
+        return lines + ["  (waiting for the next reading)"]
+
+    ranked = sorted(delta.items(), key=lambda item: -(item[1].get(fields[0],
+        0) + item[1].get(fields[1], 0)))
+
+    for name, values in ranked[:rows - 1]:
+        lines.append("%-16s" % name[:16] + "".join(["%10s" %
+            human(values.get(field, 0) / elapsed) for field in fields]))
+
+    return lines
+
+def fs_lines(data, rows):
+    '''return at most *rows* lines with the fullest file systems'''
+    if rows < 2:
+        return []
+
+    usage = []
+
+    for name, values in data.items():
+        size = values.get("size")
+
+        if size is not None and size > 0:
+            usage.append((100.0 * values["used"] / size, name, values))
+
+    lines = ["fs               %used      size      used  mount point"]
+
+    for percent, _name, values in sorted(usage, reverse=True)[:rows - 1]:
+        lines.append("%-16s %5.1f %9s %9s  %s" % (_name[:16], percent,
+            human(values["size"]), human(values["used"]),
+            values.get("mnt_point", "")))
+
+    return lines
+
+def proc_lines(data, delta, elapsed, rows):
+    '''return at most *rows* lines with the processes using more cpu'''
+    if rows < 2:
+        return []
+
+    lines = ["pid        cpu%       rss  name"]
+
+    if delta is None or not elapsed:
+        return lines + ["  (waiting for the next reading)"]
+
+    ranked = sorted(delta.items(), key=lambda item: -item[1]["cpu"])
+
+    for pid, values in ranked[:rows - 1]:
+        lines.append("%-8s %6.1f %9s  %s" % (pid, 100.0 * values["cpu"] /
+            elapsed, human(data[pid]["rss"]),
+            " ".join(data[pid]["cmdline"].split()) or data[pid]["name"]))
+
+    return lines
+
+def render(stats, deltas, elapsed, columns, rows, now=None):
+    '''return the lines of a frame of *columns* x *rows* for the last
+    *stats* and *deltas* of each collector, *elapsed* has the seconds of
+    each delta'''
+    if now is None:
+        now = time.time()
+
+    try:
+        load = "load %.2f %.2f %.2f" % os.getloadavg()
+    except (AttributeError, OSError):
+        load = ""
+
+    lines = ["%s  %s  %s" % (os.uname()[1] if hasattr(os, "uname") else "",
+        time.strftime("%H:%M:%S", time.localtime(now)), load)]
+
+    if "cpu" in deltas:
+        lines.extend(cpu_lines(deltas["cpu"], columns, max(2, rows // 3)))
+    elif "cpu" in stats:
+        lines.append("cpu  (waiting for the next reading)")
+
+    if "mem" in stats:
+        lines.extend(mem_lines(stats["mem"], columns))
+
+    sections = [name for name in ("net", "disk", "fs", "procs")
+            if name in stats]
+
+    if sections:
+        # what's left is split between the tables, a blank line each
+        size = max(0, rows - len(lines)) // len(sections) - 1
+
+        for name in sections:
+            lines.append("")
+
+            if name == "net":
+                lines.extend(rate_lines("%-16s" % "net", "%10s%10s%10s%10s"
+                    % ("rx/s", "tx/s", "rxpk/s", "txpk/s"),
+                    deltas.get("net"), elapsed.get("net"),
+                    ("rb", "tb", "rc", "tc"), size))
+            elif name == "disk":
+                lines.extend(rate_lines("%-16s" % "disk",
+                    "%10s%10s%10s%10s" % ("read/s", "write/s", "r/s", "w/s"),
+                    deltas.get("disk"), elapsed.get("disk"),
+                    ("rb", "wb", "rc", "wc"), size))
+            elif name == "fs":
+                lines.extend(fs_lines(stats["fs"], size))
+            else:
+                lines.extend(proc_lines(stats["procs"], deltas.get("procs"),
+                    elapsed.get("procs"), size))
+
+    return [line[:columns] for line in lines[:rows]]
+
+class Screen(object):
+    '''writes frames to *out*, in place if it's a terminal'''
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.tty = hasattr(out, "isatty") and out.isatty()
+        self.started = False
+
+    def size(self):
+        '''return the (columns, rows) available'''
+        return terminal_size(self.out)
+
+    def start(self):
+        '''switch to the alternate screen and hide the cursor'''
+        if self.tty and not self.started:
+            self.out.write(ALT_SCREEN + HIDE_CURSOR)
+            self.started = True
+
+    def stop(self):
+        '''go back to the main screen'''
+        if self.started:
+            self.out.write(SHOW_CURSOR + MAIN_SCREEN)
+            self.out.flush()
+            self.started = False
+
+    def draw(self, lines):
+        '''write *lines* as one frame with a single write'''
+        if self.tty:
+            self.start()
+            frame = HOME + (CLEAR_LINE + "\n").join(lines) + CLEAR_LINE + \
+                    CLEAR_SCREEN
+        else:
+            frame = "\n".join(lines) + "\n\n"
+
+        self.out.write(frame)
+        self.out.flush()
+
+class TopChecker(transport.Checker):
+    '''checker that shows the stats of each check on a Screen'''
+
+    def __init__(self, screen=None, **kwargs):
+        transport.Checker.__init__(self, **kwargs)
+        self.screen = screen if screen is not None else Screen()
+        self.stats = {}
+        self.deltas = {}
+
+    def send_stats(self, name, data):
+        '''keep the last reading'''
+        self.stats[name] = data
+
+    def send_delta_stats(self, name, data):
+        '''keep the last delta'''
+        self.deltas[name] = data
+
+    def send_summary_stats(self, name, data):
+        '''summaries are not shown'''
+        pass
+
+    def check(self):
+        '''check and draw the frame'''
+        transport.Checker.check(self)
+        columns, rows = self.screen.size()
+        self.screen.draw(render(self.stats, self.deltas,
+            self.sample_elapsed, columns, rows))
+
+    def on_exit(self):
+        '''restore the terminal'''
+        self.screen.stop()
+
+def main():
+    '''show the stats until ctrl + c'''
+    parser = OptionParser()
+    parser.add_option("-C", "--checkinterval", dest="checkinterval",
+        default=2, type="float",
+        help="check for new values every SEC seconds", metavar="SEC")
+    transport.add_checker_options(parser)
+    opts, _args = parser.parse_args()
+
+    checker = TopChecker(**transport.checker_options(opts))
+    checker.default_interval = opts.checkinterval
+
+    try:
+        while True:
+            checker.check()
+            deadline = checker.next_deadline()
+
+            if deadline is None:
+                time.sleep(opts.checkinterval)
+            else:
+                time.sleep(max(0.0, deadline - transport.monotonic()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        checker.on_exit()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+'''vectorized analytics over the stats of many hosts
+
+readings are packed into numpy arrays with one row per host and one column
+per sample, each host row is a ring buffer of the last *slots* samples,
+utilization, rates, top N and percentiles are computed on whole arrays'''
+import time
+import warnings
+import contextlib
+
+import numpy as np
+
+# columns stored for each collector, the values are taken from the readings
+# as sent by the transports (absolute counters, not deltas)
+COLUMNS = {
+    "cpu": ("kernel", "user", "idle", "nice"),
+    "mem": ("total", "used", "percent"),
+    "net": ("rb", "tb", "rc", "tc"),
+    "disk": ("rb", "wb", "rc", "wc")
+}
+
+# network interfaces that are not summed into the host totals
+IGNORE_IFACES = ("lo",)
+
+@contextlib.contextmanager
+def _quiet():
+    '''silence the "all NaN" warnings numpy emits for hosts without data'''
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        yield
+
+def _cpu_values(data):
+    '''return the COLUMNS["cpu"] values from a cpu reading'''
+    cpu = data["global"]
+    return [cpu.get(name, 0.0) for name in COLUMNS["cpu"]]
+
+def _mem_values(data):
+    '''return the COLUMNS["mem"] values from a mem reading'''
+    mem = data["mem"]
+    return [mem[name] for name in COLUMNS["mem"]]
+
+def _device_sum(names, ignore=()):
+    '''return a function that sums *names* over all the devices of a
+    reading'''
+    def values(data):
+        '''return the sum of each field for all devices'''
+        totals = [0] * len(names)
+
+        for device, stats in data.items():
+            if device in ignore:
+                continue
+
+            for i, name in enumerate(names):
+                totals[i] += stats.get(name, 0)
+
+        return totals
+
+    return values
+
+EXTRACTORS = {
+    "cpu": _cpu_values,
+    "mem": _mem_values,
+    "net": _device_sum(COLUMNS["net"], IGNORE_IFACES),
+    "disk": _device_sum(COLUMNS["disk"])
+}
+
+class FleetStore(object):
+    '''keeps the last *slots* readings of each collector for every host'''
+
+    def __init__(self, slots=360, hosts=64):
+        self.slots = slots
+        self.capacity = hosts
+        self.hosts = []
+        self.index = {}
+
+        # per collector: timestamps, write position and one array per column
+        self.times = {}
+        self.positions = {}
+        self.columns = {}
+
+        for name, columns in COLUMNS.items():
+            self.times[name] = self._empty()
+            self.positions[name] = np.zeros(hosts, dtype=np.int64)
+            self.columns[name] = dict((column, self._empty())
+                    for column in columns)
+
+    def _empty(self, hosts=None):
+        '''return a new (hosts, slots) array filled with NaN'''
+        if hosts is None:
+            hosts = self.capacity
+
+        return np.full((hosts, self.slots), np.nan)
+
+    def _grow(self):
+        '''double the host capacity'''
+        extra = self.capacity
+
+        for name in COLUMNS:
+            self.times[name] = np.vstack((self.times[name],
+                self._empty(extra)))
+            self.positions[name] = np.concatenate((self.positions[name],
+                np.zeros(extra, dtype=np.int64)))
+
+            columns = self.columns[name]
+            for column in columns:
+                columns[column] = np.vstack((columns[column],
+                    self._empty(extra)))
+
+        self.capacity += extra
+
+    def host_row(self, host):
+        '''return the row for *host*, adding it if it's new'''
+        row = self.index.get(host)
+
+        if row is None:
+            if len(self.hosts) == self.capacity:
+                self._grow()
+
+            row = self.index[host] = len(self.hosts)
+            self.hosts.append(host)
+
+        return row
+
+    def add(self, host, name, data, timestamp=None):
+        '''add the reading *data* for collector *name* from *host*, readings
+        for collectors not in COLUMNS are ignored'''
+        extractor = EXTRACTORS.get(name)
+
+        if extractor is None:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        row = self.host_row(host)
+        slot = self.positions[name][row] % self.slots
+        self.positions[name][row] += 1
+
+        self.times[name][row, slot] = timestamp
+        columns = self.columns[name]
+
+        for column, value in zip(COLUMNS[name], extractor(data)):
+            columns[column][row, slot] = value
+
+    def _window(self, name, window, now=None):
+        '''return a (hosts, slots) mask of the samples of collector *name*
+        inside the last *window* seconds'''
+        if now is None:
+            now = time.time()
+
+        times = self.times[name][:len(self.hosts)]
+        with np.errstate(invalid="ignore"):
+            return times >= now - window
+
+    def _spread(self, values, mask):
+        '''return last - first for monotonic counters *values* per host'''
+        masked = np.where(mask, values[:len(self.hosts)], np.nan)
+        with np.errstate(invalid="ignore"), _quiet():
+            return np.nanmax(masked, axis=1) - np.nanmin(masked, axis=1)
+
+    def latest(self, name, column):
+        '''return the last value of *column* for every host'''
+        rows = np.arange(len(self.hosts))
+        slots = (self.positions[name][:len(self.hosts)] - 1) % self.slots
+        return self.columns[name][column][rows, slots]
+
+    def cpu_utilization(self, window=3600, now=None):
+        '''return the cpu utilization percent of every host over the last
+        *window* seconds'''
+        mask = self._window("cpu", window, now)
+        columns = self.columns["cpu"]
+
+        busy = sum(self._spread(columns[name], mask)
+                for name in ("kernel", "user", "nice"))
+        total = busy + self._spread(columns["idle"], mask)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return busy * 100.0 / total
+
+    def rates(self, name, column, window=3600, now=None):
+        '''return the per second rate of counter *column* of collector
+        *name* for every host over the last *window* seconds'''
+        mask = self._window(name, window, now)
+        elapsed = self._spread(self.times[name], mask)
+        delta = self._spread(self.columns[name][column], mask)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return delta / elapsed
+
+    def top(self, values, count=10):
+        '''return a list of (host, value) for the *count* hosts with the
+        highest *values*, hosts without data are skipped'''
+        values = np.where(np.isnan(values), -np.inf, values)
+        count = min(count, len(values))
+
+        if count == 0:
+            return []
+
+        rows = np.argpartition(-values, count - 1)[:count]
+        rows = rows[np.argsort(-values[rows])]
+
+        return [(self.hosts[row], float(values[row])) for row in rows
+                if values[row] != -np.inf]
+
+    def percentiles(self, values, percents=(50, 90, 95, 99)):
+        '''return a dict with the *percents* percentiles of *values*
+        across hosts'''
+        if len(values) == 0:
+            return {}
+
+        with _quiet():
+            result = np.nanpercentile(values, percents)
+
+        return dict(zip(percents, [float(value) for value in result]))
+
+    def summary(self, window=3600, count=5, now=None):
+        '''return a dict with a summary of the fleet state'''
+        cpu = self.cpu_utilization(window, now)
+        mem = self.latest("mem", "percent")
+        net = self.rates("net", "rb", window, now) + \
+                self.rates("net", "tb", window, now)
+        disk = self.rates("disk", "rb", window, now) + \
+                self.rates("disk", "wb", window, now)
+
+        return {
+            "hosts": len(self.hosts),
+            "cpu": {"top": self.top(cpu, count),
+                "percentiles": self.percentiles(cpu)},
+            "mem": {"top": self.top(mem, count),
+                "percentiles": self.percentiles(mem)},
+            "net": {"top": self.top(net, count),
+                "percentiles": self.percentiles(net)},
+            "disk": {"top": self.top(disk, count),
+                "percentiles": self.percentiles(disk)}
+        }
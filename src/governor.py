@@ -0,0 +1,223 @@
+'''keeps the agent under a cpu budget by checking collectors less often
+
+the cpu time each collector (and its delta calculator) takes on the thread
+that runs it is measured on every check, at the end of each window the cpu
+used by the whole agent process in it is added to the usage (smoothed like
+the costs over the windows since the last change) and compared with the
+budget, if it's over the collector with
+the highest cost per second times priority (how little it matters, see
+PRIORITIES) gets its interval doubled, if the agent has been well under the
+budget (RESTORE) for HEADROOM windows in a row and giving back the time to
+the most important stretched collector keeps it under, its interval is
+halved, one change per window so the next one is measured with the new
+intervals
+
+a window lasts *window* seconds or the longest interval in use if that's
+longer, so every collector is checked in each window and a stretched one
+doesn't make the usage of the windows without it look lower than it is
+
+collectors with priority 0 (cpu and mem) are never stretched, no interval
+gets more than MAX_STRETCH times longer'''
+import os
+import threading
+
+# how little each collector matters, the higher the sooner it's stretched,
+# collectors not listed use DEFAULT_PRIORITY
+PRIORITIES = {
+    "cpu": 0,
+    "mem": 0,
+    "net": 1,
+    "procs": 2,
+    "cgroups": 2,
+    "disk": 3,
+    "fs": 4
+}
+DEFAULT_PRIORITY = 2
+
+MAX_STRETCH = 32
+
+# seconds of agent cpu use measured before each change, at least
+WINDOW = 10.0
+
+# intervals are restored when the agent uses less than this part of the
+# budget
+RESTORE = 0.5
+
+# windows in a row under RESTORE before an interval is restored
+HEADROOM = 3
+
+# weight of the last window in the usage and in the cost of a collector
+SMOOTHING = 0.3
+
+def process_time():
+    '''return the user and system cpu seconds used by the process'''
+    times = os.times()
+    return times[0] + times[1]
+
+class Governor(object):
+    '''stretches the intervals of the collectors to keep the agent under
+    *budget* (fraction of one core, 0.005 is 0.5%), *start* is the monotonic
+    time the first window starts'''
+
+    def __init__(self, budget, start, window=WINDOW, priorities=None,
+            cpu_time=process_time):
+        self.budget = budget
+        self.window = window
+        self.priorities = priorities if priorities is not None \
+                else PRIORITIES
+        self.cpu_time = cpu_time
+
+        self.lock = threading.Lock()
+        # cpu seconds per check of each collector
+        self.costs = {}
+        # cpu seconds and checks of each collector in the window
+        self.spent = {}
+        self.checks = {}
+        # interval multiplier of each stretched collector
+        self.stretch = {}
+
+        self.window_start = start
+        self.cpu_start = cpu_time()
+        # fraction of a core used by the agent, smoothed over the windows
+        # since the last change
+        self.usage = None
+        self.changed = True
+        # windows in a row the agent was under RESTORE
+        self.headroom = 0
+
+    def priority(self, name):
+        '''return the priority of collector *name*'''
+        return self.priorities.get(name, DEFAULT_PRIORITY)
+
+    def factor(self, name):
+        '''return the interval multiplier of collector *name*'''
+        return self.stretch.get(name, 1)
+
+    def add(self, name, seconds, check=False):
+        '''add *seconds* of cpu to collector *name*, *check* counts a
+        check'''
+        with self.lock:
+            self.spent[name] = self.spent.get(name, 0.0) + seconds
+
+            if check:
+                self.checks[name] = self.checks.get(name, 0) + 1
+
+    def timed(self, name, function, clock):
+        '''return a function that calls *function* and adds the cpu time it
+        takes measured with *clock* (a thread cpu clock) to collector
+        *name*'''
+        def call():
+            '''call function and time it'''
+            start = clock()
+
+            try:
+                return function()
+            finally:
+                self.add(name, clock() - start, True)
+
+        return call
+
+    def _close_window(self, now):
+        '''update the costs and the usage with the window that ends at
+        *now*'''
+        cpu = self.cpu_time()
+        usage = (cpu - self.cpu_start) / (now - self.window_start)
+
+        if self.changed:
+            # the windows before were measured with other intervals
+            self.usage = usage
+            self.changed = False
+        else:
+            self.usage += SMOOTHING * (usage - self.usage)
+
+        self.window_start = now
+        self.cpu_start = cpu
+
+        with self.lock:
+            spent = self.spent
+            checks = self.checks
+            self.spent = {}
+            self.checks = {}
+
+        for name, count in checks.items():
+            cost = spent.get(name, 0.0) / count
+            previous = self.costs.get(name)
+
+            if previous is None:
+                self.costs[name] = cost
+            else:
+                self.costs[name] = previous + SMOOTHING * (cost - previous)
+
+    def _rate(self, name, interval):
+        '''return the cpu seconds per second collector *name* takes when
+        checked every *interval* seconds'''
+        return self.costs.get(name, 0.0) / interval
+
+    def window_length(self, intervals):
+        '''return the seconds of the window, *intervals* has the intervals
+        without stretching'''
+        return max([self.window] + [interval * self.factor(name)
+            for name, interval in intervals.items()])
+
+    def update(self, now, intervals):
+        '''close the window if it's over at monotonic time *now* and stretch
+        or restore a collector, *intervals* has the intervals without
+        stretching, return the (name, multiplier) that changed or None'''
+        if now - self.window_start < self.window_length(intervals):
+            return None
+
+        self._close_window(now)
+
+        if self.usage < self.budget * RESTORE:
+            self.headroom += 1
+        else:
+            self.headroom = 0
+
+        if self.usage > self.budget:
+            candidates = [(self.priority(name) * self._rate(name,
+                interval * self.factor(name)), name)
+                for name, interval in intervals.items()
+                if self.priority(name) > 0 and name in self.costs
+                and self.factor(name) < MAX_STRETCH]
+
+            if not candidates:
+                return None
+
+            _score, name = max(candidates)
+            self.stretch[name] = self.factor(name) * 2
+        elif self.headroom >= HEADROOM:
+            candidates = [(self.priority(name), self._rate(name,
+                interval * self.factor(name)), name)
+                for name, interval in intervals.items()
+                if self.factor(name) > 1]
+
+            if not candidates:
+                return None
+
+            _priority, rate, name = min(candidates)
+
+            # halving the interval doubles the rate
+            if self.usage + rate >= self.budget:
+                return None
+
+            self.stretch[name] = self.factor(name) // 2
+            # the next restore waits for the headroom with this interval
+            self.headroom = 0
+
+            if self.stretch[name] == 1:
+                del self.stretch[name]
+        else:
+            return None
+
+        self.changed = True
+        return name, self.factor(name)
+
+    def state(self):
+        '''return a dict with the usage, the costs and the multipliers'''
+        return {
+            "budget": self.budget,
+            "usage": self.usage,
+            "headroom": self.headroom,
+            "costs": dict(self.costs),
+            "stretch": dict(self.stretch)
+        }
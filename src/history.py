@@ -0,0 +1,243 @@
+'''in process history of the stats with multi resolution rollups
+
+every number of every reading is a metric identified by (collector, device,
+field), "device" is the first level key of the reading (eth0, sda, mem...), the
+key and the index for lists of dicts (cpu[0]) and "" for top level values,
+deltas are kept as the collector name +
+".diff"
+
+each metric has one ring buffer per tier, a tier has buckets of
+*resolution* seconds and keeps the last *slots* of them, each bucket has the
+min, max, sum and count of the samples that fall in it, samples are added to
+every tier so the 1 minute and 1 hour tiers are rolled up as samples arrive,
+the buffers are arrays of fixed size so the memory used is bounded by
+*max_metrics* (see History.memory)'''
+import re
+import time
+import array
+import threading
+
+# (bucket seconds, buckets) of each tier: 1s for 10 minutes, 1m for a day
+# and 1h for a week
+TIERS = ((1, 600), (60, 1440), (3600, 168))
+
+DIFF_SUFFIX = ".diff"
+
+# device name for the dicts in lists
+LIST_DEVICE = "%s[%d]"
+LIST_DEVICE_RE = re.compile(r"^(.*)\[(\d+)\]$")
+
+def _is_number(value):
+    '''return True if *value* is kept in the history'''
+    return isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool)
+
+class Tier(object):
+    '''a ring buffer of *slots* buckets of *resolution* seconds'''
+
+    # bytes used per bucket: key, min, max and sum doubles and a count
+    BUCKET_SIZE = 4 * 8 + 4
+
+    def __init__(self, resolution, slots):
+        self.resolution = resolution
+        self.slots = slots
+        # bucket number (time // resolution) stored in each slot, -1 if
+        # the slot is empty
+        self.keys = array.array("d", [-1.0]) * slots
+        self.mins = array.array("d", [0.0]) * slots
+        self.maxs = array.array("d", [0.0]) * slots
+        self.sums = array.array("d", [0.0]) * slots
+        self.counts = array.array("I", [0]) * slots
+
+    def add(self, timestamp, value):
+        '''add a sample'''
+        bucket = timestamp // self.resolution
+        slot = int(bucket % self.slots)
+
+        if self.keys[slot] != bucket:
+            self.keys[slot] = bucket
+            self.mins[slot] = self.maxs[slot] = self.sums[slot] = value
+            self.counts[slot] = 1
+        else:
+            if value < self.mins[slot]:
+                self.mins[slot] = value
+            elif value > self.maxs[slot]:
+                self.maxs[slot] = value
+
+            self.sums[slot] += value
+            self.counts[slot] += 1
+
+    def points(self, start, end):
+        '''return the (bucket start time, min, max, avg) of the buckets in
+        [*start*, *end*] sorted by time'''
+        first = start // self.resolution
+        last = end // self.resolution
+
+        points = [(key * self.resolution, self.mins[slot], self.maxs[slot],
+            self.sums[slot] / self.counts[slot])
+            for slot, key in enumerate(self.keys)
+            if key >= 0 and first <= key <= last]
+        points.sort()
+
+        return points
+
+class History(object):
+    '''the history of every metric of the readings observed, at most
+    *max_metrics* metrics are kept, the rest are counted in dropped'''
+
+    def __init__(self, tiers=TIERS, max_metrics=1000):
+        self.tiers = tiers
+        self.max_metrics = max_metrics
+        self.lock = threading.Lock()
+
+        # (collector, device, field) -> list of Tier
+        self.series = {}
+        # collector -> list of (device, field)
+        self.metrics = {}
+        self.dropped = 0
+
+    def memory(self):
+        '''return the bytes used by the buffers when *max_metrics* metrics
+        are kept'''
+        return self.max_metrics * sum(slots * Tier.BUCKET_SIZE
+                for _resolution, slots in self.tiers)
+
+    def _tiers(self, key):
+        '''return the tiers of metric *key*, None if there's no room for a
+        new one'''
+        tiers = self.series.get(key)
+
+        if tiers is None:
+            if len(self.series) >= self.max_metrics:
+                self.dropped += 1
+                return None
+
+            tiers = self.series[key] = [Tier(resolution, slots)
+                    for resolution, slots in self.tiers]
+            self.metrics.setdefault(key[0], []).append(key[1:])
+
+        return tiers
+
+    def add(self, collector, data, timestamp=None):
+        '''add the numbers of reading *data* of *collector*'''
+        if timestamp is None:
+            timestamp = time.time()
+
+        samples = []
+
+        for device, value in data.items():
+            if isinstance(value, dict):
+                samples.extend([(device, field, number) for field, number
+                    in value.items() if _is_number(number)])
+            elif isinstance(value, (list, tuple)):
+                for i, item in enumerate(value):
+                    if isinstance(item, dict):
+                        samples.extend([(LIST_DEVICE % (device, i), field,
+                            number) for field, number in item.items()
+                            if _is_number(number)])
+            elif _is_number(value):
+                samples.append(("", device, value))
+
+        with self.lock:
+            for device, field, value in samples:
+                tiers = self._tiers((collector, device, field))
+
+                if tiers is not None:
+                    for tier in tiers:
+                        tier.add(timestamp, value)
+
+    def observe(self, name, data, delta, timestamp):
+        '''Checker observer, adds the reading and the delta'''
+        self.add(name, data, timestamp)
+
+        if delta is not None:
+            self.add(name + DIFF_SUFFIX, delta, timestamp)
+
+    def collectors(self):
+        '''return the names of the collectors with history'''
+        with self.lock:
+            return sorted(self.metrics)
+
+    def devices(self, collector):
+        '''return the (device, field) of the metrics of *collector*'''
+        with self.lock:
+            return sorted(self.metrics.get(collector, []))
+
+    def _tier(self, resolution, start, now):
+        '''return the index of the tier with *resolution* or the finest
+        one that still has *start* if it's None'''
+        if resolution is not None:
+            for index, (tier_resolution, _slots) in enumerate(self.tiers):
+                if tier_resolution == resolution:
+                    return index
+
+            raise ValueError("no tier with resolution %s" % resolution)
+
+        for index, (tier_resolution, slots) in enumerate(self.tiers):
+            if start >= (now // tier_resolution - slots + 1) * \
+                    tier_resolution:
+                return index
+
+        return len(self.tiers) - 1
+
+    def query(self, collector, device=None, field=None, start=None,
+            end=None, resolution=None):
+        '''return a dict from (device, field) to a list of (time, min, max,
+        avg) points of the metrics of *collector* between *start* and *end*
+        (the last hour and now if None), *device* and *field* filter the
+        metrics, *resolution* picks the tier, if None the finest one that
+        covers *start* is used'''
+        now = time.time()
+
+        if end is None:
+            end = now
+
+        if start is None:
+            start = end - 3600
+
+        index = self._tier(resolution, start, now)
+
+        with self.lock:
+            return dict(((metric_device, metric_field),
+                self.series[collector, metric_device, metric_field][index]
+                    .points(start, end))
+                for metric_device, metric_field in
+                    self.metrics.get(collector, [])
+                if (device is None or device == metric_device) and
+                    (field is None or field == metric_field))
+
+    def readings(self, collector, start, end=None, resolution=None):
+        '''return a list of (time, reading) between *start* and *end*
+        rebuilt from the history of *collector*, with the average of each
+        bucket, used to backfill the readings a transport couldn't send'''
+        buckets = {}
+
+        for (device, field), points in self.query(collector, start=start,
+                end=end, resolution=resolution).items():
+            for timestamp, _min, _max, avg in points:
+                reading = buckets.setdefault(timestamp, {})
+
+                if device == "":
+                    reading[field] = avg
+                else:
+                    reading.setdefault(device, {})[field] = avg
+
+        return [(timestamp, _rebuild_lists(reading))
+                for timestamp, reading in sorted(buckets.items())]
+
+def _rebuild_lists(reading):
+    '''turn the LIST_DEVICE devices of *reading* back into lists'''
+    lists = {}
+
+    for device in reading.keys():
+        match = LIST_DEVICE_RE.match(device)
+
+        if match is not None:
+            key, index = match.group(1), int(match.group(2))
+            lists.setdefault(key, {})[index] = reading.pop(device)
+
+    for key, items in lists.items():
+        reading[key] = [items.get(index, {})
+                for index in xrange(max(items) + 1)]
+
+    return reading
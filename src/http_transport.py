@@ -0,0 +1,293 @@
+'''HTTP transport for stats, scrapers pull the last readings
+
+instead of sending the readings the checker keeps the last reading and delta
+of each collector and serves them on an embedded HTTP server:
+
+    /metrics    text exposition format (prometheus)
+    /stats      json, like oneshot.py: {"timestamp": ..., "stats": {...},
+                "diff": {...}, "elapsed": {...}, "intervals": {...}}
+
+a scrape never collects, the bodies are rendered (and gzipped) once per
+check and served from memory with an ETag, a scraper that sends the ETag it
+has in If-None-Match gets a 304 until the next check, before the first
+check the pages are there but have no readings
+
+in the text format every number of a reading is a metric named
+sistats_<collector>_<field> with the first level key of the reading as the
+device label (cpu[3] for the lists of dicts, like history.py), deltas are
+sistats_<collector>_delta_<field> and the seconds they span
+sistats_<collector>_delta_seconds, the seconds between checks of each
+collector (longer while the agent is over its cpu budget) are
+sistats_<collector>_interval_seconds'''
+import re
+import time
+import json
+import zlib
+import SocketServer
+import BaseHTTPServer
+import threading
+
+import stream
+import transport
+
+from optparse import OptionParser
+
+PREFIX = "sistats"
+
+# device label for the dicts in lists, like history.LIST_DEVICE
+LIST_DEVICE = "%s[%d]"
+
+TEXT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+JSON_TYPE = "application/json"
+
+INVALID_NAME = re.compile(r"[^a-zA-Z0-9_]")
+
+def _is_number(value):
+    '''return True if *value* is exported as a metric'''
+    return isinstance(value, (int, long, float)) and \
+            not isinstance(value, bool)
+
+def metric_name(*parts):
+    '''return the metric name for *parts*'''
+    return INVALID_NAME.sub("_", "_".join([PREFIX] + [str(part)
+        for part in parts]))
+
+def _label(value):
+    '''return *value* escaped for a label'''
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n",
+            "\\n")
+
+def _value(value):
+    '''return *value* formatted for the text format'''
+    if not isinstance(value, float):
+        return str(value)
+    elif value != value:
+        return "NaN"
+    elif value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(value)
+
+def add_metrics(metrics, name, data):
+    '''add the numbers of reading *data* of collector *name* to *metrics*,
+    a dict from metric name to a list of (device, value)'''
+    for path, value in stream.flatten(data):
+        if not _is_number(value):
+            continue
+
+        if len(path) < 2:
+            device, fields = "", path
+        elif isinstance(path[1], int):
+            device, fields = LIST_DEVICE % path[:2], path[2:]
+        elif isinstance(path[0], basestring):
+            device, fields = path[0], path[1:]
+        else:
+            device, fields = str(path[0]), path[1:]
+
+        metrics.setdefault(metric_name(name, *fields), []).append((device,
+            value))
+
+def render_text(stats, deltas, elapsed, intervals):
+    '''return the text exposition of the last *stats* and *deltas* of each
+    collector, the seconds each delta spans (*elapsed*) and the seconds
+    between checks (*intervals*)'''
+    metrics = {}
+
+    for name, interval in intervals.items():
+        if interval is not None:
+            metrics[metric_name(name, "interval_seconds")] = [("", interval)]
+
+    for name, data in stats.items():
+        add_metrics(metrics, name, data)
+
+    for name, data in deltas.items():
+        add_metrics(metrics, name + "_delta", data)
+
+        if name in elapsed:
+            metrics.setdefault(metric_name(name, "delta_seconds"),
+                    []).append(("", elapsed[name]))
+
+    lines = []
+
+    for name, values in sorted(metrics.items()):
+        lines.append("# TYPE %s untyped" % name)
+
+        for device, value in values:
+            if device:
+                lines.append("%s{device=\"%s\"} %s" % (name, _label(device),
+                    _value(value)))
+            else:
+                lines.append("%s %s" % (name, _value(value)))
+
+    lines.append("")
+    body = "\n".join(lines)
+
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+
+    return body
+
+def render_json(stats, deltas, elapsed, intervals, timestamp):
+    '''return the json of the last *stats* and *deltas*'''
+    return json.dumps({"timestamp": timestamp, "stats": stats,
+        "diff": deltas, "elapsed": elapsed, "intervals": intervals},
+        sort_keys=True, separators=(",", ":"))
+
+def gzip(body):
+    '''return *body* gzipped'''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+class Page(object):
+    '''a rendered body, its gzipped version and its ETag'''
+
+    __slots__ = ("body", "gzipped", "etag", "content_type")
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzipped = gzip(body)
+        self.etag = "\"%08x-%x\"" % (zlib.crc32(body) & 0xffffffff,
+                len(body))
+        self.content_type = content_type
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''serves the pages of the server checker'''
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        page = self.server.checker.pages.get(self.path.split("?", 1)[0])
+
+        if page is None:
+            self.send_error(404)
+            return
+
+        cached = page.etag == self.headers.getheader("if-none-match")
+
+        self.send_response(304 if cached else 200)
+        self.send_header("ETag", page.etag)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Content-Type", page.content_type)
+
+        if cached:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = page.body
+
+        if "gzip" in self.headers.getheader("accept-encoding", ""):
+            body = page.gzipped
+            self.send_header("Content-Encoding", "gzip")
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        if self.server.checker.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''http server of *checker*'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, checker):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.checker = checker
+
+class Checker(transport.Checker):
+    '''keeps the last readings and serves them on *host*:*port*'''
+
+    def __init__(self, host="127.0.0.1", port=9110, verbose=False, **kwargs):
+        transport.Checker.__init__(self, **kwargs)
+        self.verbose = verbose
+        self.stats = {}
+        self.deltas = {}
+        # path -> Page, replaced as a whole after each check so the
+        # handlers never see half of a check, empty until the first one
+        self.pages = {}
+        self.render()
+
+        self.server = Server((host, port), self)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send_stats(self, name, data):
+        '''keep the last reading'''
+        self.stats[name] = data
+        self.changed = True
+
+    def send_delta_stats(self, name, data):
+        '''keep the last delta'''
+        self.deltas[name] = data
+        self.changed = True
+
+    def render(self):
+        '''render the pages for the readings kept'''
+        elapsed = dict((name, self.sample_elapsed[name])
+                for name in self.deltas if name in self.sample_elapsed)
+        intervals = self.effective_intervals()
+
+        self.pages = {
+            "/metrics": Page(render_text(self.stats, self.deltas, elapsed,
+                intervals), TEXT_TYPE),
+            "/stats": Page(render_json(self.stats, self.deltas, elapsed,
+                intervals, time.time()), JSON_TYPE)
+        }
+        self.changed = False
+
+    def check(self):
+        '''check and render the pages if there's something new'''
+        transport.Checker.check(self)
+
+        if self.changed:
+            self.render()
+
+    def on_exit(self):
+        '''stop the server'''
+        self.server.shutdown()
+        self.server.server_close()
+
+def base_option_parser():
+    '''create a parser for the basic options and return it, used to extend
+    the command line parsing with custom options for other agents
+    '''
+    parser = OptionParser()
+
+    parser.add_option("-v", action="store_true", dest="verbose", default=False,
+        help="be verbose")
+
+    parser.add_option("-H", "--host", dest="host", default="127.0.0.1",
+        help="listen on HOST", metavar="HOST")
+    parser.add_option("-P", "--port", dest="port", default=9110,
+        type="int", help="listen on PORT", metavar="PORT")
+
+    parser.add_option("-C", "--checkinterval", dest="checkinterval",
+            default=10, type="float",
+            help="check for new values every SEC seconds", metavar="SEC")
+
+    parser.add_option("-b", "--blacklist", dest="blacklist", default="",
+        help="don't serve the given types", metavar="TYPES")
+
+    transport.add_checker_options(parser)
+
+    return parser
+
+def main():
+    '''main function if this module is called, serves the stats'''
+    parser = base_option_parser()
+    opts, _args = parser.parse_args()
+
+    checker = Checker(opts.host, opts.port, verbose=opts.verbose,
+            blacklist=opts.blacklist.split(","),
+            **transport.checker_options(opts))
+
+    transport.main_loop(checker, opts.checkinterval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+'''cached mount table and file system usage that can't hang
+
+the mount table is only read again when it changes, on linux the kernel
+signals changes on /proc/self/mountinfo, on other systems it's read again
+every REFRESH seconds, statvfs calls (psutil.disk_usage where there's no
+statvfs) run on worker threads and mounts that don't answer in time are
+reported as stale instead of blocking'''
+import os
+import time
+import Queue
+import select
+import threading
+
+import procfs
+
+MOUNTINFO = os.path.join(procfs.PROC, "self", "mountinfo")
+
+# seconds between mount table reads when changes can't be detected
+REFRESH = 60
+
+# seconds to wait for statvfs on each mount
+TIMEOUT = 2.0
+
+def _unescape(value):
+    '''unescape the octal escapes used in mountinfo (\\040 for space)'''
+    if "\\" not in value:
+        return value
+
+    return value.decode("string_escape")
+
+def parse_mountinfo(content):
+    '''parse the content of /proc/self/mountinfo into a list of
+    (device, mount point, fs type) tuples, lines that don't have all the
+    fields are skipped'''
+    partitions = []
+
+    for line in content.splitlines():
+        fields = line.split()
+
+        try:
+            # optional fields end with a single "-"
+            separator = fields.index("-", 6)
+            partitions.append((_unescape(fields[separator + 2]),
+                _unescape(fields[4]), fields[separator + 1]))
+        except (ValueError, IndexError):
+            continue
+
+    return partitions
+
+class MountTable(object):
+    '''the list of mounted file systems, read again only when it changes'''
+
+    def __init__(self, path=MOUNTINFO, refresh=REFRESH):
+        self.refresh = refresh
+        self.partitions = None
+        self.read_time = 0.0
+        self.mountinfo = None
+        self.poller = None
+
+        if os.path.exists(path) and hasattr(select, "poll"):
+            self.mountinfo = procfs.ProcFile(path)
+            self.poller = select.poll()
+            self.poller.register(self.mountinfo.fd,
+                    select.POLLERR | select.POLLPRI)
+
+    def changed(self):
+        '''return True if the mount table may have changed since the last
+        read'''
+        if self.partitions is None:
+            return True
+        elif self.poller is None:
+            return time.time() - self.read_time >= self.refresh
+        else:
+            return bool(self.poller.poll(0))
+
+    def read(self):
+        '''read the mount table'''
+        if self.mountinfo is None:
+            import psutil
+
+            return [(part.device, part.mountpoint, part.fstype)
+                    for part in psutil.disk_partitions(True)]
+        else:
+            # reading it also clears the change notification, the whole
+            # file, it's a seq_file that comes a page per read
+            return parse_mountinfo(self.mountinfo.read())
+
+    def get(self):
+        '''return the list of (device, mount point, fs type) tuples'''
+        if self.changed():
+            self.partitions = self.read()
+            self.read_time = time.time()
+
+        return self.partitions
+
+def disk_usage(mountpoint):
+    '''return the (size, used, available) bytes of the file system mounted
+    at *mountpoint*'''
+    if not hasattr(os, "statvfs"):
+        import psutil
+
+        usage = psutil.disk_usage(mountpoint)
+        return usage.total, usage.used, usage.free
+
+    result = os.statvfs(mountpoint)
+    return (result.f_blocks * result.f_frsize,
+            (result.f_blocks - result.f_bfree) * result.f_frsize,
+            result.f_bavail * result.f_frsize)
+
+class StatvfsPool(object):
+    '''run statvfs on worker threads, a mount that hangs keeps its worker
+    busy and is not queried again until it answers, new workers are started
+    to replace the hung ones'''
+
+    def __init__(self, workers=4, timeout=TIMEOUT):
+        self.size = workers
+        self.timeout = timeout
+        self.workers = 0
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+
+        # mount point -> time the statvfs was requested
+        self.pending = {}
+        # mount point -> disk_usage result or the exception it raised
+        self.results = {}
+
+    def _work(self):
+        '''worker thread function'''
+        while True:
+            mountpoint = self.jobs.get()
+
+            try:
+                result = disk_usage(mountpoint)
+            except Exception as error:
+                # anything else would leave the mount pending for good
+                result = error
+
+            with self.lock:
+                del self.pending[mountpoint]
+                self.results[mountpoint] = result
+                self.done.notify_all()
+
+    def _start_workers(self, now):
+        '''start workers until there are *size* of them not hung'''
+        hung = len([started for started in self.pending.values()
+            if now - started > self.timeout])
+
+        while self.workers - hung < self.size:
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.workers += 1
+
+    def statvfs(self, mountpoints):
+        '''return a dict from mount point to its disk_usage result, the
+        exception if it failed or None if it didn't answer in time'''
+        now = time.time()
+        deadline = now + self.timeout
+
+        with self.lock:
+            for mountpoint in mountpoints:
+                if mountpoint not in self.pending:
+                    self.pending[mountpoint] = now
+                    self.results.pop(mountpoint, None)
+                    self.jobs.put(mountpoint)
+
+            self._start_workers(now)
+
+            while any(mountpoint in self.pending for mountpoint in
+                    mountpoints):
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    break
+
+                self.done.wait(remaining)
+
+            return dict((mountpoint, self.results.get(mountpoint))
+                    for mountpoint in mountpoints)
+
+class FsCollector(object):
+    '''collect file system stats using a cached mount table and a statvfs
+    pool'''
+
+    def __init__(self, mounts=None, pool=None):
+        self.mounts = mounts if mounts is not None else MountTable()
+        self.pool = pool if pool is not None else StatvfsPool()
+        # last good reading of each mount point, reported for stale mounts
+        self.last_usage = {}
+
+    def get_stats(self, ignore_fsname=(), ignore_fstype=()):
+        '''return file system stats in the sistats.get_fs_stats format,
+        mounts that didn't answer have stale set to True and the last known
+        values (None if there are none)'''
+        partitions = [(device, mountpoint, fstype) for device, mountpoint,
+                fstype in self.mounts.get() if device not in ignore_fsname and
+                fstype not in ignore_fstype]
+
+        results = self.pool.statvfs([mountpoint for _device, mountpoint,
+            _fstype in partitions])
+
+        filesystems = {}
+        last_usage = {}
+
+        for device, mountpoint, fstype in partitions:
+            fs_current = {}
+            fs_current['type'] = fstype
+            fs_current['mnt_point'] = mountpoint
+            fs_current['stale'] = False
+
+            result = results[mountpoint]
+
+            if result is None:
+                fs_current['stale'] = True
+                usage = self.last_usage.get(mountpoint, (None, None, None))
+                last_usage[mountpoint] = usage
+            elif isinstance(result, Exception):
+                usage = (-1, -1, -1)
+            else:
+                usage = result
+                last_usage[mountpoint] = usage
+
+            fs_current['size'], fs_current['used'], fs_current['avail'] = usage
+
+            filesystems[device] = fs_current
+
+        self.last_usage = last_usage
+        return filesystems
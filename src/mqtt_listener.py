@@ -1,9 +1,20 @@
 '''example module to listen to mqtt broker for sistats'''
 
+import time
+import json
+import threading
+import collections
+
 import bson
 import mosquitto
 
+import wire
+import stream
+import selfstats
 import sistats
+import mqtt_transport
+
+from optparse import OptionParser
 
 MQTT_CONNECT_STATUS = {
     0: "Success",
@@ -14,52 +25,403 @@ MQTT_CONNECT_STATUS = {
     5: "Refused - not authorised"
 }
 
+# seconds between keyframe requests for the same stream
+KEYFRAME_RETRY = 5.0
+
 class Consumer(object):
     '''receives stats from a mqtt broker'''
 
-    STATS = ("cpu", "mem", "net", "disk", "fs")
+    STATS = ("cpu", "mem", "net", "disk", "fs", "procs", "cgroups",
+            selfstats.SELF, mqtt_transport.ENVELOPE)
+    SUFFIXES = ("", "/diff", "/stream", "/wire", "/backfill")
 
     def __init__(self, client_id, host="localhost", port=1883,
             topic_template="/ef/machine/%s/stats/%s", keepalive=60,
-            topics=STATS):
+            topics=STATS, store=None, verbose=True):
 
         self.host = host
         self.port = port
         self.topic_template = topic_template
         self.client_id = client_id
+        self.store = store
+        self.verbose = verbose
+        self.parse_topic = mqtt_transport.topic_parser(topic_template)
+        self.decoders = stream.StreamDecoders()
+        self.wire_decoder = wire.WireDecoder()
+        # (client id, stat name) -> time of the last keyframe request
+        self.keyframe_requests = {}
+        # topics of the keyframe requests not published yet, the client is
+        # only used from the thread that runs loop
+        self.pending_keyframes = collections.deque()
 
         self.client = mosquitto.Mosquitto(client_id)
-
-        self.client.on_message = on_message
+        self.client.on_message = self.on_message
         self.client.on_connect = on_connect
 
         self.client.connect(host, port, keepalive)
+        self.subscribe(topics)
 
+    def subscribe(self, topics):
+        '''subscribe to the topics of stats *topics* of client_id'''
         for name in topics:
-            topic = topic_template % (client_id, name)
-            topic_diff = topic + "/diff"
-            print "subscribing to topic", topic, "and", topic_diff
-            self.client.subscribe(topic, 0)
-            self.client.subscribe(topic_diff, 0)
+            topic = self.topic_template % (self.client_id, name)
+            subscriptions = [topic + suffix for suffix in self.SUFFIXES]
+            print "subscribing to topics", ", ".join(subscriptions)
+
+            for subscription in subscriptions:
+                self.client.subscribe(subscription, 0)
+
+    def decode(self, topic, payload):
+        '''return a (client id, stat name, is diff, data, timestamp) tuple
+        for a message, data is None if it's a stream frame that can't be
+        decoded until the next keyframe or a wire frame with an unknown
+        schema, timestamp is the time the stats were sampled, None if the
+        message doesn't have it (stream and wire frames)'''
+        parsed = self.parse_topic(topic)
+
+        if parsed is None:
+            return None, None, False, bson.BSON(payload).decode(), None
+
+        host, name, suffix = parsed
+
+        if suffix in ("stream", "wire"):
+            if suffix == "stream":
+                data = self.decoders.decode((host, name), payload)
+            else:
+                data = self.wire_decoder.decode(payload)
+
+            if data is None:
+                self.request_keyframe(host, name)
+
+            return host, name, False, data, None
+
+        message = bson.BSON(payload).decode()
+
+        if name == mqtt_transport.ENVELOPE:
+            return host, name, False, message, message.get("timestamp")
+        elif suffix == "backfill":
+            return host, name, False, message["stats"], message["timestamp"]
+
+        is_diff = suffix == "diff"
+        key = "diff" if is_diff else "stats"
+
+        # agents with --sampletime wrap the stats, the rest send them as is
+        if set(message) == set(("timestamp", "elapsed", key)):
+            return host, name, is_diff, message[key], message["timestamp"]
+
+        return host, name, is_diff, message, None
+
+    def request_keyframe(self, host, name):
+        '''ask the agent of *host* for a keyframe of stat *name*, at most
+        once every KEYFRAME_RETRY seconds, the request is published by loop
+        since this is called from the worker threads too'''
+        now = time.time()
+
+        if now - self.keyframe_requests.get((host, name), 0) < KEYFRAME_RETRY:
+            return
+
+        self.keyframe_requests[host, name] = now
+        self.pending_keyframes.append(self.topic_template % (host, name) +
+                "/keyframe")
+
+    def loop(self, timeout=1.0):
+        '''publish the queued keyframe requests and run the network loop of
+        the client for up to *timeout* seconds'''
+        while True:
+            try:
+                topic = self.pending_keyframes.popleft()
+            except IndexError:
+                break
+
+            self.client.publish(topic, "", 1)
+
+        return self.client.loop(timeout)
+
+    def on_message(self, _mosq, msg):
+        '''handle a message from the subscriptions'''
+        self.handle(msg.topic, msg.payload)
+
+    def handle(self, topic, payload):
+        '''decode a message and deliver the stats in it'''
+        host, name, is_diff, data, timestamp = self.decode(topic, payload)
+
+        if data is None:
+            return
+        elif name == mqtt_transport.ENVELOPE:
+            self.on_envelope(host, data)
+        else:
+            self.deliver(host, name, is_diff, data, topic, timestamp)
+
+    def on_envelope(self, host, envelope):
+        '''handle the stats of a check sent in one message'''
+        timestamp = envelope.get("timestamp")
+        times = envelope.get("times", {})
+
+        for name, data in envelope.get("stats", {}).items():
+            self.deliver(host, name, False, data,
+                    self.topic_template % (host, name),
+                    times.get(name, timestamp))
+
+        for name, data in envelope.get("diff", {}).items():
+            self.deliver(host, name, True, data,
+                    self.topic_template % (host, name) + "/diff",
+                    times.get(name, timestamp))
+
+    def deliver(self, host, name, is_diff, data, topic, timestamp=None):
+        '''add the readings to the fleet store if there is one and print
+        them if verbose'''
+        if self.store is not None and host is not None and not is_diff:
+            self.store.add(host, name, data, timestamp)
+
+        if self.verbose:
+            sistats.pretty_print(topic, data)
+
+class Partition(threading.Thread):
+    '''a worker that handles the messages of part of the topics in order,
+    messages are queued without blocking, when more than *max_pending* are
+    waiting the oldest are dropped'''
+
+    def __init__(self, handle, max_pending=100000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.handle = handle
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.wakeup = threading.Event()
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def put(self, topic, payload):
+        '''queue a message, called from the network thread'''
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+
+        self.pending.append((topic, payload))
+
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def run(self):
+        '''handle the queued messages'''
+        while True:
+            self.wakeup.wait()
+            # cleared before draining so messages queued meanwhile wake it
+            # up again
+            self.wakeup.clear()
+
+            while True:
+                try:
+                    topic, payload = self.pending.popleft()
+                except IndexError:
+                    break
+
+                try:
+                    self.handle(topic, payload)
+                except Exception as error:
+                    self.errors += 1
+                    print "error handling message on", topic + ":", error
+
+                self.handled += 1
+
+class FleetConsumer(Consumer):
+    '''receives the stats of all the hosts publishing to *topic_template*
 
-def on_message(_mosq, msg):
-    '''callback called when a message from the subscriptions is received'''
-    data = bson.BSON(msg.payload).decode()
-    sistats.pretty_print(msg.topic, data)
+    it subscribes with wildcards, the network thread only queues the
+    messages to one of *workers* partitions by topic (so the frames of a
+    stream are decoded in order) and the workers decode them, keep the
+    latest stats of each host and deliver them to *sinks*, callables that
+    get (host, stat name, is diff, data, timestamp) and must be thread
+    safe'''
+
+    def __init__(self, listener_id, host="localhost", port=1883,
+            topic_template="/ef/machine/%s/stats/%s", keepalive=60,
+            store=None, sinks=(), workers=4, max_pending=100000):
+        self.sinks = list(sinks)
+        self.lock = threading.Lock()
+        # host -> stat name -> (timestamp, data)
+        self.latest = {}
+        self.partitions = [Partition(self.handle, max_pending)
+                for _ in xrange(workers)]
+
+        for partition in self.partitions:
+            partition.start()
+
+        Consumer.__init__(self, listener_id, host, port, topic_template,
+                keepalive, (), store, False)
+
+    def subscribe(self, _topics):
+        '''subscribe to the topics of all the hosts and stats'''
+        topic = self.topic_template % ("+", "+")
+        print "subscribing to topics", topic, "and", topic + "/+"
+        self.client.subscribe(topic, 0)
+        self.client.subscribe(topic + "/+", 0)
+
+    def on_message(self, _mosq, msg):
+        '''queue the message to the partition of its topic'''
+        topic = msg.topic
+
+        if topic.endswith("/keyframe"):
+            return
+
+        self.partitions[hash(topic) % len(self.partitions)].put(topic,
+                msg.payload)
+
+    def deliver(self, host, name, is_diff, data, topic, timestamp=None):
+        '''update the latest state and pass the stats to the sinks'''
+        if timestamp is None:
+            timestamp = time.time()
+
+        if host is not None and not is_diff:
+            with self.lock:
+                stats = self.latest.setdefault(host, {})
+
+                # backfilled stats are older than the latest ones
+                if name not in stats or stats[name][0] <= timestamp:
+                    stats[name] = (timestamp, data)
+
+                if self.store is not None:
+                    self.store.add(host, name, data, timestamp)
+
+        for sink in self.sinks:
+            sink(host, name, is_diff, data, timestamp)
+
+    def latest_stats(self, host=None):
+        '''return a copy of the latest stats of *host* as a dict from stat
+        name to (timestamp, data) or of all hosts as a dict from host to
+        that if *host* is None'''
+        with self.lock:
+            if host is not None:
+                return dict(self.latest.get(host, {}))
+
+            return dict((name, dict(stats))
+                    for name, stats in self.latest.items())
+
+    def stats(self):
+        '''return the counters of the partitions'''
+        return {
+            "pending": sum(len(part.pending) for part in self.partitions),
+            "handled": sum(part.handled for part in self.partitions),
+            "dropped": sum(part.dropped for part in self.partitions),
+            "errors": sum(part.errors for part in self.partitions)
+        }
+
+class StdoutSink(object):
+    '''sink that pretty prints the stats'''
+
+    def __init__(self, topic_template="%s %s"):
+        self.topic_template = topic_template
+        self.lock = threading.Lock()
+
+    def __call__(self, host, name, is_diff, data, _timestamp):
+        title = self.topic_template % (host, name) + (" diff" if is_diff
+                else "")
+
+        with self.lock:
+            sistats.pretty_print(title, data)
+
+class FileSink(object):
+    '''sink that appends the stats to *path* as json lines'''
+
+    def __init__(self, path):
+        self.handle = open(path, "a")
+        self.lock = threading.Lock()
+
+    def __call__(self, host, name, is_diff, data, timestamp):
+        line = json.dumps({"host": host, "name": name, "diff": is_diff,
+            "timestamp": timestamp, "data": data}) + "\n"
+
+        with self.lock:
+            self.handle.write(line)
+
+    def close(self):
+        '''close the file'''
+        with self.lock:
+            self.handle.close()
 
 def on_connect(_mosq, code):
     '''callback called on connect'''
     print "connection response:", MQTT_CONNECT_STATUS[code]
 
+def print_fleet_summary(store, window):
+    '''print the summary of the readings in *store*'''
+    summary = store.summary(window)
+    sistats.print_title("Fleet (%d hosts, last %d seconds)" % (
+        summary["hosts"], window), "=")
+
+    for name in ("cpu", "mem", "net", "disk"):
+        percentiles = summary[name]["percentiles"]
+        print name, "p50/p95/p99:", " ".join("%.1f" % percentiles.get(
+            percent, float("nan")) for percent in (50, 95, 99))
+        print "   top:", ", ".join("%s %.1f" % item for item in
+                summary[name]["top"])
+
+    print
+
 def main():
     '''main function if this module is called, starts a mqtt listener'''
-    import sys
+    parser = OptionParser(usage="%prog [options] CLIENT_ID")
+    parser.add_option("-a", "--analytics", dest="analytics", default=0,
+        type="int", help="keep readings in a fleet store and print a summary "
+        "every SEC seconds (requires numpy)", metavar="SEC")
+    parser.add_option("-w", "--window", dest="window", default=3600,
+        type="int", help="summarize the last SEC seconds", metavar="SEC")
+    parser.add_option("-q", action="store_false", dest="verbose",
+        default=True, help="don't print every message")
+    parser.add_option("-t", "--topic", dest="topic",
+        default="/ef/machine/%s/stats/%s", help="listen to topics made from "
+        "TEMPLATE with the client id and the stat name", metavar="TEMPLATE")
+    parser.add_option("-F", "--fleet", action="store_true", dest="fleet",
+        default=False, help="listen to all the clients, CLIENT_ID is the id "
+        "of this listener")
+    parser.add_option("-n", "--workers", dest="workers", default=4,
+        type="int", help="in fleet mode decode messages on COUNT threads",
+        metavar="COUNT")
+    parser.add_option("-o", "--output", dest="output", default=None,
+        help="in fleet mode append the stats to FILE as json lines",
+        metavar="FILE")
+
+    opts, args = parser.parse_args()
 
-    client_id = sys.argv[1]
-    consumer = Consumer(client_id)
+    if len(args) != 1:
+        parser.error("a client id is required")
+
+    store = None
+    if opts.analytics:
+        import fleet
+        store = fleet.FleetStore()
+
+    if opts.fleet:
+        sinks = []
+
+        if opts.verbose:
+            sinks.append(StdoutSink())
+
+        if opts.output is not None:
+            sinks.append(FileSink(opts.output))
+
+        consumer = FleetConsumer(args[0], topic_template=opts.topic,
+                store=store, sinks=sinks, workers=opts.workers)
+        lock = consumer.lock
+    else:
+        consumer = Consumer(args[0], topic_template=opts.topic, store=store,
+                verbose=opts.verbose)
+        lock = threading.Lock()
+
+    next_summary = time.time() + opts.analytics
 
     while True:
-        consumer.client.loop(-1)
+        consumer.loop(1.0)
+
+        if store is not None and time.time() >= next_summary:
+            with lock:
+                print_fleet_summary(store, opts.window)
+
+            if opts.fleet:
+                print "messages:", consumer.stats()
+
+            next_summary += opts.analytics
 
 if __name__ == "__main__":
     main()
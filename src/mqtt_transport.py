@@ -1,45 +1,395 @@
 '''implement mqtt transport for stats'''
+import re
+import time
+import socket
+import threading
+import collections
+
 import bson
 import mosquitto
 
+import wire
+import stream
 import transport
 
 from optparse import OptionParser
 
+ENCODINGS = ("bson", "stream", "wire")
+
+# stat name of the message with all the stats of a check
+ENVELOPE = "all"
+
+# seconds between connection attempts and seconds the network loop waits
+# for traffic each round
+RETRY = 5.0
+LOOP_TIMEOUT = 0.1
+
+# encoders for the encodings that are not bson, they are sent to the topic +
+# "/" + encoding
+ENCODERS = {
+    "stream": stream.StreamEncoder,
+    "wire": wire.WireEncoder
+}
+
+def topic_parser(topic_template):
+    '''return a function that takes a topic generated with *topic_template*
+    and returns a (client id, stat name, suffix) tuple or None if it doesn't
+    match, suffix is "" for stats and "diff", "stream", "wire", "backfill"
+    or "keyframe" for the topics that end with it'''
+    pattern = re.escape(topic_template).replace(re.escape("%s"), "([^/]+)")
+    regex = re.compile("^" + pattern + "(?:/([^/]+))?$")
+
+    def parse(topic):
+        '''parse *topic*'''
+        match = regex.match(topic)
+
+        if match is None:
+            return None
+
+        client_id, name, suffix = match.groups()
+        return client_id, name, suffix or ""
+
+    return parse
+
+class NetworkLoop(threading.Thread):
+    '''runs the network loop of a mosquitto client on its own thread so
+    acks, keepalives and reconnects don't wait for the next check
+
+    messages are queued by publish and sent from this thread with at most
+    *max_inflight* of them not acknowledged, at most *max_queued* are kept
+    while disconnected (the oldest are dropped and the time range of their
+    stats is kept in missed), the connection is retried
+    every *retry* seconds, *subscriptions* are (topic, qos) tuples
+    subscribed on each connect'''
+
+    def __init__(self, client, host, port, keepalive=60, max_inflight=20,
+            max_queued=1000, retry=RETRY, subscriptions=()):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.retry = retry
+        self.subscriptions = list(subscriptions)
+
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        # mid -> monotonic time it was published of the messages not
+        # acknowledged yet
+        self.inflight = {}
+        # called with the seconds between publishing a message and its ack
+        self.on_acked = None
+        self.connected = False
+        self.running = True
+
+        self.dropped = 0
+        self.reconnects = 0
+        # (first, last) timestamp of the stats of the dropped messages
+        self.missed = None
+
+        client.on_connect = self.on_connect
+        client.on_publish = self.on_publish
+
+    def publish(self, topic, payload, qos=1, retain=False, timestamp=None):
+        '''queue a message to be published from the network thread,
+        *timestamp* is the time of the stats in it'''
+        with self.lock:
+            if len(self.queue) >= self.max_queued:
+                dropped = self.queue.popleft()[4]
+                self.dropped += 1
+
+                if dropped is not None:
+                    if self.missed is None:
+                        self.missed = (dropped, dropped)
+                    else:
+                        self.missed = (min(self.missed[0], dropped),
+                                max(self.missed[1], dropped))
+
+            self.queue.append((topic, payload, qos, retain, timestamp))
+
+    def take_missed(self):
+        '''return the (first, last) timestamp of the stats dropped and
+        forget them, None if none were dropped or if not connected'''
+        with self.lock:
+            if not self.connected:
+                return None
+
+            missed, self.missed = self.missed, None
+            return missed
+
+    def on_connect(self, _mosq, code):
+        '''subscribe again after each connect'''
+        if code != 0:
+            print "error connecting to broker:", code
+            return
+
+        for topic, qos in self.subscriptions:
+            self.client.subscribe(topic, qos)
+
+    def on_publish(self, _mosq, mid):
+        '''a message was acknowledged'''
+        published = self.inflight.pop(mid, None)
+
+        if published is not None and self.on_acked is not None:
+            self.on_acked(transport.monotonic() - published)
+
+    def _connect(self):
+        '''connect to the broker, return True if it worked'''
+        try:
+            code = self.client.connect(self.host, self.port, self.keepalive)
+        except (socket.error, IOError) as error:
+            print "error connecting to broker:", error
+            return False
+
+        if code:
+            print "error connecting to broker:", code
+            return False
+
+        # the ones not acknowledged before are not waited for anymore
+        self.inflight.clear()
+        self.connected = True
+        return True
+
+    def _publish_queued(self):
+        '''publish queued messages while the inflight window has room'''
+        while len(self.inflight) < self.max_inflight:
+            with self.lock:
+                if not self.queue:
+                    return
+
+                message = self.queue.popleft()
+
+            topic, payload, qos, retain, _timestamp = message
+            result = self.client.publish(topic, payload, qos, retain)
+
+            # newer clients return (code, mid), older ones only the code
+            if isinstance(result, tuple):
+                code, mid = result
+            else:
+                code, mid = result, None
+
+            if code:
+                with self.lock:
+                    self.queue.appendleft(message)
+
+                self.connected = False
+                return
+
+            if qos > 0 and mid is not None:
+                self.inflight[mid] = transport.monotonic()
+
+    def run(self):
+        '''connect and run the network loop until stopped, when stopped
+        the queued messages are sent if connected'''
+        while self.running or (self.connected and
+                (self.queue or self.inflight)):
+            if not self.connected:
+                if not self.running:
+                    break
+                elif not self._connect():
+                    time.sleep(self.retry)
+                    continue
+
+            self._publish_queued()
+
+            if self.client.loop(LOOP_TIMEOUT):
+                print "connection to broker lost, reconnecting"
+                self.connected = False
+                self.reconnects += 1
+
+        self.client.disconnect()
+
+    def stop(self, timeout=5.0):
+        '''stop the loop, waiting at most *timeout* seconds for the queued
+        messages to be sent'''
+        self.running = False
+        self.join(timeout)
+
 class Checker(transport.Checker):
-    '''checker class that sends the stats to a mqtt broker'''
+    '''checker class that sends the stats to a mqtt broker
+
+    with the "stream" encoding each stat is sent to the topic + "/stream" as
+    keyframes and deltas (see the stream module), with the "wire" encoding
+    to the topic + "/wire" as schema based binary frames (see the wire
+    module), in both cases deltas are not sent and consumers can ask for a
+    keyframe (or the schema) publishing to topic + "/keyframe"
+
+    with the "bson" encoding each stat is sent to the topic as is and its
+    delta to topic + "/diff", with *sample_time* they are sent as
+    {"timestamp": time it was sampled, "elapsed": seconds since the previous
+    sample, "stats": stats} and with "diff" instead of "stats" for deltas,
+    consumers older than this one only read the former
+
+    with *envelope* the stats of each check are sent in one message to the
+    ENVELOPE topic as {"timestamp": time of the latest sample, "stats":
+    {name: stats}, "diff": {name: delta}, "times": {name: time it was
+    sampled}, "elapsed": {name: seconds since the previous sample},
+    "intervals": {name: seconds between checks}}
+
+    with a history, when messages are dropped while disconnected the stats
+    of that time range are sent again from the history once connected to
+    topic + "/backfill" as {"timestamp": ..., "stats": stats}'''
 
     def __init__(self, client_id, host="localhost", port=1883,
-            topic_template="/ef/machine/%s/stats/%s", keepalive=60):
-        transport.Checker.__init__(self)
+            topic_template="/ef/machine/%s/stats/%s", keepalive=60,
+            encoding="bson", keyframe_interval=60, qos=1, retain=False,
+            envelope=False, max_inflight=20, sample_time=False, **kwargs):
+        transport.Checker.__init__(self, **kwargs)
 
         self.host = host
         self.port = port
         self.topic_template = topic_template
         self.client_id = client_id
+        self.encoding = encoding
+        self.keyframe_interval = keyframe_interval
+        self.qos = qos
+        self.retain = retain
+        self.envelope = {} if envelope else None
+        self.sample_time = sample_time
+        self.encoders = {}
+        self.parse_topic = topic_parser(topic_template)
+
+        subscriptions = []
+        if encoding in ENCODERS:
+            subscriptions.append((topic_template % (client_id, "+") +
+                    "/keyframe", 1))
+
         self.client = mosquitto.Mosquitto(client_id + "client")
-        self.client.connect(host, port, keepalive)
+        self.client.on_message = self.on_message
+        self.network = NetworkLoop(self.client, host, port, keepalive,
+                max_inflight, subscriptions=subscriptions)
+
+        if self.selfstats is not None:
+            self.network.on_acked = lambda seconds: self.measure("send",
+                    seconds)
+
+        self.network.start()
+
+    def on_message(self, _mosq, msg):
+        '''handle keyframe requests'''
+        parsed = self.parse_topic(msg.topic)
+
+        if parsed is not None and parsed[2] == "keyframe" and \
+                parsed[1] in self.encoders:
+            self.encoders[parsed[1]].request_keyframe()
+
+    def publish(self, name, data, suffix="", timestamp=None):
+        '''encode *data* and publish it to the topic of stat *name*, sampled
+        at *timestamp* (the last sample of *name* if None)'''
+        topic = self.topic_template % (self.client_id, name)
+        start = transport.monotonic()
+
+        if self.encoding in ENCODERS:
+            encoder = self.encoders.get(name)
+
+            if encoder is None:
+                encoder = self.encoders[name] = ENCODERS[self.encoding](
+                        self.keyframe_interval)
+
+            payload = encoder.encode(data)
+            topic += "/" + self.encoding
+        else:
+            payload = bson.BSON.encode(data)
+            topic += suffix
+
+        self.measure("encode." + name, transport.monotonic() - start)
+        self.measure("size." + name, len(payload))
+
+        if timestamp is None:
+            timestamp = self.sample_times.get(name, time.time())
+
+        self.network.publish(topic, payload, self.qos, self.retain,
+                timestamp)
+
+    def backfill(self, start, end):
+        '''send the stats between *start* and *end* from the history'''
+        for name, _function, _delta in self.collectors:
+            if name in self.blacklist:
+                continue
+
+            topic = self.topic_template % (self.client_id, name) + \
+                    "/backfill"
+
+            for timestamp, data in self.history.readings(name, start, end):
+                payload = bson.BSON.encode({"timestamp": timestamp,
+                    "stats": data})
+                self.network.publish(topic, payload, self.qos, False,
+                        timestamp)
+
+    def message(self, name, key, data):
+        '''return the bson message with *data* of stat *name*, under *key*
+        with the time it was sampled and the seconds since the previous
+        sample if sample_time is set'''
+        if not self.sample_time:
+            return data
+
+        return {"timestamp": self.sample_times.get(name, time.time()),
+                "elapsed": self.sample_elapsed.get(name), key: data}
 
     def send_stats(self, name, data):
         '''send stats somewhere'''
-        topic = self.topic_template % (self.client_id, name)
-        bson_data = bson.BSON.encode(data)
-        self.client.publish(topic, bson_data, 1)
+        if self.envelope is not None:
+            self.envelope.setdefault("stats", {})[name] = data
+        elif self.encoding in ENCODERS:
+            self.publish(name, data)
+        else:
+            self.publish(name, self.message(name, "stats", data))
 
     def send_delta_stats(self, name, data):
         '''send delta stats somewhere'''
-        topic = self.topic_template % (self.client_id, name) + "/diff"
-        bson_data = bson.BSON.encode(data)
-        self.client.publish(topic, bson_data, 1)
+        if self.encoding in ENCODERS:
+            # the consumer rebuilds the readings, deltas are redundant
+            return
+
+        if self.envelope is not None:
+            self.envelope.setdefault("diff", {})[name] = data
+        else:
+            self.publish(name, self.message(name, "diff", data), "/diff")
 
     def check(self):
-        '''check for stats'''
+        '''check for stats, with envelope send them in one message'''
         transport.Checker.check(self)
-        self.client.loop(-1)
+
+        if self.envelope:
+            names = set(self.envelope.get("stats", {})) | \
+                    set(self.envelope.get("diff", {}))
+            times = dict((name, self.sample_times[name]) for name in names
+                    if name in self.sample_times)
+            self.envelope["timestamp"] = max(times.values()) if times \
+                    else time.time()
+            self.envelope["times"] = times
+            self.envelope["elapsed"] = dict((name, self.sample_elapsed[name])
+                    for name in names if name in self.sample_elapsed)
+            self.envelope["intervals"] = dict((name, self.interval(name))
+                    for name in self.envelope.get("stats", {}))
+            self.publish(ENVELOPE, self.envelope,
+                    timestamp=self.envelope["timestamp"])
+            self.envelope = {}
+
+        if self.history is not None:
+            missed = self.network.take_missed()
+
+            if missed is not None:
+                self.backfill(*missed)
+
+    def self_gauges(self):
+        '''return the queue depths of the network loop'''
+        network = self.network
+
+        return {
+            "queue": len(network.queue),
+            "inflight": len(network.inflight),
+            "dropped": network.dropped,
+            "reconnects": network.reconnects
+        }
 
     def on_exit(self):
         '''cleanup resources'''
-        self.client.disconnect()
+        self.network.stop()
 
 def base_option_parser():
     '''create a parser for the basic options and return it, used to extend
@@ -64,16 +414,56 @@ def base_option_parser():
         metavar="PASSWORD")
 
     parser.add_option("-C", "--checkinterval", dest="checkinterval",
-            default=10, type="int",
+            default=10, type="float",
             help="check for new values every SEC seconds", metavar="SEC")
 
+    parser.add_option("-t", "--topic", dest="topic",
+        default="/ef/machine/%s/stats/%s", help="publish to topics made "
+        "from TEMPLATE with the client id and the stat name",
+        metavar="TEMPLATE")
+    parser.add_option("--qos", dest="qos", default=1, type="choice",
+        choices=("0", "1", "2"), help="publish with QOS 0, 1 or 2",
+        metavar="QOS")
+    parser.add_option("--retain", action="store_true", dest="retain",
+        default=False, help="ask the broker to retain the last message of "
+        "each topic")
+    parser.add_option("-e", "--envelope", action="store_true",
+        dest="envelope", default=False, help="send the stats of each check "
+        "in one message to the \"%s\" stat topic" % ENVELOPE)
+    parser.add_option("--sampletime", action="store_true",
+        dest="sampletime", default=False, help="send each stat with the "
+        "time it was sampled and the seconds since the previous sample, "
+        "older listeners can't read them")
+    parser.add_option("--maxinflight", dest="maxinflight", default=20,
+        type="int", help="keep at most COUNT messages waiting for an ack",
+        metavar="COUNT")
+    parser.add_option("--keepalive", dest="keepalive", default=60,
+        type="int", help="ping the broker every SEC seconds",
+        metavar="SEC")
+
+    parser.add_option("-f", "--encoding", dest="encoding", default="bson",
+        choices=ENCODINGS, help="send stats as bson documents, as a stream "
+        "of keyframes and deltas or as schema based binary frames",
+        metavar="ENCODING")
+    parser.add_option("-k", "--keyframeinterval", dest="keyframeinterval",
+        default=60, type="int", help="with the stream or wire encodings send "
+        "a keyframe (or the schema) every COUNT readings", metavar="COUNT")
+
+    transport.add_checker_options(parser)
+
     return parser
+
 def main():
     '''main function if this module is called, starts a mqtt listener'''
     parser = base_option_parser()
     opts, _args = parser.parse_args()
 
-    checker = Checker(opts.clientid, opts.host, opts.port)
+    checker = Checker(opts.clientid, opts.host, opts.port, opts.topic,
+            opts.keepalive, encoding=opts.encoding,
+            keyframe_interval=opts.keyframeinterval, qos=int(opts.qos),
+            retain=opts.retain, envelope=opts.envelope,
+            max_inflight=opts.maxinflight, sample_time=opts.sampletime,
+            **transport.checker_options(opts))
     print "run 'python mqtt_listener.py", opts.clientid, "' to see the output"
     transport.main_loop(checker, opts.checkinterval)
 
@@ -0,0 +1,134 @@
+'''read the stats once and print them, for cron jobs and health checks
+
+only the modules the selected collectors and output format need are
+imported: with the procfs backend (the default where there's a /proc)
+psutil is not, json, bson and the platform module only when asked for,
+the transports never, with --delta two readings are taken SEC seconds
+apart and the delta is printed too, --platform adds the platform info
+cached on disk (see sistats.get_cached_platform_info)
+
+    python oneshot.py -c cpu,mem -f json
+    python sistats.py --once -c net -d 0.5'''
+import sys
+import time
+
+from optparse import OptionParser
+
+import sistats
+
+FORMATS = ("json", "text", "bson")
+
+DEFAULT_COLLECTORS = "cpu,mem,net,disk,fs"
+
+def read(collectors):
+    '''return a dict from collector name to its reading for the (name,
+    function, delta calculator) *collectors*'''
+    return dict((name, function()) for name, function, _delta in collectors)
+
+def _to_dicts(readings):
+    '''return *readings* with the snapshots turned into dicts'''
+    import snapshot
+
+    return dict((name, snapshot.to_dict(data))
+            for name, data in readings.items())
+
+def collect(names, backend="procfs", delta=None):
+    '''return the result for collectors *names* read with *backend*, a dict
+    with the timestamp and the stats and, if *delta* is not None, the diff
+    of two readings taken *delta* seconds apart and the seconds between
+    them'''
+    collectors = []
+
+    for name in names:
+        function, delta_calculator = sistats.get_collector(name, backend)
+        collectors.append((name, function, delta_calculator))
+
+    result = {}
+
+    if delta is not None:
+        start = time.time()
+        old = read(collectors)
+        time.sleep(delta)
+        result["elapsed"] = time.time() - start
+
+    stats = read(collectors)
+    result["timestamp"] = time.time()
+
+    if delta is not None:
+        result["diff"] = dict((name, delta_calculator(old[name],
+            stats[name])) for name, _function, delta_calculator in collectors
+            if delta_calculator is not None)
+
+    result["stats"] = stats
+
+    if backend == "snapshot":
+        for key in ("stats", "diff"):
+            if key in result:
+                result[key] = _to_dicts(result[key])
+
+    return result
+
+def write(result, output_format, out=sys.stdout):
+    '''write *result* to *out* in *output_format*'''
+    if output_format == "json":
+        import json
+        json.dump(result, out, sort_keys=True)
+        out.write("\n")
+    elif output_format == "bson":
+        import bson
+        out.write(bson.BSON.encode(result))
+    else:
+        if "platform" in result:
+            sistats.pretty_print("Platform", result["platform"])
+
+        for name, data in sorted(result["stats"].items()):
+            sistats.pretty_print(name, data)
+
+        for name, data in sorted(result.get("diff", {}).items()):
+            sistats.pretty_print("%s diff over %.3f seconds" % (name,
+                result["elapsed"]), data)
+
+def main(args=None):
+    '''read the stats once and print them'''
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-c", "--collectors", dest="collectors",
+        default=DEFAULT_COLLECTORS, help="read the collectors in NAMES, "
+        "like cpu,mem (%s)" % ", ".join(sorted(sistats.COLLECTORS)),
+        metavar="NAMES")
+    parser.add_option("-f", "--format", dest="format", default="json",
+        choices=FORMATS, help="print the stats as json, text or bson",
+        metavar="FORMAT")
+    parser.add_option("-B", "--backend", dest="backend", default="procfs",
+        choices=sistats.BACKENDS, help="read the stats with BACKEND (psutil, "
+        "procfs or snapshot), collectors that can't be read with it use "
+        "psutil", metavar="BACKEND")
+    parser.add_option("-d", "--delta", dest="delta", default=None,
+        type="float", help="take two readings SEC seconds apart and print "
+        "their delta too", metavar="SEC")
+    parser.add_option("-p", "--platform", action="store_true",
+        dest="platform", default=False, help="add the platform info")
+    parser.add_option("--platformcache", dest="platform_cache",
+        default=sistats.PLATFORM_CACHE, help="keep the platform info in "
+        "FILE, empty to not cache it", metavar="FILE")
+    opts, _args = parser.parse_args(args)
+
+    names = [name.strip() for name in opts.collectors.split(",")
+            if name.strip()]
+
+    for name in names:
+        if name not in sistats.COLLECTORS:
+            parser.error("unknown collector %s" % name)
+
+    result = collect(names, opts.backend, opts.delta)
+
+    if opts.platform:
+        if opts.platform_cache:
+            result["platform"] = sistats.get_cached_platform_info(
+                    opts.platform_cache)
+        else:
+            result["platform"] = sistats.get_platform_info()
+
+    write(result, opts.format)
+
+if __name__ == "__main__":
+    main()
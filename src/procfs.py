@@ -0,0 +1,227 @@
+'''module to get system stats straight from /proc on linux
+
+the files are opened once and re-read from the start on every call, the
+content is parsed directly into the same shapes returned by the psutil based
+functions in the sistats module'''
+import os
+
+PROC = "/proc"
+
+# /proc/stat values are in USER_HZ ticks, psutil reports seconds
+if hasattr(os, "sysconf"):
+    CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+else:
+    CLOCK_TICKS = 100.0
+
+# /proc/diskstats sectors are always 512 bytes, no matter the device
+SECTOR_SIZE = 512
+
+def read_fd(fd, bufsize=4096):
+    '''return the content of *fd* from the current position to the end,
+    reads until the end since seq_file files (/proc/net/dev,
+    /proc/diskstats...) return about a page per read no matter the size
+    asked'''
+    chunks = []
+
+    while True:
+        chunk = os.read(fd, bufsize)
+
+        if not chunk:
+            return "".join(chunks)
+
+        chunks.append(chunk)
+
+class ProcFile(object):
+    '''a file under /proc that is kept open and re-read on demand'''
+
+    def __init__(self, path, bufsize=4096):
+        self.path = path
+        self.bufsize = bufsize
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        '''return the current content of the file (see read_fd), the buffer
+        size is only a hint that grows to the size of the file'''
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        content = read_fd(self.fd, self.bufsize)
+
+        while self.bufsize < len(content):
+            self.bufsize *= 2
+
+        return content
+
+    def close(self):
+        '''close the file descriptor'''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class ProcReader(object):
+    '''keeps ProcFile instances for the files under *root*, files are
+    opened on first read'''
+
+    def __init__(self, root=PROC):
+        self.root = root
+        self.files = {}
+
+    def path(self, name):
+        '''return the full path for file *name*'''
+        return os.path.join(self.root, name)
+
+    def read(self, name):
+        '''return the content of file *name*'''
+        procfile = self.files.get(name)
+
+        if procfile is None:
+            procfile = self.files[name] = ProcFile(self.path(name))
+
+        return procfile.read()
+
+    def close(self):
+        '''close all open files'''
+        for procfile in self.files.values():
+            procfile.close()
+
+        self.files = {}
+
+def parse_cpu_stats(content, ticks=CLOCK_TICKS):
+    '''parse the content of /proc/stat into the get_cpu_stats format'''
+    cpu = None
+    percpu = []
+
+    for line in content.splitlines():
+        if not line.startswith("cpu"):
+            # cpu lines always come first
+            break
+
+        fields = line.split()
+        stats = {
+            'kernel': int(fields[3]) / ticks,
+            'user': int(fields[1]) / ticks,
+            'idle': int(fields[4]) / ticks,
+            'nice': int(fields[2]) / ticks
+        }
+
+        if fields[0] == "cpu":
+            cpu = stats
+        else:
+            percpu.append(stats)
+
+    return {
+        "global": cpu,
+        "cpu": percpu
+    }
+
+def parse_mem_stats(content):
+    '''parse the content of /proc/meminfo into the get_mem_stats format'''
+    values = {}
+
+    for line in content.splitlines():
+        name, value = line.split(":", 1)
+        # values are in kB
+        values[name] = int(value.split()[0]) * 1024
+
+    cachemem = values.get("Cached", 0) + values.get("Buffers", 0)
+
+    mem = _usage(values["MemTotal"], values["MemFree"])
+    mem['cache'] = cachemem
+
+    memswap = _usage(values.get("SwapTotal", 0), values.get("SwapFree", 0))
+
+    return {
+        "cache": cachemem,
+        "mem": mem,
+        "swap": memswap
+    }
+
+def _usage(total, free):
+    '''return a usage dict like the ones from psutil'''
+    used = total - free
+
+    if total:
+        percent = round(used * 100.0 / total, 1)
+    else:
+        percent = 0.0
+
+    return {
+        'total': total,
+        'used': used,
+        'free': free,
+        'percent': percent
+    }
+
+def parse_net_stats(content):
+    '''parse the content of /proc/net/dev into the get_net_stats format'''
+    network = {}
+
+    # the first two lines are headers
+    for line in content.splitlines()[2:]:
+        name, data = line.split(":", 1)
+        fields = data.split()
+
+        network[name.strip()] = {
+            'rb': int(fields[0]),
+            'tb': int(fields[8]),
+            'rc': int(fields[1]),
+            'tc': int(fields[9])
+        }
+
+    return network
+
+def parse_disk_stats(content):
+    '''parse the content of /proc/diskstats into the get_disk_stats format'''
+    diskios = {}
+
+    for line in content.splitlines():
+        fields = line.split()
+
+        if len(fields) < 14:
+            continue
+
+        diskios[fields[2]] = {
+            'rb': int(fields[5]) * SECTOR_SIZE,
+            'wb': int(fields[9]) * SECTOR_SIZE,
+            'rc': int(fields[3]),
+            'wc': int(fields[7]),
+            'rt': int(fields[6]),
+            'wt': int(fields[10])
+        }
+
+    return diskios
+
+# file name and parser for each collector
+SOURCES = {
+    "cpu": ("stat", parse_cpu_stats),
+    "mem": ("meminfo", parse_mem_stats),
+    "net": (os.path.join("net", "dev"), parse_net_stats),
+    "disk": ("diskstats", parse_disk_stats)
+}
+
+READER = ProcReader()
+
+def available(name, reader=READER):
+    '''return True if collector *name* can be read from /proc'''
+    return name in SOURCES and os.path.exists(reader.path(SOURCES[name][0]))
+
+def get_cpu_stats(reader=READER):
+    '''return cpu stats'''
+    return parse_cpu_stats(reader.read("stat"))
+
+def get_mem_stats(reader=READER):
+    '''return mem stats'''
+    return parse_mem_stats(reader.read("meminfo"))
+
+def get_net_stats(reader=READER):
+    '''return network stats'''
+    return parse_net_stats(reader.read(SOURCES["net"][0]))
+
+def get_disk_stats(reader=READER):
+    '''return diskio stats'''
+    return parse_disk_stats(reader.read("diskstats"))
+
+COLLECTORS = {
+    "cpu": get_cpu_stats,
+    "mem": get_mem_stats,
+    "net": get_net_stats,
+    "disk": get_disk_stats
+}
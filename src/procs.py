@@ -0,0 +1,221 @@
+'''top processes by cpu, memory and io read from /proc on linux
+
+every scan lists the processes and reads /proc/<pid>/stat, the name,
+command line and user of a process are read once and kept while the pid has
+the same start time, /proc/<pid>/io is only read again for processes that
+used cpu since the last scan since a process that didn't run can't have done
+io, the reading has the *count* processes with the most cpu and io since the
+last scan (since they started for new processes and on the first scan) and
+the most resident memory'''
+import os
+import heapq
+
+import procfs
+
+# processes reported for each ranking
+TOP = 10
+
+# bytes of the command line kept
+CMDLINE_SIZE = 256
+
+if hasattr(os, "sysconf"):
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+else:
+    PAGE_SIZE = 4096
+
+def _read(path, size=4096):
+    '''return the content of *path*, None if it can't be read'''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        return os.read(fd, size)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+def parse_stat(content):
+    '''return (name, start, cpu seconds, rss bytes) from the content of
+    /proc/<pid>/stat'''
+    # the name is between parenthesis and can have spaces and parenthesis
+    end = content.rfind(")")
+    name = content[content.find("(") + 1:end]
+    fields = content[end + 2:].split()
+
+    cpu = (int(fields[11]) + int(fields[12])) / procfs.CLOCK_TICKS
+    return name, int(fields[19]), cpu, int(fields[21]) * PAGE_SIZE
+
+def parse_io(content):
+    '''return (read bytes, written bytes) from the content of
+    /proc/<pid>/io'''
+    values = {}
+
+    for line in content.splitlines():
+        key, _sep, value = line.partition(":")
+        values[key] = value
+
+    return int(values["read_bytes"]), int(values["write_bytes"])
+
+class Process(object):
+    '''the static fields and the counters of a process'''
+
+    __slots__ = ("pid", "start", "name", "cmdline", "uid", "cpu", "rss",
+            "read_bytes", "write_bytes", "cpu_delta", "io_delta", "seen")
+
+    def __init__(self, pid, start, name):
+        self.pid = pid
+        self.start = start
+        self.name = name
+        self.cmdline = ""
+        self.uid = -1
+        self.cpu = 0.0
+        self.rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.cpu_delta = 0.0
+        self.io_delta = 0
+        self.seen = 0
+
+    def to_dict(self):
+        '''return a dict representation'''
+        return {
+            "name": self.name,
+            "cmdline": self.cmdline,
+            "uid": self.uid,
+            "start": self.start,
+            "cpu": self.cpu,
+            "rss": self.rss,
+            "rb": self.read_bytes,
+            "wb": self.write_bytes
+        }
+
+class ProcessTable(object):
+    '''the processes under *root*, kept between scans, *io* reads the io
+    counters (all of them are only readable by root)'''
+
+    def __init__(self, root=procfs.PROC, count=TOP, io=True):
+        self.root = root
+        self.count = count
+        self.io = io
+        # pid -> Process
+        self.processes = {}
+        self.scans = 0
+
+    def _read_static(self, process, path):
+        '''read the fields that don't change of a new process'''
+        cmdline = _read(os.path.join(path, "cmdline"), CMDLINE_SIZE)
+
+        if cmdline:
+            process.cmdline = cmdline.rstrip("\0").replace("\0", " ")
+
+        try:
+            process.uid = os.stat(path).st_uid
+        except OSError:
+            pass
+
+    def scan(self):
+        '''read the counters of all the processes'''
+        self.scans += 1
+        scan = self.scans
+        processes = self.processes
+
+        for name in os.listdir(self.root):
+            if not name.isdigit():
+                continue
+
+            path = os.path.join(self.root, name)
+            content = _read(os.path.join(path, "stat"))
+
+            if not content:
+                continue
+
+            proc_name, start, cpu, rss = parse_stat(content)
+            process = processes.get(name)
+
+            if process is None or process.start != start:
+                process = processes[name] = Process(int(name), start,
+                        proc_name)
+                self._read_static(process, path)
+                new = True
+            else:
+                new = False
+
+            # new processes count what they used since they started
+            process.cpu_delta = cpu - process.cpu
+            process.cpu = cpu
+            process.rss = rss
+            process.io_delta = 0
+            process.seen = scan
+
+            if self.io and (new or process.cpu_delta > 0):
+                content = _read(os.path.join(path, "io"))
+
+                if content:
+                    read_bytes, write_bytes = parse_io(content)
+
+                    process.io_delta = read_bytes - process.read_bytes + \
+                            write_bytes - process.write_bytes
+
+                    process.read_bytes = read_bytes
+                    process.write_bytes = write_bytes
+
+        for pid in [pid for pid, process in processes.items()
+                if process.seen != scan]:
+            del processes[pid]
+
+    def top(self, key, count=None):
+        '''return the *count* processes with the highest *key*, processes
+        where it's 0 are left out'''
+        if count is None:
+            count = self.count
+
+        return [process for process in heapq.nlargest(count,
+            self.processes.itervalues(), key=key) if key(process) > 0]
+
+    def get_stats(self):
+        '''scan and return the top processes by cpu, rss and io as a dict
+        from pid to the process fields'''
+        self.scan()
+        stats = {}
+
+        for key in (_by_cpu, _by_rss, _by_io):
+            for process in self.top(key):
+                stats[str(process.pid)] = process.to_dict()
+
+        return stats
+
+def _by_cpu(process):
+    '''cpu used since the last scan'''
+    return process.cpu_delta
+
+def _by_rss(process):
+    '''resident memory'''
+    return process.rss
+
+def _by_io(process):
+    '''bytes read and written since the last scan'''
+    return process.io_delta
+
+def get_stats_delta(old, new):
+    '''return the delta between two readings from ProcessTable.get_stats,
+    only processes in both (same pid and start time) are included'''
+    delta = {}
+
+    for pid, process in new.items():
+        previous = old.get(pid)
+
+        if previous is None or previous["start"] != process["start"]:
+            continue
+
+        delta[pid] = {
+            "name": process["name"],
+            "cpu": process["cpu"] - previous["cpu"],
+            "rss": process["rss"] - previous["rss"],
+            "rb": process["rb"] - previous["rb"],
+            "wb": process["wb"] - previous["wb"]
+        }
+
+    return delta
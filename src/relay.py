@@ -0,0 +1,276 @@
+'''relay that forwards the stats of many agents upstream in bulk
+
+agents send their events to the relay instead of the central endpoint,
+with rest_transport (same json Event format, one event or a list per
+request, gzipped or not) and, with --mqtt, by publishing to a broker with
+mqtt_transport, the relay subscribes to all the hosts with a
+mqtt_listener.FleetConsumer and turns the messages into events
+
+the events are coalesced by time window: they are posted upstream as lists
+of up to --batchsize events when a batch is full or --linger seconds after
+its first event, gzipped and over a pool of --concurrency keep-alive
+connections, the relay is a rest_transport.Checker that doesn't collect
+so the upstream options (queue, spool, login...) are the same
+
+back-pressure: with --queuesize the relay keeps at most that many batches
+waiting to be posted, while the queue is full agents get a 503 and spool or
+drop the events as configured (see rest_transport --spool) and the mqtt
+messages wait in the consumer partitions, the oldest are dropped past
+--maxpending'''
+import json
+import zlib
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import transport
+import rest_transport
+
+# seconds agents are asked to wait when the queue is full
+RETRY_AFTER = 5
+
+class IngressHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''receives the events of the agents'''
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are separate writes
+    disable_nagle_algorithm = True
+
+    def reply(self, code, headers=()):
+        '''send an empty json response with status *code*'''
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write("{}")
+
+    def do_POST(self):
+        size = int(self.headers.getheader("content-length", 0))
+        body = self.rfile.read(size)
+        relay = self.server.relay
+
+        if self.path == relay.login_path:
+            # agents log in to the relay, it logs in upstream itself
+            self.reply(200)
+        elif self.path not in relay.paths:
+            self.reply(404)
+        elif relay.busy():
+            relay.count("rejected")
+            self.reply(503, [("Retry-After", str(RETRY_AFTER))])
+        else:
+            try:
+                if self.headers.getheader("content-encoding") == "gzip":
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+                relay.receive(json.loads(body))
+            except (ValueError, TypeError, KeyError, zlib.error) as error:
+                relay.count("invalid")
+                relay.log("invalid request from", self.client_address[0],
+                        error)
+                self.reply(400)
+            else:
+                self.reply(200)
+
+    def log_message(self, *args):
+        if self.server.relay.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+class IngressServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''http server for the events of the agents'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, relay):
+        BaseHTTPServer.HTTPServer.__init__(self, address, IngressHandler)
+        self.relay = relay
+
+class Relay(rest_transport.Checker):
+    '''a rest_transport.Checker that doesn't collect, it forwards the
+    events posted to *listen* (a (host, port) tuple) on *paths* and, if
+    *mqtt* is a (host, port) tuple, the stats published to that broker on
+    topics made from *mqtt_topic_template*, always in bulk mode'''
+
+    def __init__(self, client_id, username, password, login_ep, data_ep,
+            listen=("127.0.0.1", 8090), paths=("/api/event",),
+            login_path="/api/session", mqtt=None,
+            mqtt_topic_template="/ef/machine/%s/stats/%s", mqtt_workers=4,
+            max_pending=100000, queue_size=0, **kwargs):
+        kwargs["bulk"] = True
+        rest_transport.Checker.__init__(self, client_id, username, password,
+                login_ep, data_ep, queue_size=queue_size, **kwargs)
+        # only the agent metrics (--self) are sent on check
+        self.collectors = []
+
+        self.queue_size = queue_size
+        self.paths = set(paths)
+        self.login_path = login_path
+
+        self.counters_lock = threading.Lock()
+        self.received = 0
+        self.rejected = 0
+        self.invalid = 0
+
+        self.server = IngressServer(listen, self)
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(
+                target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.consumer = None
+        self.quit = False
+
+        if mqtt is not None:
+            import mqtt_listener
+
+            self.consumer = mqtt_listener.FleetConsumer(client_id, mqtt[0],
+                    mqtt[1], mqtt_topic_template, sinks=[self.on_stats],
+                    workers=mqtt_workers, max_pending=max_pending)
+            self.consumer_thread = threading.Thread(target=self._loop)
+            self.consumer_thread.daemon = True
+            self.consumer_thread.start()
+
+    def _loop(self):
+        '''run the network loop of the mqtt consumer'''
+        while not self.quit:
+            self.consumer.loop(1.0)
+
+    def count(self, name, value=1):
+        '''add *value* to counter *name*'''
+        with self.counters_lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def busy(self):
+        '''return True if the upstream queue is full'''
+        if self.queue_size <= 0:
+            return False
+
+        return self.queue_stats()["depth"] >= self.queue_size
+
+    def receive(self, events):
+        '''forward the json *events* (an event or a list of them) of an
+        agent, none of them if one is not valid'''
+        if isinstance(events, dict):
+            events = [events]
+
+        for event in events:
+            if not isinstance(event, dict) or "value" not in event or \
+                    not isinstance(event.get("channel"), basestring):
+                raise ValueError("not an event: %r" % (event,))
+
+        for event in events:
+            self.send(event["channel"], event["value"],
+                    event.get("timestamp"), event.get("elapsed"),
+                    event.get("interval"))
+
+        self.count("received", len(events))
+
+    def on_stats(self, host, name, is_diff, data, timestamp):
+        '''FleetConsumer sink, forwards the stats of an mqtt message'''
+        if host is None:
+            return
+
+        channel = self.topic_template % (host, name)
+
+        if is_diff:
+            channel += ".diff"
+
+        self.send(channel, data, timestamp)
+        self.count("received")
+
+    def relay_stats(self):
+        '''return the relay counters'''
+        stats = {
+            "received": self.received,
+            "rejected": self.rejected,
+            "invalid": self.invalid
+        }
+
+        if self.consumer is not None:
+            stats.update(("mqtt_" + name, value)
+                    for name, value in self.consumer.stats().items())
+
+        return stats
+
+    def self_gauges(self):
+        '''return the queue and relay counters'''
+        gauges = rest_transport.Checker.self_gauges(self)
+        gauges.update(self.relay_stats())
+        return gauges
+
+    def check(self):
+        '''send the agent metrics if due, batches are sent when they are
+        full or old enough, not on check'''
+        transport.Checker.check(self)
+        self.log("relay", self.relay_stats(), "queue", self.queue_stats())
+
+    def on_exit(self):
+        self.quit = True
+        self.server.shutdown()
+        self.server.server_close()
+        rest_transport.Checker.on_exit(self)
+
+def parse_address(value, default_port):
+    '''return a (host, port) tuple for a "host:port" or "host" *value*'''
+    host, _sep, port = value.rpartition(":")
+
+    if not host:
+        return value, default_port
+
+    return host, int(port)
+
+def main():
+    '''main function if this module is called, starts a relay'''
+    parser = rest_transport.base_option_parser()
+    parser.add_option("-L", "--listen", dest="listen",
+        default="127.0.0.1:8090", help="receive the events of the agents on "
+        "ADDRESS (host:port)", metavar="ADDRESS")
+    parser.add_option("-m", "--mqtt", dest="mqtt", default=None,
+        help="forward the stats published to the broker at ADDRESS "
+        "(host:port) too", metavar="ADDRESS")
+    parser.add_option("--mqtttopic", dest="mqtttopic",
+        default="/ef/machine/%s/stats/%s", help="with --mqtt, the topic "
+        "TEMPLATE of the agents", metavar="TEMPLATE")
+    parser.add_option("--mqttworkers", dest="mqttworkers", default=4,
+        type="int", help="with --mqtt, decode messages on COUNT threads",
+        metavar="COUNT")
+    parser.add_option("--maxpending", dest="maxpending", default=100000,
+        type="int", help="with --mqtt, keep at most COUNT messages waiting "
+        "to be forwarded", metavar="COUNT")
+    # batches as big as the upstream takes, gzipped, agents wait when the
+    # queue is full
+    parser.set_defaults(batchsize=1000, gzip=True, queuesize=100,
+            queuepolicy="block", concurrency=4)
+    opts, _args = parser.parse_args()
+
+    login_ep = rest_transport.EndPoint(opts.host, opts.port,
+            opts.loginendpoint)
+    data_ep = rest_transport.EndPoint(opts.host, opts.port, opts.endpoint)
+
+    if opts.bulkendpoint is None:
+        bulk_ep = None
+    else:
+        bulk_ep = rest_transport.EndPoint(opts.host, opts.port,
+                opts.bulkendpoint)
+
+    relay = Relay(opts.clientid, opts.username, opts.password, login_ep,
+            data_ep, listen=parse_address(opts.listen, 8090),
+            paths=(opts.endpoint, opts.bulkendpoint or opts.endpoint),
+            login_path=opts.loginendpoint,
+            mqtt=parse_address(opts.mqtt, 1883) if opts.mqtt else None,
+            mqtt_topic_template=opts.mqtttopic,
+            mqtt_workers=opts.mqttworkers, max_pending=opts.maxpending,
+            verbose=opts.verbose, bulk_ep=bulk_ep,
+            batch_size=opts.batchsize, linger=opts.linger,
+            compress=opts.gzip, queue_size=opts.queuesize,
+            queue_policy=opts.queuepolicy, spool_dir=opts.spool,
+            replay_rate=opts.replayrate, concurrency=opts.concurrency,
+            request_timeout=opts.timeout, **transport.checker_options(opts))
+
+    transport.main_loop(relay, opts.checkinterval)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,28 @@
 '''REST transport for stats'''
 import time
 import json
+import zlib
+import base64
 import Queue
+import collections
 import pprint
 import requests
 import threading
 
+import wire
+import spool
+import stream
 import transport
 
 from optparse import OptionParser
 
+# encoders for the encodings that are not json, they are sent as base64 to
+# the topic + "." + encoding
+ENCODERS = {
+    "stream": stream.StreamEncoder,
+    "wire": wire.WireEncoder
+}
+
 class ThreadDoer(threading.Thread):
     QUIT_MSG = object()
 
@@ -20,6 +33,11 @@ class ThreadDoer(threading.Thread):
     def call(self, fun, *args, **kwargs):
         self._in.put((fun, args, kwargs))
 
+    def call_low(self, fun, *args, **kwargs):
+        '''like call, for calls that can be dropped first when the queue is
+        full'''
+        self.call(fun, *args, **kwargs)
+
     def quit(self):
         self._in.put(ThreadDoer.QUIT_MSG)
 
@@ -39,13 +57,251 @@ class ThreadDoer(threading.Thread):
 
         print "exiting doer"
 
+class BoundedQueue(object):
+    '''a queue of at most *maxsize* items, when it's full *policy* decides
+    what happens on put: "block" waits for room, "drop-oldest" evicts the
+    oldest item and "drop-diffs-first" evicts the oldest low priority item
+    or the oldest one if there are none, a *maxsize* of 0 means no limit'''
+
+    POLICIES = ("block", "drop-oldest", "drop-diffs-first")
+
+    def __init__(self, maxsize=1000, policy="drop-oldest"):
+        if policy not in BoundedQueue.POLICIES:
+            raise ValueError("unknown queue policy %r" % policy)
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.not_empty = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def _evict(self):
+        '''remove and return an item according to policy'''
+        if self.policy == "drop-diffs-first":
+            for i, (_item, low) in enumerate(self.items):
+                if low:
+                    evicted = self.items[i]
+                    del self.items[i]
+                    return evicted[0]
+
+        return self.items.popleft()[0]
+
+    def put(self, item, low=False, force=False):
+        '''add *item*, marked as low priority if *low*, *force* ignores
+        maxsize, return the evicted item or None'''
+        evicted = None
+
+        with self.not_empty:
+            if force or self.maxsize <= 0:
+                pass
+            elif self.policy == "block":
+                while len(self.items) >= self.maxsize:
+                    self.not_empty.wait()
+            elif len(self.items) >= self.maxsize:
+                evicted = self._evict()
+
+            self.items.append((item, low))
+            self.not_empty.notify_all()
+
+        return evicted
+
+    def get(self, timeout=None):
+        '''remove and return the oldest item, None if there's none after
+        *timeout* seconds'''
+        with self.not_empty:
+            if not self.items:
+                self.not_empty.wait(timeout)
+
+                if not self.items:
+                    return None
+
+            item = self.items.popleft()[0]
+            # wake up blocked producers
+            self.not_empty.notify_all()
+            return item
+
+class SpoolingDoer(ThreadDoer):
+    '''a ThreadDoer with a bounded queue, calls that don't fit in the queue
+    or fail are written to *spool* if given (dropped otherwise) and
+    replayed in order at *rate* calls per second while calls succeed
+
+    *encode* takes a (fun, args, kwargs) call and returns a json value or
+    None if it can't be spooled, *decode* does the opposite'''
+
+    def __init__(self, maxsize=1000, policy="drop-oldest", spool=None,
+            rate=10.0, encode=None, decode=None):
+        ThreadDoer.__init__(self)
+        self._in = BoundedQueue(maxsize, policy)
+        self.spool = spool
+        self.rate = rate
+        self.encode = encode
+        self.decode = decode
+
+        self.healthy = True
+        self.counters_lock = threading.Lock()
+        self.dropped = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.failed = 0
+
+    def _count(self, name):
+        '''increment counter *name*'''
+        with self.counters_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def call(self, fun, *args, **kwargs):
+        self._overflow(self._in.put((fun, args, kwargs)))
+
+    def call_low(self, fun, *args, **kwargs):
+        self._overflow(self._in.put((fun, args, kwargs), True))
+
+    def quit(self):
+        self._in.put(ThreadDoer.QUIT_MSG, force=True)
+
+    def _overflow(self, msg):
+        '''spool *msg* if possible, drop it otherwise'''
+        if msg is None:
+            return
+
+        record = None
+        if self.spool is not None and self.encode is not None:
+            record = self.encode(msg)
+
+        if record is None:
+            self._count("dropped")
+        else:
+            self.spool.append(record)
+            self._count("spooled")
+
+    def _call(self, msg):
+        '''do the call in *msg*, return True if it didn't fail'''
+        fun, args, kwargs = msg
+
+        try:
+            fun(*args, **kwargs)
+            return True
+        except Exception as error:
+            self._count("failed")
+            print "error calling", fun, args, kwargs, error
+            return False
+
+    def _replay(self):
+        '''do the oldest spooled call, if it fails it stays in the spool,
+        records that can't be decoded into a call are dropped'''
+        record = self.spool.peek()
+
+        if record is None:
+            return
+
+        try:
+            msg = self.decode(record)
+        except (ValueError, TypeError, KeyError, IndexError) as error:
+            print "dropping spooled record that can't be decoded:", error
+            self.spool.advance()
+            self._count("dropped")
+            return
+
+        self.healthy = self._call(msg)
+
+        if self.healthy:
+            self.spool.advance()
+            self._count("replayed")
+
+    def run(self):
+        self._consume(True)
+
+        if self.spool is not None:
+            self.spool.close()
+
+        print "exiting doer"
+
+    def _consume(self, replay):
+        '''do the queued calls until quit, replay spooled calls if
+        *replay*'''
+        next_replay = time.time()
+        interval = 1.0 / self.rate
+
+        while True:
+            can_replay = replay and self.healthy and self.spool is not None \
+                    and self.decode is not None and self.spool.size() > 0
+
+            if can_replay:
+                msg = self._in.get(max(0.0, next_replay - time.time()))
+            else:
+                msg = self._in.get()
+
+            if msg is ThreadDoer.QUIT_MSG:
+                break
+            elif msg is not None:
+                self.healthy = self._call(msg)
+
+                if not self.healthy:
+                    self._overflow(msg)
+
+            if can_replay and time.time() >= next_replay:
+                self._replay()
+                next_replay = time.time() + interval
+
+    def stats(self):
+        '''return a dict with the queue and spool counters'''
+        return {
+            "depth": len(self._in),
+            "dropped": self.dropped,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "failed": self.failed,
+            "spool_size": self.spool.size() if self.spool is not None else 0,
+            "spool_dropped": self.spool.dropped if self.spool is not None
+                else 0,
+            "spool_corrupt": self.spool.corrupt if self.spool is not None
+                else 0
+        }
+
+class ConcurrentDoer(SpoolingDoer):
+    '''a SpoolingDoer that does up to *concurrency* calls at the same time,
+    one slow call doesn't delay the rest, only the main thread replays the
+    spool so replayed calls keep their order'''
+
+    def __init__(self, concurrency=4, maxsize=0, policy="drop-oldest",
+            spool=None, rate=10.0, encode=None, decode=None):
+        SpoolingDoer.__init__(self, maxsize, policy, spool, rate, encode,
+                decode)
+        self.helpers = [threading.Thread(target=self._consume, args=(False,))
+                for _ in xrange(concurrency - 1)]
+
+    def start(self):
+        SpoolingDoer.start(self)
+
+        for helper in self.helpers:
+            helper.start()
+
+    def quit(self):
+        for _ in xrange(len(self.helpers) + 1):
+            SpoolingDoer.quit(self)
+
+    def join(self, timeout=None):
+        for helper in self.helpers:
+            helper.join(timeout)
+
+        SpoolingDoer.join(self, timeout)
+
 class Event(object):
     '''a class that holds message metadata and payload'''
 
-    def __init__(self, value, channel):
+    def __init__(self, value, channel, timestamp=None, elapsed=None,
+            interval=None):
 
         self.value = value
         self.channel = channel
+        # wall clock time of the reading and, for deltas, seconds between
+        # the two readings
+        self.timestamp = timestamp
+        self.elapsed = elapsed
+        # seconds between checks of the collector, longer than the one set
+        # while the agent is over its cpu budget
+        self.interval = interval
 
     def to_json(self):
         '''return a dict representation'''
@@ -56,16 +312,103 @@ class Event(object):
         '''return a string representation'''
         return pprint.pformat(self.to_json())
 
+def gzip_compress(data, level=6):
+    '''return *data* compressed in gzip format'''
+    # wbits 16 + 15 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class Batcher(object):
+    '''collects events and passes them to *send* in lists of at most *size*
+    events, a batch is sent when it's full, when flush is called or when its
+    first event is *linger* seconds old'''
+
+    def __init__(self, send, size=100, linger=1.0):
+        self.send = send
+        self.size = size
+        self.linger = linger
+        self.lock = threading.Lock()
+        self.events = []
+        self.timer = None
+
+    def _take(self):
+        '''return the current batch and start a new one, must be called with
+        the lock held'''
+        events = self.events
+        self.events = []
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        return events
+
+    def add(self, event):
+        '''add *event* to the current batch'''
+        events = None
+
+        with self.lock:
+            self.events.append(event)
+
+            if len(self.events) >= self.size:
+                events = self._take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.linger, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if events:
+            self.send(events)
+
+    def flush(self):
+        '''send the current batch if it's not empty'''
+        with self.lock:
+            events = self._take()
+
+        if events:
+            self.send(events)
+
 class Checker(transport.Checker):
     '''checker class that sends the stats to a mqtt broker'''
 
     def __init__(self, client_id, username, password, login_ep, data_ep,
-            topic_template="sistats.%s.%s", verbose=False, blacklist=None):
-        transport.Checker.__init__(self, blacklist)
+            topic_template="sistats.%s.%s", verbose=False, blacklist=None,
+            bulk=False, bulk_ep=None, batch_size=100, linger=1.0,
+            compress=False, queue_size=0, queue_policy="drop-oldest",
+            spool_dir=None, replay_rate=10.0, concurrency=1,
+            request_timeout=None, encoding="json", keyframe_interval=60,
+            **kwargs):
+        transport.Checker.__init__(self, blacklist, **kwargs)
 
         self.data_ep = data_ep
         self.login_ep = login_ep
 
+        # in bulk mode the events of each check are posted as a list to
+        # bulk_ep in one request, compress sends the bodies gzipped
+        self.bulk_ep = bulk_ep if bulk_ep is not None else data_ep
+        self.compress = compress
+        self.session = requests.Session()
+        self.request_timeout = request_timeout
+
+        # keep a connection for each concurrent request
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # login_generation changes on each login, requests that get a 401
+        # or 403 login again only if nobody did since they were sent
+        self.login_lock = threading.Lock()
+        self.login_generation = 0
+
+        # with drop-diffs-first the deltas of a batch are queued as a
+        # request of their own that can be dropped first
+        self.split_diffs = queue_policy == "drop-diffs-first"
+
+        if bulk:
+            self.batcher = Batcher(self._queue_batch, batch_size, linger)
+        else:
+            self.batcher = None
+
         self.session_key = None
 
         self.username = username
@@ -74,9 +417,32 @@ class Checker(transport.Checker):
         self.topic_template = topic_template
         self.client_id = client_id
 
+        # with the "stream" and "wire" encodings the stats are sent as base64
+        # frames to topic + "." + encoding and no deltas are sent, there's no
+        # way to ask for a keyframe (or the schema) so a consumer that loses
+        # a frame waits for the next periodic one
+        self.encoding = encoding
+        self.keyframe_interval = keyframe_interval
+        self.encoders = {}
+
         self.verbose = verbose
 
-        self.doer = ThreadDoer()
+        # with queue_size > 0 at most queue_size requests are kept in
+        # memory, the rest and the failed ones go to the spool if there's a
+        # spool_dir and are replayed when the endpoint is back
+        # with concurrency > 1 that many requests can be in flight at once
+        spooler = spool.Spool(spool_dir) if spool_dir is not None else None
+
+        if concurrency > 1:
+            self.doer = ConcurrentDoer(concurrency, queue_size, queue_policy,
+                    spooler, replay_rate, self._encode_call,
+                    self._decode_call)
+        elif queue_size > 0:
+            self.doer = SpoolingDoer(queue_size, queue_policy, spooler,
+                    replay_rate, self._encode_call, self._decode_call)
+        else:
+            self.doer = ThreadDoer()
+
         self.doer.start()
         self.login()
 
@@ -88,50 +454,185 @@ class Checker(transport.Checker):
     def login(self):
         '''login to the service and get the session key'''
         self.log("logging in to", str(self.login_ep), "with", self.username)
-        self.cookies = login(self.login_ep, self.username, self.password)
+        self.cookies = login(self.login_ep, self.username, self.password,
+                self.session, self.request_timeout)
+        self.login_generation += 1
         self.log("logged in with", self.session_key)
 
+    def relogin(self, generation):
+        '''login again if nobody did since login_generation was
+        *generation*'''
+        with self.login_lock:
+            if self.login_generation == generation:
+                self.login()
+
     def send_stats(self, name, data):
         '''send stats somewhere'''
         topic = self.topic_template % (self.client_id, name)
-        self.send(topic, data)
+
+        if self.encoding in ENCODERS:
+            encoder = self.encoders.get(name)
+
+            if encoder is None:
+                encoder = self.encoders[name] = ENCODERS[self.encoding](
+                        self.keyframe_interval)
+
+            frame = base64.b64encode(encoder.encode(data))
+            self.send(topic + "." + self.encoding, frame,
+                    self.sample_times.get(name), interval=self.interval(name))
+        else:
+            self.send(topic, data, self.sample_times.get(name),
+                    interval=self.interval(name))
 
     def send_delta_stats(self, name, data):
         '''send delta stats somewhere'''
+        if self.encoding in ENCODERS:
+            # the consumer rebuilds the readings, deltas are redundant
+            return
+
         topic = self.topic_template % (self.client_id, name) + ".diff"
-        self.send(topic, data)
+        self.send(topic, data, self.sample_times.get(name),
+                self.sample_elapsed.get(name), self.interval(name))
 
-    def _send(self, topic, data):
-        event = Event(data, topic)
-        self.log("send to", str(self.data_ep))
-        self.log(event)
-        json_data = json.dumps(event.to_json())
+    def _post(self, endpoint, data):
+        '''post *data* as json to *endpoint*'''
+        start = transport.monotonic()
+        body = json.dumps(data)
 
         headers = {
             'content-type': 'application/json'
         }
 
-        response = requests.post(str(self.data_ep), json_data, headers=headers,
-                cookies=self.cookies)
+        if self.compress:
+            body = gzip_compress(body)
+            headers['content-encoding'] = 'gzip'
+
+        sent = transport.monotonic()
+        self.measure("encode", sent - start)
+        self.measure("size", len(body))
+
+        generation = self.login_generation
+
+        try:
+            response = self.session.post(str(endpoint), body,
+                    headers=headers, cookies=self.cookies,
+                    timeout=self.request_timeout)
+        except Exception:
+            self.count_error("send")
+            raise
+
+        self.measure("send", transport.monotonic() - sent)
 
         self.log("response", response.status_code)
         if response.status_code in (401, 403):
-            self.login()
-
-    def send(self, topic, data):
+            self.relogin(generation)
+
+        # raise so the request can be spooled and replayed, other client
+        # errors would fail again
+        if response.status_code >= 500 or response.status_code in (401, 403):
+            self.count_error("send")
+            response.raise_for_status()
+
+    def _send_events(self, events):
+        '''post the json representation of *events*, a single event goes to
+        the data endpoint unless in bulk mode'''
+        if self.batcher is None and len(events) == 1:
+            self.log("send to", str(self.data_ep))
+            self._post(self.data_ep, events[0])
+        else:
+            self.log("send", len(events), "events to", str(self.bulk_ep))
+            self._post(self.bulk_ep, events)
+
+    def _encode_call(self, msg):
+        '''return the spool record for a doer call'''
+        fun, args, _kwargs = msg
+        return args[0] if fun == self._send_events else None
+
+    def _decode_call(self, record):
+        '''return the doer call for a spool record'''
+        return self._send_events, (record,), {}
+
+    def _queue_batch(self, events):
+        if not self.split_diffs:
+            self.doer.call(self._send_events,
+                    [event.to_json() for event in events])
+            return
+
+        stats = [event.to_json() for event in events
+                if not event.channel.endswith(".diff")]
+        diffs = [event.to_json() for event in events
+                if event.channel.endswith(".diff")]
+
+        if stats:
+            self.doer.call(self._send_events, stats)
+
+        if diffs:
+            self.doer.call_low(self._send_events, diffs)
+
+    def send(self, topic, data, timestamp=None, elapsed=None,
+            interval=None):
         '''send event to the data endpoint'''
-        self.doer.call(self._send, topic, data)
+        event = Event(data, topic, timestamp, elapsed, interval)
+
+        if self.batcher is None:
+            self.log(event)
+
+            if topic.endswith(".diff"):
+                self.doer.call_low(self._send_events, [event.to_json()])
+            else:
+                self.doer.call(self._send_events, [event.to_json()])
+        else:
+            self.batcher.add(event)
+
+    def queue_stats(self):
+        '''return the queue and spool counters, None if the queue is not
+        bounded'''
+        if isinstance(self.doer, SpoolingDoer):
+            return self.doer.stats()
+
+        return None
+
+    def self_gauges(self):
+        '''return the queue and spool counters'''
+        return self.queue_stats() or {}
+
+    def check(self):
+        '''check for stats, in bulk mode send them in one request'''
+        transport.Checker.check(self)
+
+        if self.batcher is not None:
+            self.batcher.flush()
+
+        stats = self.queue_stats()
+        if stats is not None:
+            self.log("queue", stats)
 
     def on_exit(self):
+        if self.batcher is not None:
+            self.batcher.flush()
+
         self.doer.quit()
 
-def login(endpoint, username, password):
-    '''do a login to endpoint'''
-    session = dict(username=username, password=password)
-    data = json.dumps(session)
+def decode_stream_event(decoders, event):
+    '''return the reading for the json *event* of a ".stream" channel
+    using the stream.StreamDecoders *decoders*, None if it can't be
+    decoded until the next keyframe'''
+    return decoders.decode(event["channel"], base64.b64decode(event["value"]))
+
+def decode_wire_event(decoder, event):
+    '''return the reading for the json *event* of a ".wire" channel using
+    the wire.WireDecoder *decoder*, None if its schema is not known yet'''
+    return decoder.decode(base64.b64decode(event["value"]))
+
+def login(endpoint, username, password, session=requests, timeout=None):
+    '''do a login to endpoint, using *session* if given to reuse its
+    connections, giving up after *timeout* seconds if not None'''
+    credentials = dict(username=username, password=password)
+    data = json.dumps(credentials)
     headers = {'content-type': 'application/json'}
 
-    response = requests.post(str(endpoint), data, headers=headers)
+    response = session.post(str(endpoint), data, headers=headers,
+            timeout=timeout)
 
     return response.cookies
 
@@ -167,12 +668,55 @@ def base_option_parser():
         metavar="PASSWORD")
 
     parser.add_option("-C", "--checkinterval", dest="checkinterval",
-            default=10, type="int",
+            default=10, type="float",
             help="check for new values every SEC seconds", metavar="SEC")
 
     parser.add_option("-b", "--blacklist", dest="blacklist", default="",
         help="don't generates events for the given types", metavar="TYPES")
 
+    parser.add_option("--bulk", action="store_true", dest="bulk",
+        default=False, help="send the events of each check in one request")
+    parser.add_option("--bulkendpoint", dest="bulkendpoint", default=None,
+        help="in bulk mode send events to ENDPOINT, defaults to --endpoint",
+        metavar="ENDPOINT")
+    parser.add_option("--batchsize", dest="batchsize", default=100,
+        type="int", help="in bulk mode send at most COUNT events per request",
+        metavar="COUNT")
+    parser.add_option("--linger", dest="linger", default=1.0, type="float",
+        help="in bulk mode wait at most SEC seconds to fill a batch",
+        metavar="SEC")
+    parser.add_option("-q", "--queuesize", dest="queuesize", default=0,
+        type="int", help="keep at most COUNT requests in memory, 0 means no "
+        "limit", metavar="COUNT")
+    parser.add_option("--queuepolicy", dest="queuepolicy",
+        default="drop-oldest", choices=BoundedQueue.POLICIES,
+        help="what to do when the queue is full: block, drop-oldest or "
+        "drop-diffs-first (with --bulk the diffs of each batch are posted "
+        "apart)", metavar="POLICY")
+    parser.add_option("-s", "--spool", dest="spool", default=None,
+        help="with --queuesize, write requests that don't fit or fail to "
+        "DIR and send them later", metavar="DIR")
+    parser.add_option("--replayrate", dest="replayrate", default=10.0,
+        type="float", help="send at most COUNT spooled requests per second",
+        metavar="COUNT")
+    parser.add_option("-n", "--concurrency", dest="concurrency", default=1,
+        type="int", help="send up to COUNT requests at the same time",
+        metavar="COUNT")
+    parser.add_option("-t", "--timeout", dest="timeout", default=None,
+        type="float", help="give up on requests after SEC seconds",
+        metavar="SEC")
+    parser.add_option("-z", "--gzip", action="store_true", dest="gzip",
+        default=False, help="send gzip compressed request bodies")
+    parser.add_option("-f", "--encoding", dest="encoding", default="json",
+        choices=("json",) + tuple(ENCODERS), help="send stats as json "
+        "documents, as a stream of keyframes and deltas or as schema based "
+        "binary frames", metavar="ENCODING")
+    parser.add_option("-k", "--keyframeinterval", dest="keyframeinterval",
+        default=60, type="int", help="with the stream or wire encodings send "
+        "a keyframe (or the schema) every COUNT readings", metavar="COUNT")
+
+    transport.add_checker_options(parser)
+
     return parser
 
 class EndPoint(object):
@@ -196,8 +740,20 @@ def main():
     login_ep = EndPoint(opts.host, opts.port, opts.loginendpoint)
     data_ep = EndPoint(opts.host, opts.port, opts.endpoint)
 
+    if opts.bulkendpoint is None:
+        bulk_ep = None
+    else:
+        bulk_ep = EndPoint(opts.host, opts.port, opts.bulkendpoint)
+
     checker = Checker(opts.clientid, opts.username, opts.password, login_ep,
-            data_ep, verbose=opts.verbose, blacklist=opts.blacklist.split(","))
+            data_ep, verbose=opts.verbose, blacklist=opts.blacklist.split(","),
+            bulk=opts.bulk, bulk_ep=bulk_ep, batch_size=opts.batchsize,
+            linger=opts.linger, compress=opts.gzip,
+            queue_size=opts.queuesize, queue_policy=opts.queuepolicy,
+            spool_dir=opts.spool, replay_rate=opts.replayrate,
+            concurrency=opts.concurrency, request_timeout=opts.timeout,
+            encoding=opts.encoding, keyframe_interval=opts.keyframeinterval,
+            **transport.checker_options(opts))
 
     transport.main_loop(checker, opts.checkinterval)
 
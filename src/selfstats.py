@@ -0,0 +1,173 @@
+'''timings and counters of the agent itself
+
+the checkers record how long each collector and delta calculator takes, how
+long the transports take to encode and send and how big the payloads are,
+the errors and the queue depths, every few seconds they are sent as the SELF
+stat with the same transport as the rest, a reading looks like
+
+    {"window": 10.0,
+     "collect.cpu": {"count": 10, "total": 0.0012, "max": 0.0003},
+     "size.cpu": {"count": 10, "total": 4960, "max": 496},
+     "errors": {"check.fs": 1},
+     "gauges": {"queue": 0, "inflight": 1},
+     "process": {"user": 0.02, "system": 0.01, "threads": 3,
+                 "max_rss": 12345678}}
+
+keys are "<what>.<collector>" for collect, delta and encode (seconds) and
+size (bytes), "send" is the seconds from sending a message to its ack or
+response, errors are counted as "check.<collector>" and "send", process has
+the cpu seconds used during the window and max_rss is None where there's
+no resource module (windows)'''
+import os
+import pstats
+import cProfile
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# stat name of the agent stats
+SELF = "self"
+
+class Metric(object):
+    '''count, total and max of some values'''
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        '''add a value'''
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        '''return a dict representation'''
+        return {"count": self.count, "total": self.total, "max": self.max}
+
+class SelfStats(object):
+    '''the metrics of the agent since the last take, all the methods can be
+    called from any thread'''
+
+    def __init__(self, start=None):
+        self.lock = threading.Lock()
+        # monotonic time the window started
+        self.start = start
+        self.times = os.times()
+        self.metrics = {}
+        self.errors = {}
+        self.gauges = {}
+
+    def add(self, key, value):
+        '''add *value* to metric *key*'''
+        with self.lock:
+            metric = self.metrics.get(key)
+
+            if metric is None:
+                metric = self.metrics[key] = Metric()
+
+            metric.add(value)
+
+    def error(self, key):
+        '''count an error of *key*'''
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def gauge(self, name, value):
+        '''set gauge *name* to *value*'''
+        with self.lock:
+            self.gauges[name] = value
+
+    def timed(self, key, function, clock):
+        '''return a function that calls *function* and adds its duration
+        measured with *clock* to *key*'''
+        def call():
+            '''call function and time it'''
+            start = clock()
+
+            try:
+                return function()
+            finally:
+                self.add(key, clock() - start)
+
+        return call
+
+    def take(self, clock):
+        '''return the reading for the window that ends at monotonic time
+        *clock* and start a new one'''
+        times = os.times()
+
+        if resource is not None:
+            # kilobytes on linux
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * \
+                    1024
+        else:
+            max_rss = None
+
+        with self.lock:
+            reading = dict((key, metric.to_dict())
+                    for key, metric in self.metrics.items())
+            reading["errors"] = self.errors
+            reading["gauges"] = self.gauges
+            reading["window"] = clock - self.start \
+                    if self.start is not None else 0.0
+            reading["process"] = {
+                "user": times[0] - self.times[0],
+                "system": times[1] - self.times[1],
+                "threads": threading.active_count(),
+                "max_rss": max_rss
+            }
+
+            self.start = clock
+            self.times = times
+            self.metrics = {}
+            self.errors = {}
+            self.gauges = dict(self.gauges)
+
+        return reading
+
+class Profiler(object):
+    '''a Checker hook (see Checker.add_hook) that runs each collector under
+    cProfile, dump writes the profile of all of them'''
+
+    def __init__(self):
+        self.profiles = {}
+
+    def __call__(self, name, call):
+        profile = self.profiles.get(name)
+
+        if profile is None:
+            profile = self.profiles[name] = cProfile.Profile()
+
+        return profile.runcall(call)
+
+    def stats(self, name=None):
+        '''return the pstats.Stats of collector *name*, of all if None'''
+        profiles = [profile for profile_name, profile in
+                sorted(self.profiles.items())
+                if name is None or name == profile_name]
+
+        if not profiles:
+            return None
+
+        stats = pstats.Stats(profiles[0])
+
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        return stats
+
+    def dump(self, path, name=None):
+        '''write the profile to *path* in the pstats format'''
+        stats = self.stats(name)
+
+        if stats is not None:
+            stats.dump_stats(path)
@@ -0,0 +1,339 @@
+'''latest stats in a memory mapped file for local readers
+
+the agent (with --shm PATH) writes the last reading and delta of each
+collector to a file, /dev/shm/sistats by default, any number of local
+processes can map it and read a consistent copy without collecting the stats
+again or talking to a broker:
+
+    reader = shm.Reader()
+    cpu = reader.get("cpu")    # {"stats": ..., "delta": ..., ...}
+
+the file has a header, a table with an entry per collector and kind (stats
+or delta) and the blobs the entries point to, the schema of each reading and
+its numbers in the wire format (see wire.py), readers keep the schemas of
+the current table they decoded by id so a read only unpacks the numbers
+straight from the map
+
+the header has a sequence number, the writer makes it odd before changing
+the file and even again when it's done, a reader takes the number before and
+after reading and tries again if it was odd or changed (a seqlock), so the
+writer never waits for the readers, the file only grows and is never
+truncated so a reader with an old, smaller map notices the size in the
+header and maps it again'''
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+
+import wire
+
+DEFAULT_PATH = "/dev/shm/sistats"
+
+MAGIC = "SISH"
+VERSION = 1
+
+# magic, version, sequence, timestamp of the last write, payload size and
+# number of entries, the sequence is at SEQ_OFFSET so it can be read alone
+HEADER = struct.Struct("<4sB3xQdII")
+SEQ = struct.Struct("<Q")
+SEQ_OFFSET = 8
+
+NAME_SIZE = 32
+
+# collector name, kind, schema id, timestamp, seconds since the previous
+# reading and offset and size of the schema and of the numbers
+ENTRY = struct.Struct("<%dsB3xIddIIII" % NAME_SIZE)
+
+# kinds of entries
+STATS = 0
+DELTA = 1
+KINDS = {STATS: "stats", DELTA: "delta"}
+
+# the file starts with this size and doubles when the payload doesn't fit
+INITIAL_SIZE = 64 * 1024
+
+# times a reader tries before giving up when the writer keeps changing the
+# file under it
+RETRIES = 100
+
+class ShmError(Exception):
+    '''raised when the file can't be written or read'''
+    pass
+
+class Exporter(object):
+    '''writes the readings to the file at *path*, only one exporter can
+    have a file open, observe is a Checker observer and publish writes what
+    changed since the last publish'''
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(self.fd)
+            raise ShmError("%s is in use by another exporter" % path)
+
+        size = os.fstat(self.fd).st_size
+        self.seq = 0
+
+        if size >= HEADER.size:
+            with open(path, "rb") as current:
+                magic, version, seq, _timestamp, _payload, _count = \
+                        HEADER.unpack(current.read(HEADER.size))
+
+            # readers of the old file must not take the new one for it
+            if magic == MAGIC and version == VERSION:
+                self.seq = seq + (seq & 1) + 2
+
+        if size < INITIAL_SIZE:
+            os.ftruncate(self.fd, INITIAL_SIZE)
+            size = INITIAL_SIZE
+
+        self.map = mmap.mmap(self.fd, size)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.seq, time.time(),
+                0, 0)
+        # (name, kind) -> [schema, schema id, encoded schema, numbers,
+        # timestamp, elapsed]
+        self.entries = {}
+        self.timestamps = {}
+        self.changed = False
+
+    def set(self, name, kind, data, timestamp, elapsed=0.0):
+        '''set the reading of *kind* of collector *name*'''
+        if len(name) > NAME_SIZE:
+            raise ShmError("collector name too long: %s" % name)
+
+        entry = self.entries.get((name, kind))
+        numbers = None
+
+        if entry is not None:
+            numbers = entry[0].pack(data)
+
+        if numbers is None:
+            schema = wire.Schema.from_reading(data)
+            encoded = schema.encode()
+            numbers = schema.pack(data)
+
+            if numbers is None:
+                raise ShmError("reading doesn't match its own schema")
+
+            entry = self.entries[(name, kind)] = [schema,
+                    zlib.crc32(encoded) & 0xffffffff, encoded, None, None,
+                    None]
+
+        entry[3:] = [numbers, timestamp, elapsed]
+        self.changed = True
+
+    def observe(self, name, data, delta, timestamp):
+        '''Checker observer, sets the reading and the delta'''
+        previous = self.timestamps.get(name)
+        self.timestamps[name] = timestamp
+        self.set(name, STATS, data, timestamp)
+
+        if delta is not None:
+            self.set(name, DELTA, delta, timestamp,
+                    timestamp - previous if previous is not None else 0.0)
+
+    def _payload(self):
+        '''return the table and the blobs'''
+        table = []
+        blobs = []
+        offset = HEADER.size + ENTRY.size * len(self.entries)
+
+        for (name, kind), (_schema, schema_id, encoded, numbers, timestamp,
+                elapsed) in sorted(self.entries.items()):
+            table.append(ENTRY.pack(name, kind, schema_id, timestamp,
+                elapsed, offset, len(encoded), offset + len(encoded),
+                len(numbers)))
+            blobs.append(encoded)
+            blobs.append(numbers)
+            offset += len(encoded) + len(numbers)
+
+        return "".join(table + blobs)
+
+    def publish(self, timestamp=None):
+        '''write the readings set since the last publish'''
+        if not self.changed:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        payload = self._payload()
+        end = HEADER.size + len(payload)
+
+        # odd while the file changes
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+
+        if end > len(self.map):
+            size = len(self.map)
+
+            while size < end:
+                size *= 2
+
+            self.map.close()
+            os.ftruncate(self.fd, size)
+            self.map = mmap.mmap(self.fd, size)
+
+        self.map[HEADER.size:end] = payload
+        self.seq += 1
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.seq, timestamp,
+                len(payload), len(self.entries))
+        self.changed = False
+
+    def close(self):
+        '''unmap and close the file, readers keep the last readings'''
+        self.map.close()
+        os.close(self.fd)
+
+class Reader(object):
+    '''reads the file written by an Exporter at *path*'''
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.map = None
+        self.schemas = {}
+        self._open()
+
+    def _open(self):
+        '''map the file, again if it grew'''
+        if self.map is not None:
+            self.map.close()
+
+        with open(self.path, "rb") as shm_file:
+            self.map = mmap.mmap(shm_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+
+        if len(self.map) < HEADER.size or \
+                self.map[:len(MAGIC)] != MAGIC:
+            raise ShmError("%s is not a stats file" % self.path)
+
+    def _schema(self, schema_id, offset, size):
+        '''return the schema with *schema_id* stored at *offset*'''
+        schema = self.schemas.get(schema_id)
+
+        if schema is None:
+            schema = wire.Schema.decode(self.map[offset:offset + size])
+
+            if zlib.crc32(schema.encode()) & 0xffffffff != schema_id:
+                # changed under us, the sequence will tell
+                return None
+
+            self.schemas[schema_id] = schema
+
+        return schema
+
+    def _read(self, names):
+        '''return the readings of *names* (all if None) and the timestamp
+        of the last write, None if the writer changed the file while
+        reading'''
+        seq, = SEQ.unpack_from(self.map, SEQ_OFFSET)
+
+        if seq & 1:
+            return None
+
+        magic, version, _seq, timestamp, size, count = \
+                HEADER.unpack_from(self.map)
+
+        if magic != MAGIC or version != VERSION:
+            raise ShmError("unsupported file version %d" % version)
+
+        if HEADER.size + size > len(self.map):
+            self._open()
+            return None
+
+        readings = {}
+        # schemas of the table, the rest are dropped from the cache
+        schema_ids = set()
+
+        try:
+            for index in xrange(count):
+                name, kind, schema_id, entry_time, elapsed, \
+                        schema_offset, schema_size, offset, _size = \
+                        ENTRY.unpack_from(self.map,
+                                HEADER.size + index * ENTRY.size)
+                name = name.rstrip("\0")
+                schema_ids.add(schema_id)
+
+                if names is not None and name not in names:
+                    continue
+
+                schema = self._schema(schema_id, schema_offset, schema_size)
+
+                if schema is None:
+                    return None
+
+                reading = readings.setdefault(name, {})
+                reading[KINDS.get(kind, kind)] = schema.unpack(self.map,
+                        offset)
+                reading["timestamp"] = entry_time
+
+                if kind == DELTA:
+                    reading["elapsed"] = elapsed
+        except (wire.WireError, struct.error):
+            # garbage read while the writer was changing the file
+            if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] == seq:
+                raise
+
+            return None
+
+        if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] != seq:
+            return None
+
+        if len(self.schemas) > len(schema_ids):
+            # readings like procs and cgroups change schema all the time
+            for schema_id in self.schemas.keys():
+                if schema_id not in schema_ids:
+                    del self.schemas[schema_id]
+
+        return readings, timestamp
+
+    def read(self, names=None):
+        '''return a dict from collector name to a dict with its "stats",
+        "delta" (if any), "timestamp" and the seconds the delta covers
+        ("elapsed"), only for the collectors in *names* if it's not None'''
+        return self.read_with_time(names)[0]
+
+    def read_with_time(self, names=None):
+        '''return the readings like read and the time of the last write'''
+        if names is not None:
+            names = set(names)
+
+        for attempt in xrange(RETRIES):
+            result = self._read(names)
+
+            if result is not None:
+                return result
+
+            if attempt:
+                time.sleep(0.0001)
+
+        raise ShmError("the writer kept changing the file")
+
+    def get(self, name):
+        '''return the readings of collector *name*, None if there are
+        none'''
+        return self.read([name]).get(name)
+
+    def close(self):
+        '''unmap the file'''
+        self.map.close()
+
+def main(args=None):
+    '''print the readings in the file as json'''
+    if args is None:
+        args = sys.argv[1:]
+
+    reader = Reader(args[0] if args else DEFAULT_PATH)
+    json.dump(reader.read(args[1:] or None), sys.stdout, sort_keys=True)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
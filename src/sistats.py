@@ -1,8 +1,17 @@
 '''module to get system stats'''
 import os
-import platform
+import time
 
-import psutil
+# psutil, platform, mounts, procs and cgroups are imported on first use so
+# the procfs backend and the one-shot mode (see oneshot.py) don't pay for
+# them and the linux only ones don't break the import elsewhere
+import procfs
+
+# platform info cache of get_cached_platform_info and the file with the id
+# of the current boot that invalidates it
+PLATFORM_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "sistats",
+        "platform.json")
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
 
 # Ignore the following FS name
 IGNORE_FSNAME = ('', 'none', 'gvfs-fuse-daemon', 'fusectl', 'cgroup')
@@ -16,50 +25,79 @@ def get_fs_delta(old, new):
     return _calculate_delta(old, new, "size", "used", "avail")
 
 def get_fs_stats_delta(old, new):
-    '''return the delta between two stats from get_fs_stats'''
+    '''return the delta between two stats from get_fs_stats, stale file
+    systems are skipped'''
     delta = {}
 
     for name in new:
-        if name in old:
+        if name in old and not (old[name].get("stale") or
+                new[name].get("stale")):
             delta[name] = get_fs_delta(old[name], new[name])
             delta[name]["type"] = new[name]["type"]
             delta[name]["mnt_point"] = new[name]["mnt_point"]
 
     return delta
 
+# created on the first call to get_fs_stats
+FS_COLLECTOR = None
+
 def get_fs_stats(ignore_fsname=IGNORE_FSNAME, ignore_fstype=IGNORE_FSTYPE):
-    '''get file system stats'''
-    # Reset the list
-    filesystems = {}
+    '''get file system stats, the mount table is only read again when it
+    changes and mounts that don't answer in time are returned with stale set
+    to True instead of blocking, see the mounts module'''
+    global FS_COLLECTOR
+
+    if FS_COLLECTOR is None:
+        import mounts
+        FS_COLLECTOR = mounts.FsCollector()
+
+    return FS_COLLECTOR.get_stats(ignore_fsname, ignore_fstype)
 
-    # Open the current mounted FS
-    fs_stats = psutil.disk_partitions(True)
-    for fs_stat in fs_stats:
-        if fs_stat.device in ignore_fsname or fs_stat.fstype in ignore_fstype:
-            continue
+def get_proc_stats_delta(old, new):
+    '''return the delta between two stats from get_proc_stats, processes
+    that exited or whose pid was reused are skipped'''
+    import procs
+    return procs.get_stats_delta(old, new)
 
-        fs_current = {}
-        fs_current['type'] = fs_stat.fstype
-        fs_current['mnt_point'] = fs_stat.mountpoint
+# created on the first call to get_proc_stats
+PROC_COLLECTOR = None
 
-        try:
-            fs_usage = psutil.disk_usage(fs_stat.mountpoint)
+def get_proc_stats():
+    '''get the top processes by cpu, resident memory and io, the static
+    fields of a process are read once, see the procs module'''
+    global PROC_COLLECTOR
 
-            fs_current['size']  = fs_usage.total
-            fs_current['used']  = fs_usage.used
-            fs_current['avail'] = fs_usage.free
+    if PROC_COLLECTOR is None:
+        import procs
+        PROC_COLLECTOR = procs.ProcessTable()
 
-        except OSError:
-            fs_current['size']  = -1
-            fs_current['used']  = -1
-            fs_current['avail'] = -1
+    return PROC_COLLECTOR.get_stats()
 
-        filesystems[fs_stat.device] = fs_current
+def get_cgroup_stats_delta(old, new):
+    '''return the delta between two stats from get_cgroup_stats, cgroups
+    that were created or removed in between are skipped'''
+    import cgroups
+    return cgroups.get_stats_delta(old, new)
 
-    return filesystems
+# created on the first call to get_cgroup_stats
+CGROUP_COLLECTOR = None
+
+def get_cgroup_stats():
+    '''get the cpu, memory and io stats of each cgroup v2 cgroup, the tree
+    is only listed again where cgroups were created or removed, see the
+    cgroups module'''
+    global CGROUP_COLLECTOR
+
+    if CGROUP_COLLECTOR is None:
+        import cgroups
+        CGROUP_COLLECTOR = cgroups.CgroupCollector()
+
+    return CGROUP_COLLECTOR.get_stats()
 
 def get_platform_info():
     '''return platform information'''
+    import platform
+
     host = {}
     host['os'] = platform.system()
     host['hostname'] = platform.node()
@@ -87,6 +125,54 @@ def get_platform_info():
 
     return host
 
+def _boot_id():
+    '''return the id of the current boot, None if it's not known'''
+    try:
+        with open(BOOT_ID) as handle:
+            return handle.read().strip()
+    except IOError:
+        return None
+
+def get_cached_platform_info(path=PLATFORM_CACHE, max_age=86400):
+    '''return get_platform_info, the result is kept in the json file at
+    *path* and used while it's from the same boot (on linux) and at most
+    *max_age* seconds old, the file is not needed to work'''
+    import json
+
+    boot_id = _boot_id()
+
+    try:
+        with open(path) as handle:
+            cached = json.load(handle)
+
+        if cached.get("boot_id") == boot_id and \
+                0 <= time.time() - cached.get("time", 0) < max_age:
+            return cached["platform"]
+    except (IOError, ValueError, KeyError, AttributeError):
+        pass
+
+    host = get_platform_info()
+
+    try:
+        directory = os.path.dirname(path)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # written to a temporary file and renamed so readers never see a
+        # partial file
+        temporary = "%s.%d" % (path, os.getpid())
+
+        with open(temporary, "w") as handle:
+            json.dump({"boot_id": boot_id, "time": time.time(),
+                "platform": host}, handle)
+
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        pass
+
+    return host
+
 def _calculate_cpu_stats(cputime):
     '''return stats for a cpu'''
     base = {
@@ -126,6 +212,8 @@ def get_cpu_stats_delta(old, new):
 
 def get_cpu_stats():
     '''return cpu stats'''
+    import psutil
+
     cputime = psutil.cpu_times()
 
     cpu = _calculate_cpu_stats(cputime)
@@ -165,6 +253,7 @@ def get_mem_stats_delta(old, new):
 
 def get_mem_stats():
     '''return mem stats'''
+    import psutil
 
     if hasattr(psutil, 'cached_phymem') and hasattr(psutil, 'phymem_buffers'):
         cachemem = psutil.cached_phymem() + psutil.phymem_buffers()
@@ -210,8 +299,9 @@ def get_net_stats_delta(old, new):
 
 def get_net_stats():
     '''return network stats'''
-    network = {}
+    import psutil
 
+    network = {}
     network_new = psutil.network_io_counters(True)
 
     for name, iface in network_new.items():
@@ -241,8 +331,9 @@ def get_disk_stats_delta(old, new):
 
 def get_disk_stats():
     '''return diskio stats'''
-    diskios = {}
+    import psutil
 
+    diskios = {}
     diskio = psutil.disk_io_counters(True)
 
     for name, diskio in diskio.items():
@@ -259,6 +350,35 @@ def get_disk_stats():
 
     return diskios
 
+# stats functions and delta calculators for each collector
+COLLECTORS = {
+    "cpu": (get_cpu_stats, get_cpu_stats_delta),
+    "mem": (get_mem_stats, get_mem_stats_delta),
+    "net": (get_net_stats, get_net_stats_delta),
+    "disk": (get_disk_stats, get_disk_stats_delta),
+    "fs": (get_fs_stats, get_fs_stats_delta),
+    "procs": (get_proc_stats, get_proc_stats_delta),
+    "cgroups": (get_cgroup_stats, get_cgroup_stats_delta)
+}
+
+BACKENDS = ("psutil", "procfs", "snapshot")
+
+def get_collector(name, backend="psutil"):
+    '''return a (function, delta_calculator) tuple for collector *name*
+    using *backend*, falls back to psutil if *backend* can't provide it on
+    this system'''
+    function, delta_calculator = COLLECTORS[name]
+
+    if backend == "procfs" and procfs.available(name):
+        function = procfs.COLLECTORS[name]
+    elif backend == "snapshot":
+        import snapshot
+
+        if name in snapshot.COLLECTORS:
+            function, delta_calculator = snapshot.get_collector(name)
+
+    return function, delta_calculator
+
 TITLE_LEVELS = ["=", "-", ".", ":", "+"]
 
 def print_title(title, underline="-"):
@@ -285,8 +405,14 @@ def pretty_print(title, data, level=0):
     print
 
 def main():
-    '''main function that displays the current values and deltas'''
-    import time
+    '''main function that displays the current values and deltas, with
+    --once the stats are read once instead, see oneshot.py'''
+    import sys
+
+    if "--once" in sys.argv[1:]:
+        import oneshot
+        oneshot.main([arg for arg in sys.argv[1:] if arg != "--once"])
+        return
 
     cpu  = get_cpu_stats()
     mem  = get_mem_stats()
@@ -0,0 +1,294 @@
+'''compact snapshot types for stats readings
+
+the values are kept in flat array('d') instances instead of dicts of dicts,
+delta functions work on the arrays directly, to_dict returns the same format
+as the functions in the sistats module so they can be encoded as BSON or
+JSON'''
+import operator
+from array import array
+
+import procfs
+import sistats
+
+CPU_FIELDS = ("kernel", "user", "idle", "nice")
+MEM_FIELDS = ("total", "used", "free", "percent")
+NET_FIELDS = ("rb", "tb", "rc", "tc")
+DISK_FIELDS = ("rb", "wb", "rc", "wc", "rt", "wt")
+
+class Snapshot(object):
+    '''base class for snapshots'''
+    __slots__ = ()
+
+    def to_dict(self):
+        '''return a dict representation'''
+        raise NotImplementedError()
+
+def to_dict(value):
+    '''return the dict representation of *value* if it's a snapshot, value
+    otherwise'''
+    if isinstance(value, Snapshot):
+        return value.to_dict()
+
+    return value
+
+def _subtract(old, new):
+    '''return an array with the element wise difference new - old'''
+    return array('d', map(operator.sub, new, old))
+
+class CpuSnapshot(Snapshot):
+    '''cpu readings, the global values first and then one row per cpu'''
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        '''return the number of cpus'''
+        return len(self.values) // len(CPU_FIELDS) - 1
+
+    def row(self, index):
+        '''return the dict for row *index*, 0 is global'''
+        width = len(CPU_FIELDS)
+        return dict(zip(CPU_FIELDS,
+            self.values[index * width:(index + 1) * width]))
+
+    def to_dict(self):
+        '''return a dict representation'''
+        return {
+            "global": self.row(0),
+            "cpu": [self.row(i + 1) for i in xrange(len(self))]
+        }
+
+def get_cpu_stats_delta(old, new):
+    '''calculate the delta between two CpuSnapshot instances'''
+    size = min(len(old.values), len(new.values))
+    return CpuSnapshot(_subtract(old.values[:size], new.values[:size]))
+
+class MemSnapshot(Snapshot):
+    '''mem readings, cache and then the mem and swap MEM_FIELDS'''
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+    def _usage(self, start):
+        '''return the usage dict starting at *start*'''
+        total, used, free, percent = self.values[start:start + 4]
+        return {
+            'total': int(total),
+            'used': int(used),
+            'free': int(free),
+            'percent': percent
+        }
+
+    def to_dict(self):
+        '''return a dict representation'''
+        cachemem = int(self.values[0])
+        mem = self._usage(1)
+        mem['cache'] = cachemem
+
+        return {
+            "cache": cachemem,
+            "mem": mem,
+            "swap": self._usage(5)
+        }
+
+def get_mem_stats_delta(old, new):
+    '''calculate the delta between two MemSnapshot instances'''
+    return MemSnapshot(_subtract(old.values, new.values))
+
+class DeviceSnapshot(Snapshot):
+    '''per device readings, one row of *fields* for each name in *names*'''
+    __slots__ = ("fields", "names", "values", "_index")
+
+    def __init__(self, fields, names, values):
+        self.fields = fields
+        self.names = names
+        self.values = values
+        self._index = None
+
+    def index(self):
+        '''return a dict from device name to row number'''
+        if self._index is None:
+            self._index = dict((name, i) for i, name in enumerate(self.names))
+
+        return self._index
+
+    def row(self, index):
+        '''return the values for row *index*'''
+        width = len(self.fields)
+        return self.values[index * width:(index + 1) * width]
+
+    def to_dict(self):
+        '''return a dict representation'''
+        fields = self.fields
+        return dict((name, dict(zip(fields, [int(val) for val in
+            self.row(i)]))) for i, name in enumerate(self.names))
+
+def get_device_stats_delta(old, new):
+    '''calculate the delta between two DeviceSnapshot instances, only
+    devices present in both are included'''
+    if old.names is new.names or old.names == new.names:
+        return DeviceSnapshot(new.fields, new.names,
+                _subtract(old.values, new.values))
+
+    oldindex = old.index()
+    names = []
+    values = array('d')
+
+    for i, name in enumerate(new.names):
+        oldrow = oldindex.get(name)
+
+        if oldrow is not None:
+            names.append(name)
+            values.extend(_subtract(old.row(oldrow), new.row(i)))
+
+    return DeviceSnapshot(new.fields, tuple(names), values)
+
+get_net_stats_delta = get_device_stats_delta
+get_disk_stats_delta = get_device_stats_delta
+
+# last device names seen for each collector, reused when they don't change
+# so consecutive snapshots share the same tuple
+_NAMES = {}
+
+def _device_snapshot(kind, fields, names, values):
+    '''create a DeviceSnapshot reusing the last names tuple for *kind*'''
+    names = tuple(names)
+    last = _NAMES.get(kind)
+
+    if last == names:
+        names = last
+    else:
+        _NAMES[kind] = names
+
+    return DeviceSnapshot(fields, names, values)
+
+def parse_cpu_snapshot(content, ticks=procfs.CLOCK_TICKS):
+    '''parse the content of /proc/stat into a CpuSnapshot'''
+    values = array('d')
+
+    for line in content.splitlines():
+        if not line.startswith("cpu"):
+            break
+
+        fields = line.split(None, 5)
+        values.extend((int(fields[3]) / ticks, int(fields[1]) / ticks,
+            int(fields[4]) / ticks, int(fields[2]) / ticks))
+
+    return CpuSnapshot(values)
+
+def parse_mem_snapshot(content):
+    '''parse the content of /proc/meminfo into a MemSnapshot'''
+    return mem_snapshot(procfs.parse_mem_stats(content))
+
+def parse_net_snapshot(content):
+    '''parse the content of /proc/net/dev into a DeviceSnapshot'''
+    names = []
+    values = array('d')
+
+    for line in content.splitlines()[2:]:
+        name, data = line.split(":", 1)
+        fields = data.split()
+        names.append(name.strip())
+        values.extend((int(fields[0]), int(fields[8]), int(fields[1]),
+            int(fields[9])))
+
+    return _device_snapshot("net", NET_FIELDS, names, values)
+
+def parse_disk_snapshot(content):
+    '''parse the content of /proc/diskstats into a DeviceSnapshot'''
+    names = []
+    values = array('d')
+    sector = procfs.SECTOR_SIZE
+
+    for line in content.splitlines():
+        fields = line.split()
+
+        if len(fields) < 14:
+            continue
+
+        names.append(fields[2])
+        values.extend((int(fields[5]) * sector, int(fields[9]) * sector,
+            int(fields[3]), int(fields[7]), int(fields[6]), int(fields[10])))
+
+    return _device_snapshot("disk", DISK_FIELDS, names, values)
+
+def cpu_snapshot(stats):
+    '''create a CpuSnapshot from the result of sistats.get_cpu_stats'''
+    values = array('d')
+
+    for cpu in [stats["global"]] + stats["cpu"]:
+        values.extend([cpu.get(name, 0.0) for name in CPU_FIELDS])
+
+    return CpuSnapshot(values)
+
+def mem_snapshot(stats):
+    '''create a MemSnapshot from the result of sistats.get_mem_stats'''
+    values = array('d', [stats["cache"]])
+
+    for name in ("mem", "swap"):
+        values.extend([stats[name][field] for field in MEM_FIELDS])
+
+    return MemSnapshot(values)
+
+def device_snapshot(kind, fields, stats):
+    '''create a DeviceSnapshot from the result of sistats.get_net_stats or
+    sistats.get_disk_stats'''
+    names = sorted(stats)
+    values = array('d')
+
+    for name in names:
+        values.extend([stats[name][field] for field in fields])
+
+    return _device_snapshot(kind, fields, names, values)
+
+def get_cpu_stats():
+    '''return cpu stats read from /proc'''
+    return parse_cpu_snapshot(procfs.READER.read("stat"))
+
+def get_mem_stats():
+    '''return mem stats read from /proc'''
+    return parse_mem_snapshot(procfs.READER.read("meminfo"))
+
+def get_net_stats():
+    '''return network stats read from /proc'''
+    return parse_net_snapshot(procfs.READER.read(procfs.SOURCES["net"][0]))
+
+def get_disk_stats():
+    '''return diskio stats read from /proc'''
+    return parse_disk_snapshot(procfs.READER.read("diskstats"))
+
+def get_psutil_cpu_stats():
+    '''return cpu stats read with psutil'''
+    return cpu_snapshot(sistats.get_cpu_stats())
+
+def get_psutil_mem_stats():
+    '''return mem stats read with psutil'''
+    return mem_snapshot(sistats.get_mem_stats())
+
+def get_psutil_net_stats():
+    '''return network stats read with psutil'''
+    return device_snapshot("net", NET_FIELDS, sistats.get_net_stats())
+
+def get_psutil_disk_stats():
+    '''return diskio stats read with psutil'''
+    return device_snapshot("disk", DISK_FIELDS, sistats.get_disk_stats())
+
+# procfs function, psutil function and delta calculator for each collector
+COLLECTORS = {
+    "cpu": (get_cpu_stats, get_psutil_cpu_stats, get_cpu_stats_delta),
+    "mem": (get_mem_stats, get_psutil_mem_stats, get_mem_stats_delta),
+    "net": (get_net_stats, get_psutil_net_stats, get_net_stats_delta),
+    "disk": (get_disk_stats, get_psutil_disk_stats, get_disk_stats_delta)
+}
+
+def get_collector(name):
+    '''return a (function, delta_calculator) tuple for collector *name*,
+    reading from /proc if available and from psutil otherwise'''
+    function, fallback, delta_calculator = COLLECTORS[name]
+
+    if not procfs.available(name):
+        function = fallback
+
+    return function, delta_calculator
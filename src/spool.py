@@ -0,0 +1,169 @@
+'''append only on disk spool for records that couldn't be sent
+
+records are json values written one per line to numbered segment files in a
+directory, they are read back in the order they were written, the read
+position is kept in a file so unsent records survive a restart, a record
+torn by a crash (the last line of a segment without its newline) or that
+isn't valid json is skipped and counted as corrupt'''
+import os
+import json
+import threading
+
+SUFFIX = ".spool"
+OFFSET_FILE = "offset"
+
+class Spool(object):
+    '''a directory of segment files of at most *segment_size* bytes, when
+    the spool is bigger than *max_size* bytes the oldest segments are
+    dropped'''
+
+    def __init__(self, path, segment_size=4 * 1024 * 1024,
+            max_size=256 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # records lost because the spool was full
+        self.dropped = 0
+        # records skipped because they were torn or not valid json
+        self.corrupt = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.segments = sorted(int(name[:-len(SUFFIX)])
+                for name in os.listdir(path) if name.endswith(SUFFIX))
+        self.sizes = dict((number, os.path.getsize(self._path(number)))
+                for number in self.segments)
+
+        self.writer = None
+        self.reader = None
+        self.position = self._load_offset()
+
+    def _path(self, number):
+        '''return the path of segment *number*'''
+        return os.path.join(self.path, "%012d%s" % (number, SUFFIX))
+
+    def _load_offset(self):
+        '''return the read position in the first segment'''
+        path = os.path.join(self.path, OFFSET_FILE)
+
+        if not self.segments or not os.path.exists(path):
+            return 0
+
+        with open(path) as handle:
+            number, position = [int(value) for value in handle.read().split()]
+
+        return position if number == self.segments[0] else 0
+
+    def _save_offset(self):
+        '''write the read position to the offset file'''
+        if not self.segments:
+            return
+
+        with open(os.path.join(self.path, OFFSET_FILE), "w") as handle:
+            handle.write("%d %d" % (self.segments[0], self.position))
+
+    def size(self):
+        '''return the bytes of unread records'''
+        with self.lock:
+            return sum(self.sizes.values()) - self.position
+
+    def append(self, record):
+        '''add *record* at the end of the spool'''
+        line = json.dumps(record) + "\n"
+
+        with self.lock:
+            if self.writer is None or \
+                    self.sizes[self.segments[-1]] >= self.segment_size:
+                self._new_segment()
+
+            os.write(self.writer, line)
+            self.sizes[self.segments[-1]] += len(line)
+
+            while len(self.segments) > 1 and \
+                    sum(self.sizes.values()) > self.max_size:
+                self._drop_first()
+
+    def _new_segment(self):
+        '''start writing to a new segment'''
+        if self.writer is not None:
+            os.close(self.writer)
+
+        number = self.segments[-1] + 1 if self.segments else 0
+        self.writer = os.open(self._path(number),
+                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600)
+        self.segments.append(number)
+        self.sizes[number] = 0
+
+    def _drop_first(self):
+        '''remove the first segment, counting its unread records as
+        dropped if it's not fully read'''
+        number = self.segments.pop(0)
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+        if self.position < self.sizes[number]:
+            with open(self._path(number)) as handle:
+                handle.seek(self.position)
+                self.dropped += handle.read().count("\n")
+
+        os.remove(self._path(number))
+        del self.sizes[number]
+        self.position = 0
+        self._save_offset()
+
+    def peek(self):
+        '''return the oldest unread record or None if there are none'''
+        with self.lock:
+            while self.segments:
+                first = self.segments[0]
+
+                if self.position < self.sizes[first]:
+                    if self.reader is None:
+                        self.reader = open(self._path(first))
+
+                    self.reader.seek(self.position)
+                    line = self.reader.readline()
+
+                    try:
+                        if line.endswith("\n"):
+                            return json.loads(line)
+                    except ValueError:
+                        pass
+
+                    # written when the agent died, skip it for good
+                    self.position = self.position + len(line) if line \
+                            else self.sizes[first]
+                    self.corrupt += 1
+                    self._save_offset()
+                elif len(self.segments) > 1:
+                    self._drop_first()
+                else:
+                    return None
+
+            return None
+
+    def advance(self):
+        '''mark the record returned by peek as read'''
+        with self.lock:
+            if self.reader is None:
+                return
+
+            self.reader.seek(self.position)
+            self.position += len(self.reader.readline())
+            self._save_offset()
+
+    def close(self):
+        '''close the open files'''
+        with self.lock:
+            if self.writer is not None:
+                os.close(self.writer)
+                self.writer = None
+
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
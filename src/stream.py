@@ -0,0 +1,349 @@
+'''keyframe + delta encoding for streams of stats readings
+
+a stream encodes the successive readings of one collector, the first frame
+and then one every *keyframe_interval* frames is a keyframe with the field
+names and absolute values, the frames in between only have the fields that
+changed since the previous frame as zigzag varint deltas
+
+numbers are sent as integers, floats are scaled by FLOAT_SCALE, other values
+(strings, booleans, None) are sent in keyframes only, a frame where they
+change or where the fields are not the same is sent as a keyframe
+
+each frame has a sequence number, when the decoder sees a gap it ignores
+frames until the next keyframe, transports can ask the encoder for one'''
+import json
+
+KEYFRAME = ord("K")
+DELTA = ord("D")
+
+KIND_INT = ord("i")
+KIND_FLOAT = ord("f")
+KIND_OTHER = ord("o")
+
+# floats are sent as integer thousandths
+FLOAT_SCALE = 1000.0
+
+class StreamError(Exception):
+    '''raised when a frame can't be decoded'''
+    pass
+
+def flatten(data, path=(), items=None):
+    '''return a list of (path, value) tuples for the leaves of the nested
+    dicts and lists in *data*, paths are tuples of keys and list indexes,
+    empty dicts and lists are leaves too'''
+    if items is None:
+        items = []
+
+    if isinstance(data, dict) and data:
+        for key, value in sorted(data.items()):
+            flatten(value, path + (key,), items)
+    elif isinstance(data, (list, tuple)) and data:
+        for i, value in enumerate(data):
+            flatten(value, path + (i,), items)
+    else:
+        items.append((path, data))
+
+    return items
+
+def _child(node, key, next_key):
+    '''return the container at *key* of *node*, creating it if needed'''
+    if isinstance(node, list):
+        if key == len(node):
+            node.append([] if isinstance(next_key, int) else {})
+
+        return node[key]
+
+    child = node.get(key)
+
+    if child is None:
+        child = node[key] = [] if isinstance(next_key, int) else {}
+
+    return child
+
+def unflatten(items):
+    '''build the nested dicts and lists from a list of (path, value)
+    tuples as returned by flatten'''
+    root = None
+
+    for path, value in items:
+        if not path:
+            return value
+
+        if root is None:
+            root = [] if isinstance(path[0], int) else {}
+
+        node = root
+        for key, next_key in zip(path, path[1:]):
+            node = _child(node, key, next_key)
+
+        if isinstance(node, list):
+            node.append(value)
+        else:
+            node[path[-1]] = value
+
+    return root if root is not None else {}
+
+# the path of an empty reading, "" is the path of a reading with an empty
+# key ({"": ...})
+EMPTY_PATH = "\x02"
+
+def _encode_path(path):
+    '''return the string for *path*, list indexes are prefixed with \\x01'''
+    if not path:
+        return EMPTY_PATH
+
+    return "\x00".join(["\x01%d" % key if isinstance(key, int) else
+        key.encode("utf-8") if isinstance(key, unicode) else key
+        for key in path])
+
+def _decode_path(value):
+    '''return the path for the string returned by _encode_path'''
+    if value == EMPTY_PATH:
+        return ()
+
+    return tuple([int(key[1:]) if key.startswith("\x01") else
+        key.decode("utf-8") for key in value.split("\x00")])
+
+def _kind(value):
+    '''return the kind used to encode *value*'''
+    if isinstance(value, bool) or value is None:
+        return KIND_OTHER
+    elif isinstance(value, (int, long)):
+        return KIND_INT
+    elif isinstance(value, float):
+        return KIND_FLOAT
+    else:
+        return KIND_OTHER
+
+def _scaled(kind, value):
+    '''return the integer sent for *value* of *kind*'''
+    if kind == KIND_FLOAT:
+        return int(round(value * FLOAT_SCALE))
+
+    return value
+
+def write_varint(out, value):
+    '''append the unsigned *value* as a varint to bytearray *out*'''
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+def write_zigzag(out, value):
+    '''append the signed *value* as a zigzag varint to bytearray *out*'''
+    write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+def read_varint(data, pos):
+    '''return the (value, new position) of the varint at *pos* of bytearray
+    *data*'''
+    value = 0
+    shift = 0
+
+    while True:
+        if pos >= len(data):
+            raise StreamError("truncated frame")
+
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            return value, pos
+
+def read_zigzag(data, pos):
+    '''return the (value, new position) of the zigzag varint at *pos*'''
+    value, pos = read_varint(data, pos)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+def _write_bytes(out, value):
+    '''append a length prefixed string'''
+    write_varint(out, len(value))
+    out.extend(value)
+
+def _read_bytes(data, pos):
+    '''return the (string, new position) of a length prefixed string'''
+    size, pos = read_varint(data, pos)
+
+    if pos + size > len(data):
+        raise StreamError("truncated frame")
+
+    return str(data[pos:pos + size]), pos + size
+
+class StreamEncoder(object):
+    '''encodes the readings of one collector as keyframes and deltas'''
+
+    def __init__(self, keyframe_interval=60):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.paths = None
+        self.kinds = None
+        self.values = None
+        self.since_keyframe = 0
+        self.keyframe_requested = False
+
+    def request_keyframe(self):
+        '''make the next frame a keyframe'''
+        self.keyframe_requested = True
+
+    def encode(self, data):
+        '''return the next frame for the reading *data*'''
+        items = flatten(data)
+        paths = [path for path, _value in items]
+        kinds = [_kind(value) for _path, value in items]
+        values = [_scaled(kind, value) for kind, (_path, value) in
+                zip(kinds, items)]
+
+        out = bytearray()
+        keyframe = self.keyframe_requested or paths != self.paths or \
+                kinds != self.kinds or \
+                self.since_keyframe >= self.keyframe_interval
+
+        if not keyframe:
+            changed = [i for i, (value, old) in
+                    enumerate(zip(values, self.values)) if value != old]
+
+            if any(kinds[i] == KIND_OTHER for i in changed):
+                keyframe = True
+
+        if keyframe:
+            out.append(KEYFRAME)
+            write_varint(out, self.seq)
+            write_varint(out, len(items))
+
+            for path, kind, value in zip(paths, kinds, values):
+                _write_bytes(out, _encode_path(path))
+                out.append(kind)
+
+                if kind == KIND_OTHER:
+                    _write_bytes(out, json.dumps(value))
+                else:
+                    write_zigzag(out, value)
+
+            self.paths = paths
+            self.kinds = kinds
+            self.since_keyframe = 0
+            self.keyframe_requested = False
+        else:
+            out.append(DELTA)
+            write_varint(out, self.seq)
+            write_varint(out, len(changed))
+
+            last = -1
+            for i in changed:
+                # gap from the previous changed field
+                write_varint(out, i - last - 1)
+                write_zigzag(out, values[i] - self.values[i])
+                last = i
+
+            self.since_keyframe += 1
+
+        self.values = values
+        self.seq += 1
+
+        return str(out)
+
+class StreamDecoder(object):
+    '''rebuilds the readings from the frames of a StreamEncoder, after a lost
+    frame needs_keyframe is True and frames are ignored until the next
+    keyframe'''
+
+    def __init__(self):
+        self.seq = None
+        self.paths = None
+        self.kinds = None
+        self.values = None
+        self.needs_keyframe = True
+
+    def decode(self, frame):
+        '''return the reading for *frame* or None if it can't be rebuilt
+        until the next keyframe'''
+        data = bytearray(frame)
+
+        if not data:
+            raise StreamError("empty frame")
+
+        frame_type = data[0]
+        seq, pos = read_varint(data, 1)
+
+        if frame_type == KEYFRAME:
+            self._read_keyframe(data, pos)
+        elif frame_type == DELTA:
+            if self.needs_keyframe or seq != self.seq + 1:
+                self.needs_keyframe = True
+                self.seq = seq
+                return None
+
+            self._read_delta(data, pos)
+        else:
+            raise StreamError("unknown frame type %d" % frame_type)
+
+        self.seq = seq
+        self.needs_keyframe = False
+
+        return unflatten([(path, value / FLOAT_SCALE if kind == KIND_FLOAT
+            else value) for path, kind, value in
+            zip(self.paths, self.kinds, self.values)])
+
+    def _read_keyframe(self, data, pos):
+        '''read the fields of a keyframe'''
+        count, pos = read_varint(data, pos)
+        paths = []
+        kinds = []
+        values = []
+
+        for _ in xrange(count):
+            path, pos = _read_bytes(data, pos)
+            kind = data[pos]
+            pos += 1
+
+            if kind == KIND_OTHER:
+                value, pos = _read_bytes(data, pos)
+                value = json.loads(value)
+            else:
+                value, pos = read_zigzag(data, pos)
+
+            paths.append(_decode_path(path))
+            kinds.append(kind)
+            values.append(value)
+
+        self.paths = paths
+        self.kinds = kinds
+        self.values = values
+
+    def _read_delta(self, data, pos):
+        '''apply the changes of a delta frame'''
+        count, pos = read_varint(data, pos)
+        index = -1
+
+        for _ in xrange(count):
+            gap, pos = read_varint(data, pos)
+            delta, pos = read_zigzag(data, pos)
+            index += gap + 1
+
+            if index >= len(self.values):
+                raise StreamError("field %d out of range" % index)
+
+            self.values[index] += delta
+
+class StreamDecoders(object):
+    '''a StreamDecoder for each stream key, for consumers that get frames
+    from many hosts and collectors'''
+
+    def __init__(self):
+        self.decoders = {}
+
+    def decode(self, key, frame):
+        '''decode *frame* of stream *key*, see StreamDecoder.decode'''
+        decoder = self.decoders.get(key)
+
+        if decoder is None:
+            decoder = self.decoders[key] = StreamDecoder()
+
+        return decoder.decode(frame)
+
+    def needs_keyframe(self, key):
+        '''return True if stream *key* is waiting for a keyframe'''
+        decoder = self.decoders.get(key)
+        return decoder is None or decoder.needs_keyframe
@@ -1,18 +1,325 @@
 '''base class for transports'''
 
 import time
+import Queue
+import ctypes
+import functools
 import threading
+import ctypes.util
 
 import sistats
+import snapshot
+import aggregate
+
+# collectors in the order they are checked
+STATS = ("cpu", "mem", "net", "disk", "fs")
+
+# stat name of the summaries sent in summary mode
+SUMMARY = "%s.summary"
+
+CLOCK_MONOTONIC = 1
+CLOCK_THREAD_CPUTIME_ID = 3
+
+class _Timespec(ctypes.Structure):
+    '''struct timespec'''
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _clock(clock_id, fallback):
+    '''return a function that returns the seconds of clock *clock_id*,
+    *fallback* if clock_gettime is not available'''
+    libname = ctypes.util.find_library("rt") or ctypes.util.find_library("c")
+
+    if libname is None:
+        return fallback
+
+    clock_gettime = getattr(ctypes.CDLL(libname), "clock_gettime", None)
+
+    if clock_gettime is None:
+        return fallback
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def clock():
+        '''return the seconds of the clock'''
+        # one per call, the clocks are read from the collector threads too
+        timespec = _Timespec()
+        clock_gettime(clock_id, ctypes.byref(timespec))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+    return clock
+
+def _monotonic_clock():
+    '''return a function that returns the seconds of a monotonic clock,
+    falls back to time.time if there's no monotonic clock available'''
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+
+    return _clock(CLOCK_MONOTONIC, time.time)
+
+def _thread_time_clock():
+    '''return a function that returns the cpu seconds used by the calling
+    thread, falls back to the cpu seconds of the process'''
+    if hasattr(time, "thread_time"):
+        return time.thread_time
+
+    return _clock(CLOCK_THREAD_CPUTIME_ID, time.clock)
+
+monotonic = _monotonic_clock()
+thread_time = _thread_time_clock()
+
+def parse_seconds(value):
+    '''parse a list of collector=seconds pairs ("cpu=1,fs=60") like the
+    ones used for intervals and timeouts, return a dict with collector names
+    as keys'''
+    seconds = {}
+
+    for item in value.split(","):
+        if item.strip():
+            name, value = item.split("=", 1)
+            seconds[name.strip()] = float(value)
+
+    return seconds
+
+def parse_backends(value):
+    '''parse a backend option value, either a single backend name for all
+    collectors ("procfs") or a list of collector=backend pairs
+    ("cpu=procfs,net=procfs"), return a dict with collector names as keys'''
+    backends = {}
+
+    for item in value.split(","):
+        item = item.strip()
+
+        if not item:
+            continue
+        elif "=" in item:
+            name, backend = item.split("=", 1)
+            backends[name.strip()] = backend.strip()
+        else:
+            for name in STATS:
+                backends[name] = item
+
+    return backends
+
+def collect(function):
+    '''call *function* and return a (data, time, clock) tuple with the
+    wall clock and monotonic time at the middle of the call'''
+    start = monotonic()
+    start_time = time.time()
+    data = function()
+    half = (monotonic() - start) / 2.0
+
+    return data, start_time + half, start + half
+
+class CollectorPool(object):
+    '''run collectors on worker threads, results are put on a queue as
+    (name, sample, error) tuples'''
+
+    def __init__(self, workers):
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+
+        for _ in xrange(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        '''worker thread function'''
+        while True:
+            name, function = self.jobs.get()
+
+            try:
+                self.results.put((name, collect(function), None))
+            except Exception as error:
+                self.results.put((name, None, error))
+
+    def submit(self, name, function):
+        '''run collector *name* using *function*'''
+        self.jobs.put((name, function))
+
+    def get(self, timeout=None):
+        '''return the next result, None if there's none in *timeout*
+        seconds, 0 means don't wait'''
+        try:
+            return self.results.get(timeout != 0, timeout or None)
+        except Queue.Empty:
+            return None
+
+def add_checker_options(parser):
+    '''add the options for the Checker arguments to the OptionParser
+    *parser*, checker_options returns them as keyword arguments'''
+    parser.add_option("-B", "--backend", dest="backend", default="psutil",
+        help="collect stats using BACKEND (psutil, procfs or snapshot), can "
+        "be set per collector like cpu=procfs,net=procfs", metavar="BACKEND")
+    parser.add_option("-I", "--intervals", dest="intervals", default="",
+        help="check interval in seconds per collector, like cpu=1,fs=60, "
+        "collectors not listed use --checkinterval", metavar="INTERVALS")
+    parser.add_option("-W", "--workers", dest="workers", default=0,
+        type="int", help="run collectors on COUNT threads",
+        metavar="COUNT")
+    parser.add_option("--budget", dest="budget", default=None,
+        type="float", help="with --workers, wait at most SEC seconds for "
+        "the collectors on each check", metavar="SEC")
+    parser.add_option("--timeouts", dest="timeouts", default="",
+        help="with --workers, seconds to wait for each collector, like "
+        "fs=2,disk=1", metavar="TIMEOUTS")
+    parser.add_option("--history", dest="history", default=0, type="int",
+        help="keep the history of up to COUNT metrics in memory with 1 "
+        "second, 1 minute and 1 hour resolutions", metavar="COUNT")
+    parser.add_option("-S", "--summary", dest="summary", default=None,
+        type="float", help="send a summary of the readings (min, max, "
+        "mean, last, p95, p99) every SEC seconds instead of each reading",
+        metavar="SEC")
+    parser.add_option("--procs", dest="procs", default=0, type="int",
+        help="send the top COUNT processes by cpu, memory and io",
+        metavar="COUNT")
+    parser.add_option("--cgroups", dest="cgroups", default=None,
+        help="send the cpu, memory and io stats of the cgroups under the "
+        "cgroup v2 hierarchy at ROOT", metavar="ROOT")
+    parser.add_option("--self", dest="self_interval", default=None,
+        type="float", help="send the timings, payload sizes, errors and "
+        "queue depths of the agent every SEC seconds", metavar="SEC")
+    parser.add_option("--cpubudget", dest="cpu_budget", default=None,
+        type="float", help="check the least important, most expensive "
+        "collectors less often while the agent uses more than PERCENT of "
+        "one core", metavar="PERCENT")
+    parser.add_option("--shm", dest="shm", default=None,
+        help="write the last readings to the memory mapped FILE for local "
+        "readers (see shm.py), like /dev/shm/sistats", metavar="FILE")
+
+def checker_options(opts):
+    '''return a dict with the Checker keyword arguments from the *opts*
+    parsed with the options added by add_checker_options'''
+    return {
+        "backends": parse_backends(opts.backend),
+        "intervals": parse_seconds(opts.intervals),
+        "workers": opts.workers,
+        "budget": opts.budget,
+        "timeouts": parse_seconds(opts.timeouts),
+        "history": opts.history,
+        "summary_window": opts.summary,
+        "procs": opts.procs,
+        "cgroups": opts.cgroups,
+        "self_interval": opts.self_interval,
+        "shm": opts.shm,
+        "cpu_budget": opts.cpu_budget / 100.0
+            if opts.cpu_budget is not None else None
+    }
 
 class Checker(object):
     '''base class to check for stats'''
 
-    def __init__(self, blacklist=None):
+    def __init__(self, blacklist=None, backends=None, intervals=None,
+            workers=0, budget=None, timeouts=None, history=0,
+            summary_window=None, procs=0, cgroups=None,
+            self_interval=None, shm=None, cpu_budget=None):
         self.last_vals = {}
         self.last_time = 0.0
         self.check_time = 0.0
         self.blacklist = set(blacklist if blacklist is not None else [])
+        self.backends = backends if backends is not None else {}
+
+        # seconds between checks for each collector, collectors without an
+        # interval use default_interval, if that is None too they are
+        # checked on every call to check
+        self.intervals = intervals if intervals is not None else {}
+        self.default_interval = None
+        self.next_checks = {}
+
+        # wall clock time of the last reading of each collector and seconds
+        # between the two readings used to calculate the last delta
+        self.sample_times = {}
+        self.sample_elapsed = {}
+        self.sample_clocks = {}
+
+        # with workers > 0 collectors run on a thread pool, check waits at
+        # most budget seconds in total and timeouts[name] seconds for each
+        # collector, collectors that miss it are sent on the next check
+        self.pool = CollectorPool(workers) if workers > 0 else None
+        self.budget = budget
+        self.timeouts = timeouts if timeouts is not None else {}
+        self.running = {}
+        self.missed = []
+
+        # with summary_window the readings are not sent, a summary of them
+        # (see the aggregate module) is sent every summary_window seconds
+        self.summary_window = summary_window
+        self.summaries = {}
+
+        # functions called with (name, data, delta, timestamp) after each
+        # reading is sent, delta is None if there's none
+        self.observers = []
+
+        # functions called with (name, call) that wrap each check_stats,
+        # see add_hook
+        self.hooks = []
+
+        # with self_interval the timings of the agent are kept in a
+        # selfstats.SelfStats and sent every self_interval seconds
+        self.self_interval = self_interval
+
+        if self_interval is not None:
+            import selfstats
+            self.selfstats = selfstats.SelfStats(monotonic())
+            self.next_self = monotonic() + self_interval
+        else:
+            self.selfstats = None
+            self.next_self = None
+
+        # with history > 0 the readings of up to that many metrics are kept
+        # in a history.History
+        if history > 0:
+            import history as history_module
+            self.history = history_module.History(max_metrics=history)
+            self.add_observer(self.history.observe)
+        else:
+            self.history = None
+
+        # with cpu_budget (a fraction of one core) the intervals of the
+        # least important, most expensive collectors are stretched while the
+        # agent uses more than that, see governor.py
+        if cpu_budget is not None:
+            import governor as governor_module
+            self.governor = governor_module.Governor(cpu_budget, monotonic())
+        else:
+            self.governor = None
+
+        # with shm (a path) the last readings are written to a memory mapped
+        # file by a shm.Exporter after each check for local readers
+        if shm is not None:
+            import shm as shm_module
+            self.exporter = shm_module.Exporter(shm)
+            self.add_observer(self.exporter.observe)
+        else:
+            self.exporter = None
+
+        self.collectors = []
+        for name in STATS:
+            function, delta_calculator = sistats.get_collector(name,
+                    self.backends.get(name, "psutil"))
+            self.collectors.append((name, function, delta_calculator))
+
+        # with procs > 0 the top that many processes are checked too, each
+        # checker has its own table since it keeps the previous scan
+        if procs > 0:
+            import procs as procs_module
+            table = procs_module.ProcessTable(count=procs)
+            self.collectors.append(("procs", table.get_stats,
+                sistats.get_proc_stats_delta))
+
+        # with cgroups (the root of a cgroup v2 hierarchy) the stats of each
+        # cgroup are checked too
+        if cgroups is not None:
+            import cgroups as cgroups_module
+            collector = cgroups_module.CgroupCollector(cgroups)
+
+            # a v1 hierarchy or a wrong root would send {} on every check
+            if not collector.available():
+                raise ValueError("%s is not the root of a cgroup v2 "
+                        "hierarchy (no cgroup.controllers)" % cgroups)
+
+            self.collectors.append(("cgroups", collector.get_stats,
+                sistats.get_cgroup_stats_delta))
 
     def check_stats(self, name, function, delta_calculator=None):
         '''check stats for *name* using *function* if it's not the
@@ -22,20 +329,141 @@ class Checker(object):
         if name in self.blacklist:
             return
 
-        try:
-            data = function()
-            self.send_stats(name, data)
+        if self.selfstats is not None:
+            function = self.selfstats.timed("collect." + name, function,
+                    monotonic)
+
+        if self.governor is not None:
+            function = self.governor.timed(name, function, thread_time)
 
-            if name in self.last_vals and delta_calculator is not None:
-                old = self.last_vals[name]
-                delta = delta_calculator(old, data)
+        call = lambda: self.process_stats(name, collect(function),
+                delta_calculator)
 
-                self.send_delta_stats(name, delta)
+        for hook in self.hooks:
+            call = functools.partial(hook, name, call)
 
-            self.last_vals[name] = data
+        try:
+            call()
         except Exception as error:
+            self.count_error("check." + name)
             print "error fetching data from", name, error
 
+    def process_stats(self, name, sample, delta_calculator=None):
+        '''send the (data, time, clock) *sample* returned by collect for
+        *name* and its delta if there's a previous one'''
+        data, sample_time, clock = sample
+        self.sample_times[name] = sample_time
+
+        if name in self.sample_clocks:
+            self.sample_elapsed[name] = clock - self.sample_clocks[name]
+
+        self.sample_clocks[name] = clock
+
+        send = self.summary_window is None
+        data_dict = snapshot.to_dict(data)
+        delta_dict = None
+
+        if send:
+            self.send_stats(name, data_dict)
+
+        if name in self.last_vals and delta_calculator is not None:
+            old = self.last_vals[name]
+            start = monotonic()
+            cpu_start = thread_time()
+            delta = delta_calculator(old, data)
+            self.measure("delta." + name, monotonic() - start)
+            self.add_cost(name, thread_time() - cpu_start)
+            delta_dict = snapshot.to_dict(delta)
+
+            if send:
+                self.send_delta_stats(name, delta_dict)
+
+        self.last_vals[name] = data
+
+        if not send:
+            self.summarize(name, data_dict, delta_dict, clock)
+
+        for observer in self.observers:
+            observer(name, data_dict, delta_dict, sample_time)
+
+    def summarize(self, name, data, delta, clock):
+        '''add a reading to the window of *name*, send the summary if the
+        window is over'''
+        window = self.summaries.get(name)
+
+        if window is None:
+            window = self.summaries[name] = aggregate.WindowSummary(
+                    name in aggregate.COUNTERS)
+
+        window.add(clock, data, delta,
+                self.sample_elapsed.get(name) if delta is not None else None)
+
+        if window.elapsed(clock) >= self.summary_window:
+            self.send_summary_stats(name, window.summary(clock))
+            # the next delta starts at clock so windows don't overlap
+            window.reset(clock)
+
+    def send_summary_stats(self, name, data):
+        '''send the summary of collector *name*, by default as the stats
+        of SUMMARY % name'''
+        self.send_stats(SUMMARY % name, data)
+
+    def add_observer(self, observer):
+        '''call *observer* with (name, data, delta, timestamp) after each
+        reading is sent'''
+        self.observers.append(observer)
+
+    def add_hook(self, hook):
+        '''wrap each check_stats with *hook*, it's called with the collector
+        name and a function without arguments that checks it and has to
+        call it and return what it returns, for example to run it under a
+        profiler (see selfstats.Profiler), with workers it wraps the
+        collection on the worker thread so it must be thread safe'''
+        self.hooks.append(hook)
+
+    def measure(self, key, value):
+        '''add *value* to agent metric *key* if they are kept'''
+        if self.selfstats is not None:
+            self.selfstats.add(key, value)
+
+    def count_error(self, key):
+        '''count an error of *key* in the agent metrics if they are kept'''
+        if self.selfstats is not None:
+            self.selfstats.error(key)
+
+    def add_cost(self, name, seconds):
+        '''add *seconds* of cpu to the cost of collector *name* if there's
+        a cpu budget'''
+        if self.governor is not None:
+            self.governor.add(name, seconds)
+
+    def self_gauges(self):
+        '''return a dict with the gauges (queue depths...) sent with the
+        agent metrics'''
+        return {}
+
+    def check_self(self, now):
+        '''send the agent metrics if they are due at monotonic time
+        *now*'''
+        if self.selfstats is None or now < self.next_self:
+            return
+
+        if self.self_interval > 0:
+            missed = int((now - self.next_self) / self.self_interval)
+            self.next_self += (missed + 1) * self.self_interval
+        else:
+            self.next_self = now
+
+        for name, value in self.self_gauges().items():
+            self.selfstats.gauge(name, value)
+
+        if self.governor is not None:
+            self.selfstats.gauge("governor", self.governor.state())
+            self.selfstats.gauge("intervals", self.effective_intervals())
+
+        import selfstats
+        self.send_stats(selfstats.SELF, self.selfstats.take(now))
+
     def send_stats(self, name, data):
         '''send stats somewhere'''
         raise NotImplementedError()
@@ -44,21 +472,183 @@ class Checker(object):
         '''send delta stats somewhere'''
         raise NotImplementedError()
 
+    def base_interval(self, name):
+        '''return the check interval set for collector *name*'''
+        return self.intervals.get(name, self.default_interval)
+
+    def interval(self, name):
+        '''return the check interval for collector *name*, stretched if the
+        agent is over its cpu budget'''
+        interval = self.base_interval(name)
+
+        if interval is not None and self.governor is not None:
+            interval *= self.governor.factor(name)
+
+        return interval
+
+    def effective_intervals(self):
+        '''return a dict with the check interval of each collector'''
+        return dict((name, self.interval(name))
+                for name, _function, _delta in self.collectors
+                if name not in self.blacklist)
+
+    def adjust(self, now):
+        '''stretch or restore the interval of a collector if the cpu used
+        by the agent in the last window at monotonic time *now* asks for
+        it'''
+        if self.governor is None:
+            return
+
+        intervals = dict((name, self.base_interval(name))
+                for name, _function, _delta in self.collectors
+                if name not in self.blacklist and
+                self.base_interval(name) is not None)
+        change = self.governor.update(now, intervals)
+
+        if change is not None:
+            self.on_interval_changed(change[0], self.interval(change[0]))
+
+    def on_interval_changed(self, name, interval):
+        '''called when the interval of collector *name* changes to keep the
+        agent under its cpu budget'''
+        print "checking", name, "every", interval, "seconds, cpu budget", \
+                self.governor.budget, "usage", self.governor.usage
+
+    def is_due(self, name, now):
+        '''return True if collector *name* has to be checked at *now*, if
+        so schedule the next check'''
+        interval = self.interval(name)
+
+        if interval is None:
+            return True
+
+        deadline = self.next_checks.get(name)
+
+        if deadline is None:
+            deadline = now
+        elif deadline > now:
+            return False
+
+        # deadlines are kept on a fixed grid so they don't drift, missed
+        # checks are skipped instead of run in a burst
+        missed = int((now - deadline) / interval)
+        self.next_checks[name] = deadline + (missed + 1) * interval
+
+        return True
+
+    def next_deadline(self):
+        '''return the monotonic time of the next scheduled check or None if
+        there are no intervals'''
+        deadlines = self.next_checks.values()
+
+        if self.next_self is not None:
+            deadlines.append(self.next_self)
+
+        if not deadlines:
+            return None
+
+        return min(deadlines)
+
     def check(self):
-        '''check for stats'''
+        '''check for the stats that are due'''
         self.last_time = self.check_time
         self.check_time = time.time()
+        now = monotonic()
 
-        self.check_stats("cpu", sistats.get_cpu_stats,
-                            sistats.get_cpu_stats_delta)
-        self.check_stats("mem", sistats.get_mem_stats,
-                            sistats.get_mem_stats_delta)
-        self.check_stats("net", sistats.get_net_stats,
-                            sistats.get_net_stats_delta)
-        self.check_stats("disk", sistats.get_disk_stats,
-                            sistats.get_disk_stats_delta)
-        self.check_stats("fs", sistats.get_fs_stats,
-                            sistats.get_fs_stats_delta)
+        due = [(name, function, delta_calculator) for name, function,
+                delta_calculator in self.collectors if self.is_due(name, now)
+                and name not in self.blacklist]
+
+        if self.pool is None:
+            for name, function, delta_calculator in due:
+                self.check_stats(name, function, delta_calculator)
+        else:
+            self.check_parallel(due, now)
+
+        self.adjust(monotonic())
+        self.check_self(monotonic())
+
+        if self.exporter is not None:
+            self.exporter.publish()
+
+    def check_parallel(self, due, now):
+        '''run the *due* collectors on the pool and send their stats as
+        they finish'''
+        # results of collectors that missed the previous check
+        result = self.pool.get(0)
+        while result is not None:
+            self.process_result(result)
+            result = self.pool.get(0)
+
+        never = float("inf")
+        deadlines = {}
+
+        for name, function, delta_calculator in due:
+            if name in self.running:
+                # still running since a previous check
+                continue
+
+            self.running[name] = delta_calculator
+            deadlines[name] = now + self.timeouts.get(name, never)
+
+            if self.selfstats is not None:
+                function = self.selfstats.timed("collect." + name, function,
+                        monotonic)
+
+            if self.governor is not None:
+                function = self.governor.timed(name, function, thread_time)
+
+            # on the pool the hooks wrap the collection, the stats are
+            # processed on this thread
+            for hook in self.hooks:
+                function = functools.partial(hook, name, function)
+
+            self.pool.submit(name, function)
+
+        budget = never if self.budget is None else now + self.budget
+
+        while deadlines:
+            deadline = min(budget, min(deadlines.values()))
+
+            if deadline == never:
+                result = self.pool.get()
+            else:
+                result = self.pool.get(max(0.0, deadline - monotonic()))
+
+            if result is not None:
+                deadlines.pop(result[0], None)
+                self.process_result(result)
+            elif deadline == budget:
+                break
+            else:
+                current = monotonic()
+                for name in [name for name, limit in deadlines.items()
+                        if limit <= current]:
+                    del deadlines[name]
+
+        self.missed = sorted(name for name in self.running)
+
+        if self.missed:
+            self.on_missed(self.missed)
+
+    def process_result(self, result):
+        '''process a (name, sample, error) result from the pool'''
+        name, sample, error = result
+        delta_calculator = self.running.pop(name, None)
+
+        try:
+            if error is not None:
+                raise error
+
+            self.process_stats(name, sample, delta_calculator)
+        except Exception as error:
+            self.count_error("check." + name)
+            print "error fetching data from", name, error
+
+    def on_missed(self, names):
+        '''called with the collectors that didn't finish in time'''
+        print "collectors still running after the check budget:", \
+                ", ".join(names)
 
     def on_exit(self):
         '''cleanup resources'''
@@ -67,16 +657,23 @@ class Checker(object):
 class ConsoleChecker(Checker):
     '''checker class that sends the stats to the console'''
 
-    def __init__(self):
-        Checker.__init__(self)
+    def __init__(self, **kwargs):
+        Checker.__init__(self, **kwargs)
 
     def send_stats(self, name, data):
         '''send stats somewhere'''
-        sistats.pretty_print(name, data)
+        sistats.pretty_print("%s at %.3f" % (name,
+            self.sample_times.get(name, time.time())), data)
 
     def send_delta_stats(self, name, data):
         '''send delta stats somewhere'''
-        sistats.pretty_print(name + " diff", data)
+        sistats.pretty_print("%s diff over %.3f seconds" % (name,
+            self.sample_elapsed.get(name, 0.0)), data)
+
+    def send_summary_stats(self, name, data):
+        '''send the summary somewhere'''
+        sistats.pretty_print("%s summary of %d readings over %.3f seconds" %
+                (name, data["samples"], data["window"]), data["stats"])
 
     def on_exit(self):
         '''cleanup resources'''
@@ -91,18 +688,39 @@ class ThreadChecker(threading.Thread):
         self.checker = checker
         self.quit = False
 
+        if checker.default_interval is None:
+            checker.default_interval = check_interval
+
     def stop(self):
-        '''call it to exit after the next check'''
+        '''call it to exit after the current check'''
         self.quit = True
 
     def run(self):
-        '''main thread function'''
+        '''main thread function, sleeps until the next collector is due
+        so the check period doesn't include the time spent checking'''
         while not self.quit:
             self.checker.check()
-            time.sleep(self.check_interval)
+
+            deadline = self.checker.next_deadline()
+
+            if deadline is None:
+                deadline = monotonic() + self.check_interval
+
+            self.sleep_until(deadline)
 
         self.checker.on_exit()
 
+    def sleep_until(self, deadline):
+        '''sleep until the monotonic time *deadline* or until stop is
+        called'''
+        while not self.quit:
+            remaining = deadline - monotonic()
+
+            if remaining <= 0:
+                break
+
+            time.sleep(min(remaining, 0.5))
+
 def main_loop(checker, check_interval=10):
     '''create a thread checker and wait till ctrl + c'''
     listener = ThreadChecker(checker, check_interval)
@@ -0,0 +1,362 @@
+'''schema based binary format for stats readings
+
+a reading is split in a schema and its numbers, the schema has the layout of
+the reading: a table with each key (field and device names) once, the dicts
+and lists it's made of, the struct type of each number and the values that
+are not numbers (strings, booleans, None), the numbers are packed with
+struct as fixed width integers and doubles, a field keeps the struct type it
+had when the schema was made
+
+every frame starts with a header with the magic, the format version, the
+frame type and the schema id (the crc32 of the schema), a frame carries the
+schema only the first time, when it changes, every *schema_interval* frames
+or when asked to, the rest only have the numbers, decoders keep the schemas
+they've seen by id so hosts with the same layout share them'''
+import json
+import zlib
+import struct
+
+from itertools import izip
+
+MAGIC = "SW"
+VERSION = 1
+
+# frame with the schema and the numbers / with the numbers only
+SCHEMA = ord("S")
+VALUES = ord("V")
+
+HEADER = struct.Struct("!2sBBI")
+SCHEMA_SIZE = struct.Struct("!I")
+
+# struct codes for the numbers
+INT = "q"
+FLOAT = "d"
+
+class WireError(Exception):
+    '''raised when a reading or a frame can't be encoded or decoded'''
+    pass
+
+def _code(value):
+    '''return the struct code used for *value*, None if it's not a number
+    that fits one'''
+    if isinstance(value, bool) or value is None:
+        return None
+    elif isinstance(value, (int, long)):
+        return INT if -2 ** 63 <= value < 2 ** 63 else None
+    elif isinstance(value, float):
+        return FLOAT
+    else:
+        return None
+
+def _walk(node, parent, key, containers, leaves):
+    '''add the containers and the leaves of *node* to *containers* as
+    (parent, key, is list, size) and to *leaves* as (container, key, value),
+    containers are referred to by their position'''
+    index = len(containers)
+    is_list = isinstance(node, (list, tuple))
+    containers.append((parent, key, is_list, len(node)))
+
+    for child in (xrange(len(node)) if is_list else sorted(node)):
+        value = node[child]
+
+        if isinstance(value, (dict, list, tuple)):
+            _walk(value, index, child, containers, leaves)
+        else:
+            leaves.append((index, child, value))
+
+class Schema(object):
+    '''the layout of a reading
+
+    containers is a list of (parent, key, is list, size) for each dict and
+    list, the first one is the reading, numbers a list of (container, key,
+    struct code) and constants a list of (container, key, value) for the
+    rest of the fields, numbers are sorted by container'''
+
+    def __init__(self, containers, numbers, constants):
+        self.containers = containers
+        self.numbers = numbers
+        self.constants = constants
+        self.constant_values = [value for _index, _key, value in constants]
+        self.struct = struct.Struct("!" + "".join([code
+            for _index, _key, code in numbers]))
+        self._encoded = None
+        # types of the numbers of the reading the schema was made from
+        self.types = None
+
+        # (container, keys, start, end) of the numbers of each container
+        self.groups = []
+        start = 0
+
+        for index in sorted(set([index for index, _key, _code in numbers])):
+            keys = [key for number_index, key, _code in numbers
+                    if number_index == index]
+            self.groups.append((index, keys, start, start + len(keys)))
+            start += len(keys)
+
+    @classmethod
+    def from_reading(cls, data):
+        '''return the schema of *data*'''
+        if not isinstance(data, (dict, list, tuple)):
+            raise WireError("readings must be dicts or lists")
+
+        containers = []
+        leaves = []
+        _walk(data, None, None, containers, leaves)
+
+        numbers = []
+        constants = []
+
+        for index, key, value in leaves:
+            code = _code(value)
+
+            if code is None:
+                constants.append((index, key, value))
+            else:
+                numbers.append((index, key, code))
+
+        numbers.sort(key=lambda number: number[0])
+
+        schema = cls(containers, numbers, constants)
+        schema.types = [type(value) for _index, _key, value in
+                sorted(leaves, key=lambda leaf: leaf[0])
+                if _code(value) is not None]
+
+        return schema
+
+    def _nodes(self, data):
+        '''return the containers of *data* if it has the layout of the
+        schema, None if it doesn't'''
+        if len(data) != self.containers[0][3]:
+            return None
+
+        nodes = [data]
+
+        for parent, key, _is_list, size in self.containers[1:]:
+            node = nodes[parent][key]
+
+            if len(node) != size:
+                return None
+
+            nodes.append(node)
+
+        return nodes
+
+    def pack(self, data):
+        '''return the packed numbers of *data*, None if it doesn't have the
+        layout or the constants of the schema'''
+        try:
+            nodes = self._nodes(data)
+
+            if nodes is None or [nodes[index][key] for index, key, _value
+                    in self.constants] != self.constant_values:
+                return None
+
+            # same sizes and all the keys there means the same keys
+            values = [nodes[index][key] for index, key, _code in
+                    self.numbers]
+
+            # struct would pack a float as an integer and the other way
+            if self.types is not None and \
+                    map(type, values) != self.types:
+                return None
+
+            return self.struct.pack(*values)
+        except (KeyError, IndexError, TypeError, struct.error):
+            return None
+
+    def unpack(self, data, offset=0):
+        '''return the reading for the numbers packed at *offset* of
+        *data*'''
+        try:
+            numbers = self.struct.unpack_from(data, offset)
+        except struct.error as error:
+            raise WireError("invalid values: %s" % error)
+
+        nodes = []
+
+        for parent, key, is_list, size in self.containers:
+            node = [None] * size if is_list else {}
+
+            if parent is not None:
+                nodes[parent][key] = node
+
+            nodes.append(node)
+
+        for index, keys, start, end in self.groups:
+            node = nodes[index]
+
+            if isinstance(node, dict):
+                node.update(izip(keys, numbers[start:end]))
+            else:
+                for key, value in izip(keys, numbers[start:end]):
+                    node[key] = value
+
+        for index, key, value in self.constants:
+            nodes[index][key] = value
+
+        return nodes[0]
+
+    def encode(self):
+        '''return the compressed representation of the schema'''
+        if self._encoded is None:
+            names = []
+            refs = {}
+
+            def ref(key):
+                '''return the name table reference of *key*, list indexes
+                are stored as negative numbers'''
+                if isinstance(key, (int, long)):
+                    return -key - 1
+                elif key is None:
+                    return None
+                elif key not in refs:
+                    refs[key] = len(names)
+                    names.append(key)
+
+                return refs[key]
+
+            content = {
+                "containers": [[parent, ref(key), is_list, size]
+                    for parent, key, is_list, size in self.containers],
+                "numbers": [[index, ref(key), code]
+                    for index, key, code in self.numbers],
+                "constants": [[index, ref(key), value]
+                    for index, key, value in self.constants]
+            }
+            content["names"] = names
+
+            self._encoded = zlib.compress(json.dumps(content,
+                separators=(",", ":")))
+
+        return self._encoded
+
+    @classmethod
+    def decode(cls, data):
+        '''return the schema for the output of encode'''
+        try:
+            content = json.loads(zlib.decompress(data))
+            names = content["names"]
+
+            def key(ref):
+                '''return the key for a name table reference'''
+                if ref is None:
+                    return None
+
+                return -ref - 1 if ref < 0 else names[ref]
+
+            schema = cls([(parent, key(ref), is_list, size)
+                for parent, ref, is_list, size in content["containers"]],
+                [(index, key(ref), str(code))
+                    for index, ref, code in content["numbers"]],
+                [(index, key(ref), value)
+                    for index, ref, value in content["constants"]])
+        except (zlib.error, ValueError, KeyError, IndexError,
+                TypeError) as error:
+            raise WireError("invalid schema: %s" % error)
+
+        schema._encoded = data
+
+        return schema
+
+class WireEncoder(object):
+    '''encodes the readings of one collector'''
+
+    def __init__(self, schema_interval=60):
+        self.schema_interval = schema_interval
+        self.schema = None
+        self.schema_id = None
+        self.since_schema = 0
+        self.schema_requested = False
+
+    def request_keyframe(self):
+        '''send the schema with the next frame, named like
+        stream.StreamEncoder.request_keyframe so transports can use both'''
+        self.schema_requested = True
+
+    def encode(self, data):
+        '''return the frame for the reading *data*'''
+        send_schema = self.schema_requested or \
+                self.since_schema >= self.schema_interval
+        numbers = None
+
+        if self.schema is not None:
+            numbers = self.schema.pack(data)
+
+        if numbers is None:
+            schema = Schema.from_reading(data)
+
+            if self.schema is None or \
+                    schema.encode() != self.schema.encode():
+                self.schema_id = zlib.crc32(schema.encode()) & 0xffffffff
+                send_schema = True
+
+            # replaced even if it's the same to keep the types of the
+            # numbers (an int that became a long)
+            self.schema = schema
+
+            numbers = self.schema.pack(data)
+
+            if numbers is None:
+                raise WireError("reading doesn't match its own schema")
+
+        if send_schema:
+            schema = self.schema.encode()
+            self.since_schema = 0
+            self.schema_requested = False
+
+            return "".join((HEADER.pack(MAGIC, VERSION, SCHEMA,
+                self.schema_id), SCHEMA_SIZE.pack(len(schema)), schema,
+                numbers))
+
+        self.since_schema += 1
+        return HEADER.pack(MAGIC, VERSION, VALUES, self.schema_id) + numbers
+
+class WireDecoder(object):
+    '''decodes the frames of any number of WireEncoders, keeps at most
+    *max_schemas* schemas'''
+
+    def __init__(self, max_schemas=1024):
+        self.max_schemas = max_schemas
+        self.schemas = {}
+
+    def decode(self, frame):
+        '''return the reading for *frame* or None if its schema is not known
+        yet'''
+        if len(frame) < HEADER.size:
+            raise WireError("truncated frame")
+
+        magic, version, frame_type, schema_id = HEADER.unpack_from(frame)
+
+        if magic != MAGIC:
+            raise WireError("not a wire frame")
+        elif version != VERSION:
+            raise WireError("unsupported version %d" % version)
+
+        offset = HEADER.size
+
+        if frame_type == SCHEMA:
+            if len(frame) < offset + SCHEMA_SIZE.size:
+                raise WireError("truncated frame")
+
+            size, = SCHEMA_SIZE.unpack_from(frame, offset)
+            offset += SCHEMA_SIZE.size
+
+            schema = self.schemas.get(schema_id)
+
+            if schema is None:
+                if len(self.schemas) >= self.max_schemas:
+                    self.schemas.clear()
+
+                schema = self.schemas[schema_id] = Schema.decode(
+                        frame[offset:offset + size])
+
+            offset += size
+        elif frame_type == VALUES:
+            schema = self.schemas.get(schema_id)
+
+            if schema is None:
+                return None
+        else:
+            raise WireError("unknown frame type %d" % frame_type)
+
+        return schema.unpack(frame, offset)
@@ -0,0 +1,93 @@
+'''tests for the on disk spool'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "src"))
+
+import spool
+
+class SpoolRecoveryTest(unittest.TestCase):
+    '''a spool left behind by an agent that died while writing'''
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _segment(self, number=0):
+        '''return the path of segment *number*'''
+        return os.path.join(self.path, "%012d%s" % (number, spool.SUFFIX))
+
+    def _drain(self, reader):
+        '''return all the unread records of *reader*'''
+        records = []
+
+        while True:
+            record = reader.peek()
+
+            if record is None:
+                return records
+
+            records.append(record)
+            reader.advance()
+
+    def test_truncated_segment(self):
+        writer = spool.Spool(self.path)
+        writer.append([1])
+        writer.append([2])
+        writer.append([3])
+        writer.close()
+
+        # the last record lost its end
+        with open(self._segment()) as handle:
+            content = handle.read()
+
+        with open(self._segment(), "w") as handle:
+            handle.write(content[:-3])
+
+        reader = spool.Spool(self.path)
+        self.assertEqual(self._drain(reader), [[1], [2]])
+        self.assertEqual(reader.corrupt, 1)
+        self.assertEqual(reader.size(), 0)
+
+        # records written after the restart come after the good ones
+        reader.append([4])
+        self.assertEqual(self._drain(reader), [[4]])
+        reader.close()
+
+    def test_truncated_segment_after_restart(self):
+        writer = spool.Spool(self.path)
+        writer.append({"a": 1})
+        writer.close()
+
+        with open(self._segment(), "a") as handle:
+            handle.write("{\"a\": ")
+
+        reader = spool.Spool(self.path)
+        self.assertEqual(reader.peek(), {"a": 1})
+        reader.advance()
+        self.assertEqual(reader.peek(), None)
+        reader.close()
+
+        # the skipped record stays skipped
+        reader = spool.Spool(self.path)
+        self.assertEqual(reader.peek(), None)
+        self.assertEqual(reader.corrupt, 0)
+        reader.close()
+
+    def test_garbage_line(self):
+        with open(self._segment(), "w") as handle:
+            handle.write("[1]\nnot json\n[2]\n")
+
+        reader = spool.Spool(self.path)
+        self.assertEqual(self._drain(reader), [[1], [2]])
+        self.assertEqual(reader.corrupt, 1)
+        reader.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+'''tests for the stream encoding'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "src"))
+
+import stream
+
+# readings that have to come back as they were sent
+READINGS = [
+    {},
+    [],
+    {"a": {}},
+    {"a": []},
+    {"a": {"b": {}, "c": [1, {}, []]}},
+    {"": {}},
+    {"": {"x": 1}},
+    {"cpu": [{"user": 1.5, "idle": 2.25}, {"user": 0.0, "idle": 3.0}]},
+    {"eth0": {"rb": 1 << 40, "tb": -5, "up": True, "name": u"\u00e9th",
+        "speed": None}}
+]
+
+class StreamRoundTripTest(unittest.TestCase):
+    '''readings encoded and decoded again'''
+
+    def test_keyframes(self):
+        for reading in READINGS:
+            frame = stream.StreamEncoder().encode(reading)
+            self.assertEqual(stream.StreamDecoder().decode(frame), reading)
+
+    def test_deltas(self):
+        for reading in READINGS:
+            encoder = stream.StreamEncoder()
+            decoder = stream.StreamDecoder()
+
+            for _ in xrange(3):
+                self.assertEqual(decoder.decode(encoder.encode(reading)),
+                        reading)
+
+    def test_empty_after_values(self):
+        encoder = stream.StreamEncoder()
+        decoder = stream.StreamDecoder()
+
+        for reading in ({"a": 1}, {}, {"a": 2}, {}):
+            self.assertEqual(decoder.decode(encoder.encode(reading)),
+                    reading)
+
+if __name__ == "__main__":
+    unittest.main()